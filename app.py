@@ -1,23 +1,38 @@
-from flask import Flask, render_template, request, redirect, url_for, abort, jsonify, g, make_response, send_file
+from flask import (Flask, render_template, request, redirect, url_for, abort, jsonify, g, make_response, send_file,
+                   Response, stream_with_context)
+from markupsafe import escape
 from models import (
     calculate_seniority,
     entitled_leave_days,
     entitled_sick_days,
     entitled_personal_days,
     entitled_marriage_days,
+    annual_leave_grants,
+    hourly_wage,
+    payroll_line,
+    leave_tier_changes,
+    fifo_grant_balances,
+    forecast_leave_months,
+    build_business_day_bitmap,
+    business_day_prefix,
+    business_days_between,
 )
-from datetime import datetime, date
-from decimal import Decimal, InvalidOperation
+from xlsx import XlsxWriter, ChunkSink
+from datetime import datetime, date, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import os
+import shutil
 import psycopg
+from psycopg.rows import dict_row
 import socket
-from urllib.parse import urlparse
-from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs, quote
 import base64
 import io
 import csv
 import zipfile
 import json
+from contextlib import contextmanager
+import click
 
 app = Flask(__name__)
 
@@ -30,11 +45,29 @@ LEAVE_POLICY = os.environ.get("LEAVE_POLICY", "anniversary")
 # 週年制遞延（月數）：0 = 不遞延（到期折現）；12 = 遞延一年
 ANNIV_CARRYOVER_MONTHS = int(os.environ.get("ANNIV_CARRYOVER_MONTHS", "0"))
 
+# 同一員工核准假單日期重疊：reject=拒絕 / warn=允許但提示 / allow_partial=半天內（單日 <8h 且合計 ≤8h）允許，其餘拒絕
+LEAVE_OVERLAP_POLICY = os.environ.get("LEAVE_OVERLAP_POLICY", "reject")
+
+# 公司預設工作週（ISO 星期，1=週一 … 7=週日）與每日工時；分店可在 store_work_schedules 個別設定
+WORK_WEEKDAYS = os.environ.get("WORK_WEEKDAYS", "12345")
+WORK_DAY_HOURS = Decimal(os.environ.get("WORK_DAY_HOURS", "8"))
+
+# 月薪換算時薪的每月工時（特休折現、薪資扣款）
+PAYROLL_MONTHLY_HOURS = Decimal(os.environ.get("PAYROLL_MONTHLY_HOURS", "240"))
+
+# 工作日曆的日子種類；workday = 補班（把原本的休息日改成上班）
+WORK_CALENDAR_KINDS = {'holiday': '國定假日', 'typhoon': '颱風假', 'closure': '公司休業', 'workday': '補班'}
+
 # ========== 基本認證（可關閉：不設定 ADMIN_USER/PASS 即停用） ==========
 ADMIN_USER = os.environ.get('ADMIN_USER')
 ADMIN_PASS = os.environ.get('ADMIN_PASS')
 BACKUP_TOKEN = os.environ.get('BACKUP_TOKEN')  # /admin/backup 用
 
+# 背景工作（報表/備份）產出檔存放目錄；worker 與 web 需共用
+JOB_OUTPUT_DIR = os.environ.get('JOB_OUTPUT_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_output')
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', '300'))  # running 超過此秒數沒有心跳 → 視為 worker 已死，重新排隊
+
 def _parse_basic_auth(auth_header: str):
     if not auth_header or not auth_header.startswith('Basic '):
         return None, None
@@ -76,6 +109,7 @@ def get_conn():
     user = result.username
     password = result.password
     dbname = result.path.lstrip('/')
+    sslmode = parse_qs(result.query).get('sslmode', ['require'])[0]  # 本機資料庫可用 ?sslmode=disable
     ipv4 = socket.getaddrinfo(host, port, socket.AF_INET)[0][4][0]
     return psycopg.connect(
         host=ipv4,
@@ -83,7 +117,7 @@ def get_conn():
         user=user,
         password=password,
         dbname=dbname,
-        sslmode='require'
+        sslmode=sslmode
     )
 
 # -------------------------
@@ -143,8 +177,11 @@ def _form_used_leave_hours() -> Decimal:
         return d * 8 if d >= 0 else Decimal('0')
     return Decimal('0')
 
-def _form_hours_or_days(hours_name='hours', days_name='days') -> Decimal:
-    """讀請假表單：優先小時（0.5 單位），否則天 ×8。"""
+def _form_hours_or_days(hours_name='hours', days_name='days', default=None, day_hours=None) -> Decimal:
+    """
+    讀請假表單：優先小時（0.5 單位），否則天 × 每日工時（day_hours()，例如分店排班；預設 WORK_DAY_HOURS）；
+    都沒填時用 default()（例如依工作日曆推算）。
+    """
     val_h = request.form.get(hours_name)
     if val_h not in (None, ''):
         return _parse_half_hour(val_h)
@@ -156,7 +193,9 @@ def _form_hours_or_days(hours_name='hours', days_name='days') -> Decimal:
             d = Decimal('0')
         if d <= 0:
             raise ValueError("天數需大於 0")
-        return d * 8
+        return d * (day_hours() if day_hours is not None else WORK_DAY_HOURS)
+    if default is not None:
+        return default()
     raise ValueError("請輸入請假時數")
 
 def _ensure_date(d):
@@ -203,15 +242,18 @@ def _add_months(d: date, months: int) -> date:
     last = monthrange(y, m)[1]
     return date(y, m, min(d.day, last))
 
-def compute_expiry_dates(grant_date: date, policy: str):
+def compute_expiry_dates(grant_date: date, policy: str, carryover_months=None):
     """
     回傳 (本期到期日, 最終到期日)。
     - 曆年制：本期=當年12/31，最終=次年12/31
     - 週年制：本期=入職+12個月-1天；最終=入職+(12+ANNIV_CARRYOVER_MONTHS)個月-1天
               若 ANNIV_CARRYOVER_MONTHS=0 → 不遞延 → 最終=本期
+    carryover_months：覆蓋 ANNIV_CARRYOVER_MONTHS（制度試算用）
     """
     if not grant_date:
         return None, None
+    if carryover_months is None:
+        carryover_months = ANNIV_CARRYOVER_MONTHS
 
     if policy == "calendar":
         first_expiry = date(grant_date.year, 12, 31)
@@ -224,13 +266,290 @@ def compute_expiry_dates(grant_date: date, policy: str):
             last = monthrange(y, m)[1]
             return date(y, m, min(d.day, last))
         first_expiry = _add_months(grant_date, 12) - timedelta(days=1)
-        if ANNIV_CARRYOVER_MONTHS > 0:
-            final_expiry = _add_months(grant_date, 12 + ANNIV_CARRYOVER_MONTHS) - timedelta(days=1)
+        if carryover_months > 0:
+            final_expiry = _add_months(grant_date, 12 + carryover_months) - timedelta(days=1)
         else:
             final_expiry = first_expiry
     return first_expiry, final_expiry
 
 
+# -------------------------
+# audit_logs：每月分區（acted_at），舊分區可卸離封存
+# -------------------------
+AUDIT_ARCHIVE_SCHEMA = 'audit_archive'
+
+def _audit_partition_name(month_start: date) -> str:
+    return f"audit_logs_y{month_start.year}m{month_start.month:02d}"
+
+def _ensure_audit_partition(c, month_start: date):
+    """建立某月份的 audit_logs 分區（已存在則略過）。"""
+    name = _audit_partition_name(month_start)
+    c.execute("SELECT to_regclass(%s)", (name,))
+    if c.fetchone()[0] is not None:
+        return
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name}
+          PARTITION OF audit_logs
+          FOR VALUES FROM ('{month_start.isoformat()}') TO ('{_add_months(month_start, 1).isoformat()}')
+    """)
+
+def _ensure_audit_logs(c):
+    """
+    audit_logs 為依 acted_at 每月 RANGE 分區的資料表，before/after 為 JSONB（只存變動欄位）。
+    舊版（單一 TEXT 表）會在第一次執行時轉換：逐筆算出差異後搬入分區表，再刪除舊表。
+    每次呼叫確保「本月 + 下月」分區存在，DEFAULT 分區僅作保險。
+    """
+    c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('audit_logs')")
+    row = c.fetchone()
+    created = False
+    if row is None or row[0] != 'p':
+        # 多個 worker 同時啟動時只讓一個做轉換
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('audit_logs_migrate'))")
+        c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('audit_logs')")
+        row = c.fetchone()
+    if row is None or row[0] != 'p':
+        created = True
+        legacy = row is not None
+        if legacy:
+            c.execute("ALTER TABLE audit_logs RENAME TO audit_logs_legacy")
+            c.execute("ALTER SEQUENCE IF EXISTS audit_logs_id_seq OWNED BY NONE")
+        c.execute("CREATE SEQUENCE IF NOT EXISTS audit_logs_id_seq")
+        c.execute("""
+            CREATE TABLE audit_logs (
+              id          BIGINT NOT NULL DEFAULT nextval('audit_logs_id_seq'),
+              table_name  TEXT,
+              row_id      INTEGER,
+              action      TEXT,                -- insert/update/delete/approve/reject/backup/report
+              before_json JSONB,               -- 只存變動欄位（變更前）
+              after_json  JSONB,               -- 只存變動欄位（變更後）
+              acted_by    TEXT,
+              acted_at    TIMESTAMP NOT NULL DEFAULT NOW(),
+              CONSTRAINT audit_logs_pk PRIMARY KEY (id, acted_at)
+            ) PARTITION BY RANGE (acted_at);
+        """)
+        c.execute("ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs.id")
+        c.execute("CREATE TABLE IF NOT EXISTS audit_logs_default PARTITION OF audit_logs DEFAULT")
+        c.execute("CREATE INDEX IF NOT EXISTS audit_logs_table_row_idx ON audit_logs (table_name, row_id, acted_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS audit_logs_acted_by_idx ON audit_logs (acted_by, acted_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS audit_logs_acted_at_idx ON audit_logs (acted_at, id)")
+
+        if legacy:
+            c.execute("SELECT MIN(acted_at)::date FROM audit_logs_legacy")
+            first = c.fetchone()[0] or date.today()
+            m = date(first.year, first.month, 1)
+            while m <= date.today():
+                _ensure_audit_partition(c, m)
+                m = _add_months(m, 1)
+            # 舊資料：完整 before/after → 只留變動欄位（規則同 _audit_diff）
+            c.execute("""
+                INSERT INTO audit_logs (id, table_name, row_id, action, before_json, after_json, acted_by, acted_at)
+                SELECT l.id, l.table_name, l.row_id, l.action,
+                       CASE WHEN j.b = '{}'::jsonb OR j.a = '{}'::jsonb THEN j.b
+                            ELSE (SELECT COALESCE(jsonb_object_agg(k, j.b -> k), '{}'::jsonb)
+                                    FROM jsonb_object_keys(j.a) k
+                                   WHERE j.b ? k AND (j.b -> k) IS DISTINCT FROM (j.a -> k)) END,
+                       CASE WHEN j.b = '{}'::jsonb OR j.a = '{}'::jsonb THEN j.a
+                            ELSE (SELECT COALESCE(jsonb_object_agg(k, j.a -> k), '{}'::jsonb)
+                                    FROM jsonb_object_keys(j.a) k
+                                   WHERE (j.b -> k) IS DISTINCT FROM (j.a -> k)) END,
+                       l.acted_by, COALESCE(l.acted_at, NOW())
+                  FROM audit_logs_legacy l
+                  CROSS JOIN LATERAL (
+                    SELECT COALESCE(NULLIF(l.before_json, ''), '{}')::jsonb AS b,
+                           COALESCE(NULLIF(l.after_json,  ''), '{}')::jsonb AS a
+                  ) j
+            """)
+            c.execute("SELECT setval('audit_logs_id_seq', GREATEST((SELECT COALESCE(MAX(id), 0) FROM audit_logs), 1))")
+            c.execute("DROP TABLE audit_logs_legacy")
+
+    # 變更 feed（/api/changes）排序用：寫入交易的 xid8。既有紀錄為 0（常數預設值，不重寫資料），
+    # 之後的新紀錄才改用 pg_current_xact_id()；已有欄位就不再 ALTER（避免每次都拿表鎖）
+    c.execute("SELECT 1 FROM pg_attribute WHERE attrelid = 'audit_logs'::regclass AND attname = 'txid' AND NOT attisdropped")
+    if c.fetchone() is None:
+        c.execute("ALTER TABLE audit_logs ADD COLUMN IF NOT EXISTS txid xid8 NOT NULL DEFAULT '0'")
+        c.execute("ALTER TABLE audit_logs ALTER COLUMN txid SET DEFAULT pg_current_xact_id()")
+        # feed 索引：剛建立的表直接建；既有資料庫交給 `flask create-indexes`（HOT_INDEXES，CONCURRENTLY）
+        if created:
+            c.execute("CREATE INDEX IF NOT EXISTS audit_logs_feed_idx ON audit_logs (txid, id)")
+
+    this_month = date.today().replace(day=1)
+    _ensure_audit_partition(c, this_month)
+    _ensure_audit_partition(c, _add_months(this_month, 1))
+
+
+# -------------------------
+# leave_records：依 date_from 年度分區；每年再依 archived 分成 hot / arch 兩個子分區
+# -------------------------
+# 封存子分區可放到另外的 tablespace（例如掛在有壓縮的檔案系統上）
+LEAVE_ARCHIVE_TABLESPACE = os.environ.get('LEAVE_ARCHIVE_TABLESPACE')
+
+def _leave_records_is_partitioned(c) -> bool:
+    c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('leave_records')")
+    row = c.fetchone()
+    return bool(row and row[0] == 'p')
+
+def _ensure_leave_year_partition(c, year: int, parent: str = 'leave_records'):
+    """
+    建立某年度分區（已存在則略過）：
+      leave_records_yYYYY        FOR VALUES FROM (YYYY-01-01) TO (YYYY+1-01-01)
+        ├ leave_records_yYYYY_hot   archived = FALSE
+        └ leave_records_yYYYY_arch  archived = TRUE（fillfactor 100、積極 TOAST 壓縮）
+    """
+    name = f"leave_records_y{year}"
+    c.execute("SELECT to_regclass(%s)", (name,))
+    if c.fetchone()[0] is not None:
+        return
+    # 跨年時多個請求會同時發現分區不存在：取鎖後再查一次，只讓一個建立
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('leave_partition'), %s)", (year,))
+    c.execute("SELECT to_regclass(%s), to_regclass(%s), to_regclass(%s)", (name, f"{name}_hot", f"{name}_arch"))
+    if all(r is not None for r in c.fetchone()):
+        return
+    tablespace = f"TABLESPACE {LEAVE_ARCHIVE_TABLESPACE}" if LEAVE_ARCHIVE_TABLESPACE else ""
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent}
+          FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')
+          PARTITION BY LIST (archived)
+    """)
+    c.execute(f"CREATE TABLE IF NOT EXISTS {name}_hot PARTITION OF {name} FOR VALUES IN (FALSE)")
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name}_arch PARTITION OF {name} FOR VALUES IN (TRUE)
+          WITH (fillfactor = 100, toast_tuple_target = 128) {tablespace}
+    """)
+
+def _ensure_leave_partition_for(conn, d):
+    """寫入前確保該日期所在年度的分區存在（轉換期間同時顧及 leave_records_part）。"""
+    year = _ensure_date(d).year
+    with conn.cursor() as c:
+        if _leave_records_is_partitioned(c):
+            _ensure_leave_year_partition(c, year)
+        else:
+            c.execute("SELECT to_regclass('leave_records_part')")
+            if c.fetchone()[0] is not None:
+                _ensure_leave_year_partition(c, year, parent='leave_records_part')
+
+
+# -------------------------
+# 熱點查詢索引（由 `flask create-indexes` 以 CONCURRENTLY 建立，不鎖寫入）
+# 名稱必須以「資料表名_」開頭：分區表的子分區索引以 <分區名>_<後綴> 命名
+# -------------------------
+HOT_INDEXES = [
+    # 首頁/保險列表/到期提醒：在職篩選 + 分店 + 依 id 分頁（INCLUDE end_date 可 index-only 計數）
+    ('employees_active_store_idx', 'employees',
+     "(store_id, id) INCLUDE (end_date) WHERE COALESCE(is_active, TRUE) = TRUE"),
+    # 月報/離職篩選：end_date IS NULL OR end_date >= ...
+    ('employees_end_date_idx', 'employees', "(end_date)"),
+    # 分店管理：各分店人數
+    ('employees_store_idx', 'employees', "(store_id)"),
+    # 年資里程碑：N 天內到職週年 / 特休級距變動（範圍查詢）
+    ('employees_next_anniversary_idx', 'employees', "(next_anniversary) WHERE COALESCE(is_active, TRUE) = TRUE"),
+    ('employees_next_tier_idx', 'employees', "(next_tier_change) WHERE COALESCE(is_active, TRUE) = TRUE"),
+    # _fetch_leave_usage_hours：每人每假別已用時數（覆蓋 hours，index-only scan）
+    ('leave_records_usage_idx', 'leave_records',
+     "(employee_id, leave_type) INCLUDE (hours) "
+     "WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE"),
+    # 請假紀錄頁：員工 + 假別，依 (date_from, id) 排序/分頁
+    ('leave_records_history_idx', 'leave_records', "(employee_id, leave_type, date_from, id)"),
+    # 月報：某月份的核准假單
+    ('leave_records_month_idx', 'leave_records',
+     "(date_from) INCLUDE (employee_id, leave_type, hours) "
+     "WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE"),
+    # 月報跨月分攤：與報表月份相交的核准假單（daterange &&，不只看 date_from）
+    ('leave_records_span_idx', 'leave_records',
+     "USING gist (daterange(date_from, date_to, '[]')) "
+     "WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE"),
+    # 重疊檢查：同員工核准假單的日期區間（GiST；需 btree_gist，缺少時改用 INDEX_FALLBACKS）
+    ('leave_records_overlap_idx', 'leave_records',
+     "USING gist (employee_id, daterange(date_from, date_to, '[]')) "
+     "WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE"),
+    # insurances(employee_id) 已有 UNIQUE 索引，不另建
+    ('audit_logs_table_row_idx', 'audit_logs', "(table_name, row_id, acted_at)"),
+    ('audit_logs_acted_by_idx', 'audit_logs', "(acted_by, acted_at)"),
+    ('audit_logs_acted_at_idx', 'audit_logs', "(acted_at, id)"),
+    # 變更 feed（/api/changes）：依 (txid, id) 續讀
+    ('audit_logs_feed_idx', 'audit_logs', "(txid, id)"),
+]
+
+# 索引名 → (需要的 extension, 無法安裝時的替代定義；None = 不建，由其他索引代勞)
+INDEX_FALLBACKS = {
+    # 沒有 btree_gist 時只剩日期區間，與 leave_records_span_idx 相同
+    'leave_records_overlap_idx': ('btree_gist', None),
+}
+
+def _index_state(c, name):
+    """None = 不存在；否則回傳 indisvalid。"""
+    c.execute("SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s)", (name,))
+    row = c.fetchone()
+    return None if row is None else bool(row[0])
+
+def _create_index_concurrently(c, name, table, definition):
+    """建立單一索引；上次失敗留下的 INVALID 索引先移除再重建。"""
+    state = _index_state(c, name)
+    if state is True:
+        return False
+    if state is False:
+        c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    c.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+    return True
+
+def ensure_hot_indexes(conn, echo=print):
+    """
+    建立 HOT_INDEXES（conn 需為 autocommit）。
+    分區表不支援直接 CONCURRENTLY：先在主表建 ON ONLY 索引，各葉分區逐一 CONCURRENTLY 建立，
+    再由下而上 ATTACH；全部掛上後主表索引即轉為有效。
+    """
+    with conn.cursor() as c:
+        available = set()
+        for ext in {ext for ext, _ in INDEX_FALLBACKS.values()}:
+            try:
+                c.execute(f"CREATE EXTENSION IF NOT EXISTS {ext}")
+                available.add(ext)
+            except psycopg.Error:
+                echo(f"extension {ext} 無法安裝，改用替代索引")
+        for name, table, definition in HOT_INDEXES:
+            if name in INDEX_FALLBACKS and INDEX_FALLBACKS[name][0] not in available:
+                definition = INDEX_FALLBACKS[name][1]
+                if definition is None:
+                    continue
+            c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = c.fetchone()
+            if row is None:
+                continue
+            if row[0] != 'p':
+                if _create_index_concurrently(c, name, table, definition):
+                    echo(f"created {name}")
+                continue
+
+            if _index_state(c, name) is True:
+                continue
+            suffix = name[len(table) + 1:]
+            c.execute("""
+                SELECT t.relid::regclass::text, t.parentrelid::regclass::text, t.isleaf
+                  FROM pg_partition_tree(%s::regclass) t
+                 WHERE t.level > 0
+                 ORDER BY t.level
+            """, (table,))
+            tree = c.fetchall()
+            c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+            idx_of = {table: name}
+            for rel, parent, isleaf in tree:
+                # 主表索引建立後才新增的分區，PostgreSQL 已自動建好並掛上
+                c.execute("""
+                    SELECT i.inhrelid::regclass::text
+                      FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+                     WHERE i.inhparent = to_regclass(%s) AND x.indrelid = to_regclass(%s)
+                """, (idx_of[parent], rel))
+                row = c.fetchone()
+                if row:
+                    idx_of[rel] = row[0]
+                    continue
+                idx_of[rel] = f"{rel}_{suffix}"
+                if isleaf:
+                    _create_index_concurrently(c, idx_of[rel], rel, definition)
+                else:
+                    c.execute(f"CREATE INDEX IF NOT EXISTS {idx_of[rel]} ON ONLY {rel} {definition}")
+                c.execute(f"ALTER INDEX {idx_of[parent]} ATTACH PARTITION {idx_of[rel]}")
+            echo(f"created {name} ({len(tree)} partitions)")
+
 
 # -------------------------
 # 資料表初始化/升級（含分店、部門、審核欄位、審計表）
@@ -297,6 +616,12 @@ def init_db():
         c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS used_leave_hours NUMERIC(8,1);")
         c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS leave_adjust_hours NUMERIC(8,1) DEFAULT 0;")
         c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS store_id INTEGER REFERENCES stores(id);")
+        c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS leave_ledger_synced_on DATE;")  # 特休帳本最後同步日
+        # 年資里程碑（_refresh_milestones 維護）：下次到職週年日、下次特休級距變動日與之後的天數
+        c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS next_anniversary DATE;")
+        c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS next_tier_change DATE;")
+        c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS next_tier_days INTEGER;")
+        c.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS milestones_synced_on DATE;")
         conn.commit()
 
         # ========== insurances ==========
@@ -318,28 +643,75 @@ def init_db():
         c.execute("CREATE SEQUENCE IF NOT EXISTS insurances_id_seq;")
         c.execute("ALTER TABLE insurances ALTER COLUMN id SET DEFAULT nextval('insurances_id_seq');")
         c.execute("ALTER SEQUENCE insurances_id_seq OWNED BY insurances.id;")
+        c.execute("ALTER TABLE insurances ADD COLUMN IF NOT EXISTS locked BOOLEAN DEFAULT FALSE;")  # 手動鎖定，不隨級距重算
         conn.commit()
 
-        # ========== leave_records（加入 hours + 審核欄位 + 軟刪） ==========
+        # ========== 勞健保級距與費率（依生效日版本化） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS insurance_rate_versions (
+              id                     SERIAL PRIMARY KEY,
+              effective_from         DATE NOT NULL UNIQUE,
+              labour_rate            NUMERIC(6,5) NOT NULL,   -- 勞保普通事故 + 就業保險
+              labour_employee_share  NUMERIC(4,3) NOT NULL,
+              labour_employer_share  NUMERIC(4,3) NOT NULL,
+              health_rate            NUMERIC(6,5) NOT NULL,
+              health_employee_share  NUMERIC(4,3) NOT NULL,
+              health_employer_share  NUMERIC(4,3) NOT NULL,
+              health_dependents      NUMERIC(4,2) NOT NULL,   -- 雇主負擔的平均眷口數
+              occupational_rate      NUMERIC(6,5) NOT NULL,   -- 職災保險（雇主全額）
+              pension_rate           NUMERIC(6,5) NOT NULL,   -- 勞退提繳
+              note                   TEXT DEFAULT '',
+              created_at             TIMESTAMP DEFAULT NOW()
+            );
+        ''')
         c.execute('''
-            CREATE TABLE IF NOT EXISTS leave_records (
-              id           SERIAL PRIMARY KEY,
-              employee_id  INTEGER REFERENCES employees(id),
-              leave_type   TEXT    NOT NULL,
-              date_from    DATE    NOT NULL,
-              date_to      DATE    NOT NULL,
-              days         INTEGER,
-              hours        NUMERIC(8,1),
-              note         TEXT,
-              created_at   TIMESTAMP DEFAULT NOW(),
-              status       TEXT DEFAULT 'approved', -- pending/approved/rejected/canceled
-              created_by   TEXT,
-              approved_by  TEXT,
-              approved_at  TIMESTAMP,
-              deleted      BOOLEAN DEFAULT FALSE,
-              deleted_at   TIMESTAMP
+            CREATE TABLE IF NOT EXISTS insurance_brackets (
+              version_id     INTEGER NOT NULL REFERENCES insurance_rate_versions(id) ON DELETE CASCADE,
+              kind           TEXT NOT NULL,                  -- labour / health / pension / occupational
+              insured_salary INTEGER NOT NULL,               -- 投保金額（月薪 ≤ 此值的最小一級）
+              PRIMARY KEY (version_id, kind, insured_salary)
             );
         ''')
+        c.execute("SELECT 1 FROM insurance_rate_versions LIMIT 1")
+        if c.fetchone() is None:
+            c.execute('''
+                INSERT INTO insurance_rate_versions (effective_from, labour_rate, labour_employee_share, labour_employer_share,
+                       health_rate, health_employee_share, health_employer_share, health_dependents,
+                       occupational_rate, pension_rate, note)
+                VALUES ('2025-01-01', 0.125, 0.2, 0.7, 0.0517, 0.3, 0.6, 0.56, 0.0021, 0.06, '預設：114 年費率')
+                RETURNING id
+            ''')
+            vid = c.fetchone()[0]
+            c.executemany("INSERT INTO insurance_brackets (version_id, kind, insured_salary) VALUES (%s,%s,%s)",
+                          [(vid, kind, amt) for kind, cap in INSURANCE_BRACKET_CAPS.items()
+                           for amt in DEFAULT_INSURED_SALARIES if amt <= cap])
+        conn.commit()
+
+        # ========== leave_records（加入 hours + 審核欄位 + 軟刪；依 date_from 年度分區） ==========
+        # 新資料庫直接建分區表；既有的單一表由 `flask leave-partition-migrate` 線上轉換
+        c.execute("SELECT to_regclass('leave_records')")
+        if c.fetchone()[0] is None:
+            c.execute('''
+                CREATE TABLE leave_records (
+                  id           SERIAL,
+                  employee_id  INTEGER REFERENCES employees(id),
+                  leave_type   TEXT    NOT NULL,
+                  date_from    DATE    NOT NULL,
+                  date_to      DATE    NOT NULL,
+                  days         INTEGER,
+                  hours        NUMERIC(8,1),
+                  note         TEXT,
+                  created_at   TIMESTAMP DEFAULT NOW(),
+                  status       TEXT DEFAULT 'approved', -- pending/approved/rejected/canceled
+                  created_by   TEXT,
+                  approved_by  TEXT,
+                  approved_at  TIMESTAMP,
+                  deleted      BOOLEAN DEFAULT FALSE,
+                  deleted_at   TIMESTAMP,
+                  archived     BOOLEAN NOT NULL DEFAULT FALSE, -- 已離職員工舊年度 → 封存分區
+                  CONSTRAINT leave_records_pk PRIMARY KEY (id, date_from, archived)
+                ) PARTITION BY RANGE (date_from);
+            ''')
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS hours NUMERIC(8,1);")
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'approved';")
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS created_by TEXT;")
@@ -347,22 +719,296 @@ def init_db():
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS approved_at TIMESTAMP;")
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS deleted BOOLEAN DEFAULT FALSE;")
         c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;")
-        c.execute("UPDATE leave_records SET status = COALESCE(status, 'approved');")
+        c.execute("ALTER TABLE leave_records ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT FALSE;")
+        c.execute("UPDATE leave_records SET status = 'approved' WHERE status IS NULL;")
+        if _leave_records_is_partitioned(c):
+            _ensure_leave_year_partition(c, date.today().year)
+            _ensure_leave_year_partition(c, date.today().year + 1)
         conn.commit()
 
-        # ========== audit_logs ==========
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS audit_logs (
-              id SERIAL PRIMARY KEY,
-              table_name TEXT,
-              row_id INTEGER,
-              action TEXT,                -- insert/update/delete/approve/reject/backup/report
-              before_json TEXT,
-              after_json  TEXT,
-              acted_by    TEXT,
-              acted_at    TIMESTAMP DEFAULT NOW()
+        # ========== audit_logs（JSONB 差異 + 依 acted_at 每月分區） ==========
+        _ensure_audit_logs(c)
+        conn.commit()
+
+        # ========== 特休帳本（每位員工每個給假期間一列 + FIFO 扣抵明細） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_grants (
+              id             SERIAL PRIMARY KEY,
+              employee_id    INTEGER NOT NULL REFERENCES employees(id),
+              grant_date     DATE NOT NULL,
+              period_end     DATE NOT NULL,                   -- 本期到期；之後未休的轉為遞延
+              expires_on     DATE NOT NULL,                   -- 最終到期（含遞延）
+              granted_hours  NUMERIC(8,1) NOT NULL,
+              adjust_hours   NUMERIC(8,1) NOT NULL DEFAULT 0, -- employees.leave_adjust_hours 記在最新一期
+              used_hours     NUMERIC(8,1) NOT NULL DEFAULT 0,
+              carried_hours  NUMERIC(8,1) NOT NULL DEFAULT 0,
+              expired_hours  NUMERIC(8,1) NOT NULL DEFAULT 0,
+              paid_out_hours NUMERIC(8,1) NOT NULL DEFAULT 0, -- 未休折現
+              paid_out_on    DATE,
+              updated_at     TIMESTAMP DEFAULT NOW(),
+              UNIQUE (employee_id, grant_date)
+            );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS leave_grants_emp_expiry_idx ON leave_grants (employee_id, expires_on);")
+        # 到期提醒：只索引還有餘額的期別
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS leave_grants_open_expiry_idx ON leave_grants (expires_on)
+             WHERE used_hours + expired_hours + paid_out_hours < granted_hours + adjust_hours;
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_grant_usage (
+              id              SERIAL PRIMARY KEY,
+              grant_id        INTEGER REFERENCES leave_grants(id) ON DELETE CASCADE, -- NULL = 超休（無可扣期別）
+              employee_id     INTEGER NOT NULL,
+              leave_record_id INTEGER NOT NULL,
+              leave_date      DATE NOT NULL,
+              hours           NUMERIC(8,1) NOT NULL
             );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS leave_grant_usage_emp_idx ON leave_grant_usage (employee_id, leave_date);")
+        c.execute("ALTER TABLE leave_grants ADD COLUMN IF NOT EXISTS paid_out_on DATE;")
+        # 指定日期的已用時數：grant_id + leave_date 範圍
+        c.execute("DROP INDEX IF EXISTS leave_grant_usage_grant_idx;")
+        c.execute("CREATE INDEX IF NOT EXISTS leave_grant_usage_grant_date_idx ON leave_grant_usage (grant_id, leave_date);")
+        # 歷史餘額檢查點：每月底各員工各假別的累計已用時數（依 date_from 計）
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_balance_snapshots (
+              employee_id INTEGER NOT NULL,
+              leave_type  TEXT NOT NULL,
+              as_of       DATE NOT NULL,
+              used_hours  NUMERIC(10,1) NOT NULL,
+              taken_at    TIMESTAMP DEFAULT NOW(),
+              PRIMARY KEY (employee_id, leave_type, as_of)
+            );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS leave_balance_snapshots_as_of_idx ON leave_balance_snapshots (as_of);")
+        conn.commit()
+
+        # ========== 特休折現（每個給假期別最多結算一次） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_settlements (
+              id          SERIAL PRIMARY KEY,
+              grant_id    INTEGER NOT NULL UNIQUE REFERENCES leave_grants(id) ON DELETE RESTRICT, -- UNIQUE 讓批次可重跑
+              employee_id INTEGER NOT NULL REFERENCES employees(id),
+              store_id    INTEGER,
+              settle_date DATE NOT NULL,             -- 期別到期日或離職日
+              reason      TEXT NOT NULL,             -- expiry / termination
+              hours       NUMERIC(8,1) NOT NULL,
+              hourly_rate NUMERIC(10,2) NOT NULL,
+              amount      INTEGER NOT NULL,
+              created_at  TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS leave_settlements_date_idx ON leave_settlements (settle_date, store_id);")
+        # 已結算的期別不可刪（帳本重建會保留）；NOT VALID：既有資料不回頭檢查，新資料與刪除照樣受限
+        c.execute("""
+            SELECT 1 FROM pg_constraint
+             WHERE conrelid = 'leave_settlements'::regclass AND conname = 'leave_settlements_grant_id_fkey'
         """)
+        if c.fetchone() is None:
+            c.execute("""
+                ALTER TABLE leave_settlements ADD CONSTRAINT leave_settlements_grant_id_fkey
+                  FOREIGN KEY (grant_id) REFERENCES leave_grants(id) ON DELETE RESTRICT NOT VALID
+            """)
+        # 批次進度：每個（區間, 分店）完成後記一筆，中斷後重跑會略過
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_settlement_runs (
+              window_from DATE NOT NULL,
+              window_to   DATE NOT NULL,
+              store_id    INTEGER NOT NULL,          -- 0 = 未分店
+              rows        INTEGER NOT NULL,
+              amount      BIGINT NOT NULL,
+              finished_at TIMESTAMP DEFAULT NOW(),
+              PRIMARY KEY (window_from, window_to, store_id)
+            );
+        ''')
+        conn.commit()
+
+        # 特休負債推估快取：同一天同一參數只算一次（store_id 0 = 未分店）
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_forecast_cache (
+              as_of          DATE NOT NULL,
+              months         INTEGER NOT NULL,
+              store_id       INTEGER NOT NULL,
+              month          DATE NOT NULL,
+              headcount      INTEGER NOT NULL,
+              granted_hours  NUMERIC(12,1) NOT NULL,
+              used_hours     NUMERIC(12,1) NOT NULL,
+              expiring_hours NUMERIC(12,1) NOT NULL,
+              balance_hours  NUMERIC(12,1) NOT NULL,
+              liability      BIGINT NOT NULL,   -- 段末餘額 × 時薪
+              payout_cost    BIGINT NOT NULL,   -- 段內到期/離職折現
+              computed_at    TIMESTAMP DEFAULT NOW(),
+              PRIMARY KEY (as_of, months, store_id, month)
+            );
+        ''')
+        conn.commit()
+
+        # 分析彙總表（store_key 0 = 未分店）：請假以 date_from 月份、員工目前分店/部門歸屬；
+        # 人數只存當月到職/離職，月底人數查詢時以累計和算出。寫入路徑標記 dirty 月份，讀取前/夜間重算
+        c.execute("SELECT to_regclass('rollup_dirty_months')")
+        new_rollups = c.fetchone()[0] is None
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leave_monthly_rollup (
+              month       DATE NOT NULL,
+              store_key   INTEGER NOT NULL,
+              department  TEXT NOT NULL,
+              leave_type  TEXT NOT NULL,
+              hours       NUMERIC(12,1) NOT NULL,
+              records     INTEGER NOT NULL,
+              PRIMARY KEY (month, store_key, department, leave_type)
+            );
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS headcount_monthly_rollup (
+              month      DATE NOT NULL,
+              store_key  INTEGER NOT NULL,
+              hires      INTEGER NOT NULL,
+              leavers    INTEGER NOT NULL,
+              PRIMARY KEY (month, store_key)
+            );
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_dirty_months (
+              kind   TEXT NOT NULL,   -- leave / headcount
+              month  DATE NOT NULL,
+              PRIMARY KEY (kind, month)
+            );
+        ''')
+        if new_rollups:
+            c.execute('''
+                INSERT INTO rollup_dirty_months (kind, month)
+                SELECT DISTINCT 'leave', date_trunc('month', date_from)::date FROM leave_records
+                UNION
+                SELECT 'headcount', date_trunc('month', d)::date
+                  FROM employees, LATERAL (VALUES (start_date), (end_date)) v(d) WHERE d IS NOT NULL
+                ON CONFLICT DO NOTHING
+            ''')
+        conn.commit()
+
+        # ========== 背景工作（SKIP LOCKED 取件；queued → running → done / failed / cancelled） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+              id               BIGSERIAL PRIMARY KEY,
+              kind             TEXT NOT NULL,             -- monthly_report / backup
+              params           JSONB NOT NULL DEFAULT '{}',
+              status           TEXT NOT NULL DEFAULT 'queued',
+              progress         INTEGER NOT NULL DEFAULT 0, -- 0~100
+              message          TEXT,
+              attempts         INTEGER NOT NULL DEFAULT 0,
+              max_attempts     INTEGER NOT NULL DEFAULT 3,
+              run_after        TIMESTAMP NOT NULL DEFAULT NOW(),  -- 重試延後
+              cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+              locked_by        TEXT,
+              heartbeat_at     TIMESTAMP,
+              result_path      TEXT,
+              result_name      TEXT,
+              error            TEXT,
+              created_by       TEXT,
+              created_at       TIMESTAMP NOT NULL DEFAULT NOW(),
+              started_at       TIMESTAMP,
+              finished_at      TIMESTAMP
+            );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_after, id) WHERE status = 'queued';")
+        c.execute("CREATE INDEX IF NOT EXISTS jobs_created_idx ON jobs (created_at DESC);")
+        # 月結報表快取：version = 產生當下的 audit_logs 最大 id；之後有觸及該月的稽核紀錄才重產
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS report_cache (
+              month        DATE NOT NULL,
+              format       TEXT NOT NULL DEFAULT 'csv',   -- csv（ZIP 內多個 CSV）/ xlsx（一個活頁簿）
+              version      BIGINT NOT NULL,
+              generated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+              job_id       BIGINT REFERENCES jobs(id),
+              path         TEXT NOT NULL,
+              name         TEXT NOT NULL,
+              PRIMARY KEY (month, format)
+            );
+        ''')
+        conn.commit()
+
+        # ========== 薪資（每次計算一筆 run，明細不可修改；重算 = 新 run，以最新一筆為準） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS payroll_runs (
+              id         SERIAL PRIMARY KEY,
+              month      DATE NOT NULL,       -- 當月 1 日
+              scope      TEXT NOT NULL,       -- company / store / employee
+              store_id   INTEGER,
+              created_by TEXT,
+              created_at TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS payroll_lines (
+              id                       SERIAL PRIMARY KEY,
+              run_id                   INTEGER NOT NULL REFERENCES payroll_runs(id),
+              month                    DATE NOT NULL,
+              employee_id              INTEGER NOT NULL REFERENCES employees(id),
+              store_id                 INTEGER,
+              base_salary              INTEGER NOT NULL,
+              position_allowance       INTEGER NOT NULL,
+              employed_days            INTEGER NOT NULL,
+              hourly_rate              NUMERIC(10,2) NOT NULL,
+              gross                    INTEGER NOT NULL,
+              personal_leave_hours     NUMERIC(8,1) NOT NULL,
+              personal_leave_deduction INTEGER NOT NULL,
+              sick_leave_hours         NUMERIC(8,1) NOT NULL,
+              sick_half_pay_hours      NUMERIC(8,1) NOT NULL,
+              sick_leave_deduction     INTEGER NOT NULL,
+              personal_labour          INTEGER NOT NULL,
+              personal_health          INTEGER NOT NULL,
+              leave_cashout            INTEGER NOT NULL,
+              net                      INTEGER NOT NULL
+            );
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS payroll_lines_emp_month_idx ON payroll_lines (employee_id, month, run_id DESC);")
+        c.execute("CREATE INDEX IF NOT EXISTS payroll_lines_month_idx ON payroll_lines (month, store_id);")
+        c.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'payroll_lines_immutable'")
+        if c.fetchone() is None:
+            c.execute('''
+                CREATE OR REPLACE FUNCTION payroll_immutable() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                  RAISE EXCEPTION '% 不可修改或刪除，請重新計算產生新的 run', TG_TABLE_NAME;
+                END $$;
+            ''')
+            c.execute('''CREATE TRIGGER payroll_runs_immutable BEFORE UPDATE OR DELETE ON payroll_runs
+                         FOR EACH ROW EXECUTE FUNCTION payroll_immutable();''')
+            c.execute('''CREATE TRIGGER payroll_lines_immutable BEFORE UPDATE OR DELETE ON payroll_lines
+                         FOR EACH ROW EXECUTE FUNCTION payroll_immutable();''')
+        conn.commit()
+
+        # ========== 工作日曆（假日/颱風假/休業/補班 + 分店排班 + 每年工作日 bitmap） ==========
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS work_calendar_days (
+              id         SERIAL PRIMARY KEY,
+              day        DATE NOT NULL,
+              store_id   INTEGER REFERENCES stores(id),  -- NULL = 全公司
+              kind       TEXT NOT NULL,                  -- holiday/typhoon/closure/workday
+              name       TEXT,
+              created_at TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS work_calendar_days_day_store_uq "
+                  "ON work_calendar_days (day, COALESCE(store_id, 0));")
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS store_work_schedules (
+              store_id   INTEGER PRIMARY KEY REFERENCES stores(id),
+              workdays   TEXT NOT NULL DEFAULT '12345',  -- ISO 星期
+              day_hours  NUMERIC(4,1) NOT NULL DEFAULT 8,
+              updated_at TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+        # 快取：由上面兩張表推導，異動時刪除對應列、下次查詢重建
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS business_day_bitmaps (
+              store_id   INTEGER NOT NULL,  -- 0 = 未指定分店（公司預設）
+              year       INTEGER NOT NULL,
+              bitmap     BYTEA NOT NULL,
+              day_hours  NUMERIC(4,1) NOT NULL,
+              built_at   TIMESTAMP DEFAULT NOW(),
+              PRIMARY KEY (store_id, year)
+            );
+        ''')
         conn.commit()
 
         # 回填：員工小時欄位用天數*8 補上；歷史紀錄 hours 用 days*8 補上
@@ -370,10 +1016,12 @@ def init_db():
           UPDATE employees
              SET entitled_leave_hours = COALESCE(entitled_leave_hours, COALESCE(entitled_leave,0) * 8.0),
                  used_leave_hours     = COALESCE(used_leave_hours,     COALESCE(used_leave,0)     * 8.0)
+           WHERE entitled_leave_hours IS NULL OR used_leave_hours IS NULL
         """)
         c.execute("""
           UPDATE leave_records
-             SET hours = COALESCE(hours, COALESCE(days,0) * 8.0)
+             SET hours = COALESCE(days,0) * 8.0
+           WHERE hours IS NULL
         """)
         conn.commit()
 
@@ -396,41 +1044,484 @@ def init_db():
             conn.commit()
 
 # === Audit Log 寫入小工具 ===
+def _audit_diff(before_obj, after_obj):
+    """
+    只保留變動欄位：before/after 皆有內容時，取 after 中值不同的 key；
+    只有一邊（新增/刪除）時原樣保留。
+    """
+    before = json.loads(json.dumps(before_obj or {}, ensure_ascii=False, default=str))
+    after  = json.loads(json.dumps(after_obj  or {}, ensure_ascii=False, default=str))
+    if not before or not after:
+        return before, after
+    changed = [k for k in after if before.get(k) != after[k]]
+    return ({k: before[k] for k in changed if k in before},
+            {k: after[k] for k in changed})
+
 def write_audit(conn, table, row_id, action, before_obj=None, after_obj=None, acted_by=None):
+    """寫入稽核紀錄並 commit；資料異動請留在同一交易內不要先 commit，/api/changes 才不會漏掉事件。"""
+    before_obj, after_obj = _audit_diff(before_obj, after_obj)
     with conn.cursor() as c:
         c.execute("""
           INSERT INTO audit_logs (table_name, row_id, action, before_json, after_json, acted_by)
-          VALUES (%s,%s,%s,%s,%s,%s)
+          VALUES (%s,%s,%s,%s::jsonb,%s::jsonb,%s)
         """, (table, row_id, action,
-              json.dumps(before_obj or {}, ensure_ascii=False),
-              json.dumps(after_obj  or {}, ensure_ascii=False),
+              json.dumps(before_obj, ensure_ascii=False),
+              json.dumps(after_obj,  ensure_ascii=False),
               acted_by or getattr(g, 'current_user', None)))
     conn.commit()
 
 # === 從 leave_records 動態彙總（只計 approved） ===
-def _fetch_leave_usage_hours(conn):
+def _fetch_leave_usage_hours(conn, emp_ids=None, as_of=None):
     """
     回傳格式：
     { emp_id: { '病假': 小時, '事假': 小時, '婚假': 小時, '特休': 小時 }, ... }
     只統計：status='approved' AND deleted=false
+    emp_ids：只彙總這些員工（走 leave_records_usage_idx 的 index-only scan）；None = 全部
+    as_of：截至該日（依 date_from）的累計，改由檢查點 + 之後的差額計算
     """
+    if as_of is not None:
+        return _fetch_leave_usage_hours_as_of(conn, emp_ids, as_of)
     data = {}
+    emp_filter = "AND employee_id = ANY(%s)" if emp_ids is not None else ""
     with conn.cursor() as c:
-        c.execute("""
+        c.execute(f"""
             SELECT employee_id, leave_type, COALESCE(SUM(hours),0)
               FROM leave_records
              WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE
+                   {emp_filter}
              GROUP BY employee_id, leave_type
-        """)
+        """, (list(emp_ids),) if emp_ids is not None else None)
         for emp_id, ltype, hrs in c.fetchall():
             d = data.setdefault(emp_id, {})
             d[str(ltype)] = float(hrs or 0.0)
     return data
+def _usage_as_of_query(emp_ids, as_of):
+    """
+    「截至 as_of 的累計已用時數」SQL：每位員工每假別取 as_of 以前最近一次檢查點，
+    再加上檢查點之後到 as_of 的核准假單（leave_records_history_idx 範圍掃描）→ 成本只跟差額有關。
+    """
+    emp_filter = "AND employee_id = ANY(%(ids)s)" if emp_ids is not None else ""
+    sql = f"""
+        WITH base AS (
+          SELECT DISTINCT ON (employee_id, leave_type) employee_id, leave_type, as_of, used_hours
+            FROM leave_balance_snapshots
+           WHERE as_of <= %(as_of)s {emp_filter}
+           ORDER BY employee_id, leave_type, as_of DESC
+        ), delta AS (
+          SELECT lr.employee_id, lr.leave_type, SUM(COALESCE(lr.hours, 0)) AS hours
+            FROM leave_records lr
+            LEFT JOIN base b ON b.employee_id = lr.employee_id AND b.leave_type = lr.leave_type
+           WHERE lr.status='approved' AND COALESCE(lr.deleted,FALSE)=FALSE
+             AND lr.date_from <= %(as_of)s
+             AND (b.as_of IS NULL OR lr.date_from > b.as_of)
+             {emp_filter.replace('employee_id', 'lr.employee_id')}
+           GROUP BY lr.employee_id, lr.leave_type
+        )
+        SELECT employee_id, leave_type, COALESCE(b.used_hours, 0) + COALESCE(d.hours, 0)
+          FROM base b FULL JOIN delta d USING (employee_id, leave_type)
+    """
+    return sql, {'ids': list(emp_ids) if emp_ids is not None else None, 'as_of': as_of}
+
+def _fetch_leave_usage_hours_as_of(conn, emp_ids, as_of):
+    data = {}
+    with conn.cursor() as c:
+        c.execute(*_usage_as_of_query(emp_ids, as_of))
+        for emp_id, ltype, hrs in c.fetchall():
+            data.setdefault(emp_id, {})[str(ltype)] = float(hrs or 0.0)
+    return data
+
+def _lock_leave_ledger(conn, emp_ids):
+    """
+    員工特休帳本/餘額檢查點的交易級鎖：每人一把，依 id 排序取鎖避免互鎖。
+    帳本重建、檢查點寫入與假單異動的檢查點失效都先取這把鎖，同一人同時只有一個交易在改。
+    """
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT pg_advisory_xact_lock(hashtext('leave_ledger'), id)
+              FROM (SELECT id FROM unnest(%s::int[]) AS id ORDER BY id) s
+        """, (sorted(set(emp_ids)),))
+
+def _invalidate_leave_snapshots(conn, emp_id, since):
+    """回溯異動（date_from ≤ 既有檢查點）時，刪掉該員工 since 之後的檢查點，下次查詢改由更早的檢查點重放。"""
+    _lock_leave_ledger(conn, [emp_id])
+    with conn.cursor() as c:
+        c.execute("DELETE FROM leave_balance_snapshots WHERE employee_id=%s AND as_of >= %s",
+                  (emp_id, _ensure_date(since)))
+
+
+# -------------------------
+# 特休帳本：每個給假期間一列，核准特休依 FIFO 扣抵最早且未到期的期別
+# -------------------------
+ANNUAL_LEAVE_TYPE = '特休'
+
+def _sync_leave_ledger(conn, emp_ids, since=None):
+    """
+    同步員工的特休帳本（不 commit，與呼叫端同一交易）：
+      1) 依到職日補齊/校正給假期別（留職停薪中不新增期別；最新一期帶入 leave_adjust_hours）
+      2) since 之後（含）的特休重新 FIFO 扣抵；since=None 時整位重扣
+      3) 以一次 UPDATE 重算各期已用/遞延/到期，並記下同步日
+    """
+    emp_ids = sorted(set(emp_ids))
+    if not emp_ids:
+        return
+    today = date.today()
+    _lock_leave_ledger(conn, emp_ids)
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT id, start_date, end_date, COALESCE(on_leave_suspend, FALSE), COALESCE(leave_adjust_hours, 0)
+              FROM employees WHERE id = ANY(%s)
+        """, (emp_ids,))
+        deletes, upserts, updates = [], [], []
+        for emp_id, sd, ed, suspend, adj in c.fetchall():
+            until = min(today, _ensure_date(ed)) if ed else today
+            plan = annual_leave_grants(_ensure_date(sd), until)
+            deletes.append((emp_id, [gd for gd, _ in plan]))
+            for i, (gd, days) in enumerate(plan):
+                period_end, expires_on = compute_expiry_dates(gd, LEAVE_POLICY)
+                adjust = adj if i == len(plan) - 1 else 0
+                if suspend:
+                    updates.append((period_end, expires_on, adjust, emp_id, gd))
+                else:
+                    upserts.append((emp_id, gd, period_end, expires_on, days * 8, adjust))
+        # 不在給假計畫內的期別刪除（例如到職日更正）；已折現結算的期別保留，結算紀錄才對得到
+        c.executemany("""
+            DELETE FROM leave_grants g
+             WHERE g.employee_id=%s AND g.grant_date <> ALL(%s)
+               AND NOT EXISTS (SELECT 1 FROM leave_settlements s WHERE s.grant_id = g.id)
+        """, deletes)
+        if upserts:
+            c.executemany("""
+                INSERT INTO leave_grants (employee_id, grant_date, period_end, expires_on, granted_hours, adjust_hours)
+                VALUES (%s,%s,%s,%s,%s,%s)
+                ON CONFLICT (employee_id, grant_date) DO UPDATE
+                   SET period_end = EXCLUDED.period_end, expires_on = EXCLUDED.expires_on,
+                       adjust_hours = EXCLUDED.adjust_hours
+            """, upserts)
+        if updates:
+            c.executemany("""
+                UPDATE leave_grants SET period_end=%s, expires_on=%s, adjust_hours=%s
+                 WHERE employee_id=%s AND grant_date=%s
+            """, updates)
+
+        # 重扣範圍：since 之後的扣抵明細刪掉重算
+        if since is None:
+            c.execute("DELETE FROM leave_grant_usage WHERE employee_id = ANY(%s)", (emp_ids,))
+        else:
+            c.execute("DELETE FROM leave_grant_usage WHERE employee_id = ANY(%s) AND leave_date >= %s",
+                      (emp_ids, _ensure_date(since)))
+        c.execute("""
+            SELECT g.employee_id, g.id, g.grant_date, g.expires_on,
+                   g.granted_hours + g.adjust_hours - g.paid_out_hours
+                     - COALESCE((SELECT SUM(u.hours) FROM leave_grant_usage u WHERE u.grant_id = g.id), 0)
+              FROM leave_grants g
+             WHERE g.employee_id = ANY(%s)
+             ORDER BY g.employee_id, g.grant_date
+        """, (emp_ids,))
+        grants = {}
+        for emp_id, gid, gd, exp, remaining in c.fetchall():
+            grants.setdefault(emp_id, []).append([gid, gd, exp, remaining])
+
+        c.execute(f"""
+            SELECT employee_id, id, date_from, COALESCE(hours, 0)
+              FROM leave_records
+             WHERE employee_id = ANY(%s) AND leave_type = %s
+               AND status='approved' AND COALESCE(deleted,FALSE)=FALSE
+               {"AND date_from >= %s" if since is not None else ""}
+             ORDER BY employee_id, date_from, id
+        """, (emp_ids, ANNUAL_LEAVE_TYPE) + ((_ensure_date(since),) if since is not None else ()))
+        usage = []
+        for emp_id, rid, df, hours in c.fetchall():
+            need = hours
+            for gr in grants.get(emp_id, []):
+                if need <= 0:
+                    break
+                gid, gd, exp, remaining = gr
+                if gd <= df <= exp and remaining > 0:
+                    take = min(need, remaining)
+                    gr[3] -= take
+                    need -= take
+                    usage.append((gid, emp_id, rid, df, take))
+            if need > 0:
+                usage.append((None, emp_id, rid, df, need))
+        if usage:
+            c.executemany("""
+                INSERT INTO leave_grant_usage (grant_id, employee_id, leave_record_id, leave_date, hours)
+                VALUES (%s,%s,%s,%s,%s)
+            """, usage)
+
+        c.execute("""
+            UPDATE leave_grants g
+               SET used_hours    = u.used,
+                   carried_hours = CASE WHEN g.expires_on > g.period_end AND g.period_end < CURRENT_DATE
+                                        THEN GREATEST(g.granted_hours + g.adjust_hours - u.used_in_period, 0)
+                                        ELSE 0 END,
+                   expired_hours = CASE WHEN g.expires_on < CURRENT_DATE
+                                        THEN GREATEST(g.granted_hours + g.adjust_hours - u.used - g.paid_out_hours, 0)
+                                        ELSE 0 END,
+                   updated_at    = NOW()
+              FROM (
+                SELECT g2.id,
+                       COALESCE(SUM(x.hours), 0) AS used,
+                       COALESCE(SUM(x.hours) FILTER (WHERE x.leave_date <= g2.period_end), 0) AS used_in_period
+                  FROM leave_grants g2
+                  LEFT JOIN leave_grant_usage x ON x.grant_id = g2.id
+                 WHERE g2.employee_id = ANY(%s)
+                 GROUP BY g2.id
+              ) u
+             WHERE g.id = u.id
+        """, (emp_ids,))
+        c.execute("UPDATE employees SET leave_ledger_synced_on = CURRENT_DATE WHERE id = ANY(%s)", (emp_ids,))
+
+def _sync_stale_leave_ledgers(conn, emp_ids=None, never_only=False):
+    """
+    今天還沒同步過的員工先同步（新期別、到期/遞延依日期推進）；emp_ids=None 為全部。
+    只給 CLI / 批次作業用（每晚 `flask leave-ledger-sync`）；頁面與 API 只讀帳本，不在讀取路徑同步。
+    never_only：只補從未建帳的員工。
+    """
+    stale = "leave_ledger_synced_on IS NULL" if never_only else \
+            "(leave_ledger_synced_on IS NULL OR leave_ledger_synced_on < CURRENT_DATE)"
+    with conn.cursor() as c:
+        c.execute(f"""
+            SELECT id FROM employees
+             WHERE {stale}
+               {"AND id = ANY(%s)" if emp_ids is not None else ""}
+             ORDER BY id
+        """, (list(emp_ids),) if emp_ids is not None else None)
+        stale = [r[0] for r in c.fetchall()]
+    for i in range(0, len(stale), 500):
+        _sync_leave_ledger(conn, stale[i:i + 500])
+        conn.commit()
+    return len(stale)
+
+def _after_leave_write(conn, emp_id, leave_type, since, dates=()):
+    """
+    假單寫入後的掛勾（與寫入同一交易）：失效受影響的餘額檢查點；特休從異動日起重新扣抵；
+    標記分析彙總的月份（dates：改期時的新舊 date_from）。
+    """
+    _invalidate_leave_snapshots(conn, emp_id, since)
+    _mark_rollup_months(conn, 'leave', (since,) + tuple(dates))
+    if leave_type == ANNUAL_LEAVE_TYPE:
+        _sync_leave_ledger(conn, [emp_id], since=since)
+
+def _fetch_leave_balances(conn, emp_ids, as_of=None):
+    """
+    目前有效期別（已給假、未到期）的特休合計：{emp_id: (給假+調整, 已用, 折現)}。
+    走 leave_grants_emp_expiry_idx，不再彙總歷年流水帳。
+    as_of：改看該日有效的期別，已用/折現只算到該日（扣抵明細 leave_date ≤ as_of）。
+    已離職員工以 min(離職日, 基準日) 當天有效的期別計算，不會因期別過期而顯示 0。
+    """
+    with conn.cursor() as c:
+        if as_of is None:
+            c.execute("""
+                SELECT g.employee_id, SUM(g.granted_hours + g.adjust_hours), SUM(g.used_hours), SUM(g.paid_out_hours)
+                  FROM leave_grants g
+                  JOIN employees e ON e.id = g.employee_id
+                 CROSS JOIN LATERAL (SELECT LEAST(COALESCE(e.end_date, CURRENT_DATE), CURRENT_DATE) AS d) r
+                 WHERE g.employee_id = ANY(%s) AND g.expires_on >= r.d AND g.grant_date <= r.d
+                 GROUP BY g.employee_id
+            """, (list(emp_ids),))
+        else:
+            c.execute("""
+                SELECT g.employee_id, SUM(g.granted_hours + g.adjust_hours), SUM(COALESCE(u.hours, 0)),
+                       SUM(CASE WHEN g.paid_out_on <= %(d)s THEN g.paid_out_hours ELSE 0 END)
+                  FROM leave_grants g
+                  JOIN employees e ON e.id = g.employee_id
+                 CROSS JOIN LATERAL (SELECT LEAST(COALESCE(e.end_date, %(d)s), %(d)s::date) AS d) r
+                  LEFT JOIN LATERAL (
+                    SELECT SUM(x.hours) AS hours FROM leave_grant_usage x
+                     WHERE x.grant_id = g.id AND x.leave_date <= %(d)s
+                  ) u ON TRUE
+                 WHERE g.employee_id = ANY(%(ids)s) AND g.expires_on >= r.d AND g.grant_date <= r.d
+                 GROUP BY g.employee_id
+            """, {'ids': list(emp_ids), 'd': as_of})
+        return {r[0]: (float(r[1]), float(r[2]), float(r[3])) for r in c.fetchall()}
+
+def _parse_as_of():
+    """
+    ?as_of=YYYY-MM-DD → date；未給回傳 None（= 今天，走即時欄位）。
+    注意：as_of 是「用目前的資料回推該日」，事後補登、改期或刪除的假單都會反映在過去日期上，
+    不是當天系統實際顯示的數字（不從稽核紀錄重建）。
+    """
+    v = request.args.get('as_of')
+    if not v:
+        return None
+    try:
+        d = datetime.strptime(v, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400, description='as_of 格式需為 YYYY-MM-DD')
+    if d > date.today():
+        abort(400, description='as_of 不可晚於今天')
+    return d
+
+@app.get('/api/leave-ledger/<int:emp_id>')
+def api_leave_ledger(emp_id):
+    """員工的特休帳本：各期別給假/已用/遞延/到期/折現，以及超休（無可扣期別）時數。"""
+    init_db()
+    with get_conn() as conn:
+        with conn.cursor(row_factory=dict_row) as c:
+            c.execute("""
+                SELECT id, grant_date, period_end, expires_on, granted_hours, adjust_hours,
+                       used_hours, carried_hours, expired_hours, paid_out_hours,
+                       granted_hours + adjust_hours - used_hours - expired_hours - paid_out_hours AS remaining_hours
+                  FROM leave_grants WHERE employee_id=%s ORDER BY grant_date
+            """, (emp_id,))
+            grants = c.fetchall()
+            c.execute("SELECT COALESCE(SUM(hours), 0) AS h FROM leave_grant_usage WHERE employee_id=%s AND grant_id IS NULL",
+                      (emp_id,))
+            overdrawn = c.fetchone()['h']
+    for gr in grants:
+        for k, v in gr.items():
+            if isinstance(v, Decimal):
+                gr[k] = float(v)
+            elif isinstance(v, date):
+                gr[k] = v.isoformat()
+    return jsonify({'employee_id': emp_id, 'grants': grants, 'overdrawn_hours': float(overdrawn)})
+
+@app.get('/api/leave-balance/<int:emp_id>')
+def api_leave_balance(emp_id):
+    """
+    GET /api/leave-balance/<id>?as_of=YYYY-MM-DD → 年資、特休（有效期別）與各假別累計已用時數
+    as_of 以目前資料回推（as_of_basis='current_records'），見 _parse_as_of。
+    """
+    init_db()
+    as_of = _parse_as_of()
+    ref_day = as_of or date.today()
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT start_date, end_date FROM employees WHERE id=%s", (emp_id,))
+            row = c.fetchone()
+        if not row:
+            return abort(404)
+        usage = _fetch_leave_usage_hours(conn, [emp_id], as_of).get(emp_id, {})
+        entitled, used, paid = _fetch_leave_balances(conn, [emp_id], as_of).get(emp_id, (0.0, 0.0, 0.0))
+    sd, ed = _ensure_date(row[0]), _ensure_date(row[1])
+    ref_end = min(ed, ref_day) if ed else ref_day
+    years, months = calculate_seniority(sd, ref_end) if sd and sd <= ref_end else (0, 0)
+    return jsonify({
+        'employee_id': emp_id,
+        'as_of': ref_day.isoformat(),
+        'as_of_basis': 'current_records',
+        'seniority': {'years': years, 'months': months},
+        'annual': {'entitled_hours': entitled, 'used_hours': used, 'paid_out_hours': paid,
+                   'remaining_hours': max(entitled - used - paid, 0.0)},
+        'used_hours_by_type': usage,
+    })
 
 
 # -------------------------
 # 首頁：員工特休總覽（分店過濾 + 分頁）
 # -------------------------
+# -------------------------
+# 員工總覽（頁面與全名單匯出共用）
+# -------------------------
+OVERVIEW_SELECT = '''
+    SELECT
+        e.id, e.name, e.start_date, e.end_date,
+        e.department, e.job_level,
+        e.salary_grade, e.base_salary, e.position_allowance,
+        e.on_leave_suspend, e.used_leave, e.entitled_leave,
+        e.entitled_leave_hours, e.used_leave_hours,
+        e.entitled_sick, e.used_sick,
+        e.entitled_personal, e.used_personal,
+        e.entitled_marriage, e.used_marriage,
+        e.is_active,
+        e.leave_adjust_hours,
+        e.store_id,
+        s.name AS store_name
+    FROM employees e
+    LEFT JOIN stores s ON s.id = e.store_id
+    {where_sql}
+    ORDER BY e.id
+'''
+
+def _overview_filters(show_all, store_id, as_of):
+    """總覽篩選（在職 / all=1 全部、分店、基準日），回傳 (where_sql, params)。"""
+    where = []
+    params = []
+    if not show_all:
+        if as_of:
+            where.append("(e.end_date IS NULL OR e.end_date >= %s)")
+            where.append("e.start_date <= %s")
+            params += [as_of, as_of]
+        else:
+            where.append("(e.end_date IS NULL OR e.end_date >= CURRENT_DATE)")
+            where.append("COALESCE(e.is_active, TRUE) = TRUE")
+    if store_id:
+        where.append("e.store_id = %s")
+        params.append(store_id)
+    return ("WHERE " + " AND ".join(where)) if where else "", params
+
+def _overview_row(row, balances, usage_map, ref_day):
+    """OVERVIEW_SELECT 的一列 → 總覽顯示用 dict（特休以帳本計，病/事/婚以天呈現）。"""
+    (sid, name, sd, ed, dept, level, grade, base, allowance,
+     suspend, used_days, ent_days,
+     ent_hours, used_hours,
+     sick_ent, sick_used, per_ent, per_used, mar_ent, mar_used,
+     is_active, adj_hours, store_id, store_name) = row
+
+    # ✅ 特休以帳本計算：目前有效期別的給假（含調整）、FIFO 已扣、已折現
+    ent_h, used_h, paid_h = balances.get(sid, (0.0, 0.0, 0.0))
+    ent_h = max(ent_h, 0.0)
+
+    u = usage_map.get(sid, {})
+
+    sick_used_hours     = float(u.get('病假', 0.0))
+    personal_used_hours = float(u.get('事假', 0.0))
+    marriage_used_hours = float(u.get('婚假', 0.0))
+
+    # 以天呈現病/事/婚
+    sick_ent_days      = int(sick_ent or 0)
+    personal_ent_days  = int(per_ent or 0)
+    marriage_ent_days  = int(mar_ent or 0)
+
+    sick_used_days     = sick_used_hours / 8.0
+    personal_used_days = personal_used_hours / 8.0
+    marriage_used_days = marriage_used_hours / 8.0
+
+    remaining_sick_days     = max(sick_ent_days - sick_used_days, 0.0)
+    remaining_personal_days = max(personal_ent_days - personal_used_days, 0.0)
+    remaining_marriage_days = max(marriage_ent_days - marriage_used_days, 0.0)
+
+    # 年資（到職日 → 基準日；已離職者算到離職日）
+    ref_end = min(_ensure_date(ed), ref_day) if ed else ref_day
+    years, months = calculate_seniority(_ensure_date(sd), ref_end) if sd and _ensure_date(sd) <= ref_end else (0, 0)
+
+    return {
+        'id': sid,
+        'name': name,
+        'start_date': sd,
+        'end_date': ed or '',
+        'department': dept,
+        'job_level': level,
+        'salary_grade': grade,
+        'base_salary': base,
+        'position_allowance': allowance,
+        'years': years,
+        'months': months,
+
+        'entitled': ent_h,
+        'used': used_h,
+        'remaining': max(ent_h - used_h - paid_h, 0.0),
+
+        'suspend': suspend,
+
+        'entitled_sick': sick_ent_days,
+        'used_sick': sick_used_days,
+        'remaining_sick': remaining_sick_days,
+
+        'entitled_personal': personal_ent_days,
+        'used_personal': personal_used_days,
+        'remaining_personal': remaining_personal_days,
+
+        'entitled_marriage': marriage_ent_days,
+        'used_marriage': marriage_used_days,
+        'remaining_marriage': remaining_marriage_days,
+
+        'is_active': is_active,
+        'store_id': store_id,
+        'store_name': store_name or '未分店',
+    }
+
 @app.route('/')
 def index():
     init_db()
@@ -450,21 +1541,15 @@ def index():
     except ValueError:
         page_size = 20
     offset = (page - 1) * page_size
+    as_of = _parse_as_of()   # 歷史基準日（稽核/勞檢）；None = 今天
+    ref_day = as_of or date.today()
 
     # 分店列表
     with get_conn() as conn, conn.cursor() as c:
         c.execute("SELECT id, name, is_active FROM stores WHERE COALESCE(is_active, TRUE)=TRUE ORDER BY id")
         stores = c.fetchall()
 
-    where = []
-    params = []
-    if not show_all:
-        where.append("(e.end_date IS NULL OR e.end_date >= CURRENT_DATE)")
-        where.append("COALESCE(e.is_active, TRUE) = TRUE")
-    if current_store_id:
-        where.append("e.store_id = %s")
-        params.append(current_store_id)
-    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+    where_sql, params = _overview_filters(show_all, current_store_id, as_of)
 
     # 總數
     with get_conn() as conn, conn.cursor() as c:
@@ -473,114 +1558,13 @@ def index():
 
     # 主查詢
     with get_conn() as conn, conn.cursor() as c:
-        base_select = f'''
-            SELECT
-                e.id, e.name, e.start_date, e.end_date,
-                e.department, e.job_level,
-                e.salary_grade, e.base_salary, e.position_allowance,
-                e.on_leave_suspend, e.used_leave, e.entitled_leave,
-                e.entitled_leave_hours, e.used_leave_hours,
-                e.entitled_sick, e.used_sick,
-                e.entitled_personal, e.used_personal,
-                e.entitled_marriage, e.used_marriage,
-                e.is_active,
-                e.leave_adjust_hours,
-                e.store_id,
-                s.name AS store_name
-            FROM employees e
-            LEFT JOIN stores s ON s.id = e.store_id
-            {where_sql}
-            ORDER BY e.id
-            LIMIT %s OFFSET %s
-        '''
-        c.execute(base_select, tuple(params) + (page_size, offset))
+        c.execute(OVERVIEW_SELECT.format(where_sql=where_sql) + " LIMIT %s OFFSET %s",
+                  tuple(params) + (page_size, offset))
         rows = c.fetchall()
-        usage_map = _fetch_leave_usage_hours(conn)  # 彙總 approved 假單
-
-    employees = []
-    for (sid, name, sd, ed, dept, level, grade, base, allowance,
-         suspend, used_days, ent_days,
-         ent_hours, used_hours,
-         sick_ent, sick_used, per_ent, per_used, mar_ent, mar_used,
-         is_active, adj_hours, store_id, store_name) in rows:
-
-        # ✅ 依「現在年資」即時計算應特休（忽略 employees 的舊欄位）
-        #   在職者：用 start_date 算到今天；離職者：保守沿用資料表舊值（避免影響歷史結算）
-        if ed:
-            # 已離職 → 沿用資料表欄位
-            ent_h_base = float(ent_hours) if ent_hours is not None else float((ent_days or 0) * 8)
-        else:
-            sd_safe = _ensure_date(sd)
-            yy, mm = calculate_seniority(sd_safe)
-            ent_days_now = entitled_leave_days(yy, mm, suspend)  # 0/3/7/10/14/15...（天）
-            ent_h_base = float(ent_days_now) * 8.0
-
-        adj   = float(adj_hours or 0)
-        ent_h = max(ent_h_base + adj, 0.0)
-
-        # ✅ 已用特休一律以流水帳彙總（approved 且未刪），不看 employees 舊欄位
-        u = usage_map.get(sid, {})
-        used_h = float(u.get('特休', 0.0))
-
-
-        sick_used_hours     = float(u.get('病假', 0.0))
-        personal_used_hours = float(u.get('事假', 0.0))
-        marriage_used_hours = float(u.get('婚假', 0.0))
-
-        # 以天呈現病/事/婚
-        sick_ent_days      = int(sick_ent or 0)
-        personal_ent_days  = int(per_ent or 0)
-        marriage_ent_days  = int(mar_ent or 0)
-
-        sick_used_days     = sick_used_hours / 8.0
-        personal_used_days = personal_used_hours / 8.0
-        marriage_used_days = marriage_used_hours / 8.0
-
-        remaining_sick_days     = max(sick_ent_days - sick_used_days, 0.0)
-        remaining_personal_days = max(personal_ent_days - personal_used_days, 0.0)
-        remaining_marriage_days = max(marriage_ent_days - marriage_used_days, 0.0)
-
-        # 年資
-        ref_date = ed or sd
-        if isinstance(ref_date, str):
-            ref_date = datetime.strptime(ref_date, '%Y-%m-%d').date()
-        years, months = calculate_seniority(ref_date)
-
-        employees.append({
-            'id': sid,
-            'name': name,
-            'start_date': sd,
-            'end_date': ed or '',
-            'department': dept,
-            'job_level': level,
-            'salary_grade': grade,
-            'base_salary': base,
-            'position_allowance': allowance,
-            'years': years,
-            'months': months,
-
-            'entitled': ent_h,
-            'used': used_h,
-            'remaining': max(ent_h - used_h, 0.0),
-
-            'suspend': suspend,
-
-            'entitled_sick': sick_ent_days,
-            'used_sick': sick_used_days,
-            'remaining_sick': remaining_sick_days,
-
-            'entitled_personal': personal_ent_days,
-            'used_personal': personal_used_days,
-            'remaining_personal': remaining_personal_days,
-
-            'entitled_marriage': marriage_ent_days,
-            'used_marriage': marriage_used_days,
-            'remaining_marriage': remaining_marriage_days,
-
-            'is_active': is_active,
-            'store_id': store_id,
-            'store_name': store_name or '未分店',
-        })
+        usage_map = _fetch_leave_usage_hours(conn, [r[0] for r in rows], as_of)  # 只彙總本頁員工的 approved 假單
+        balances = _fetch_leave_balances(conn, [r[0] for r in rows], as_of)   # 特休：帳本中（基準日）有效的期別
+
+    employees = [_overview_row(r, balances, usage_map, ref_day) for r in rows]
 
     total_pages = (total_count + page_size - 1) // page_size
     pagination = {
@@ -598,7 +1582,137 @@ def index():
                            stores=stores,
                            current_store_id=current_store_id,
                            pagination=pagination,
-                           page_size=page_size)
+                           page_size=page_size,
+                           as_of=as_of.isoformat() if as_of else '')
+
+# -------------------------
+# 全名單匯出（不受分頁限制；server-side cursor 分批串流）：CSV 或 XLSX（format=xlsx）
+# -------------------------
+EXPORT_BATCH_SIZE = 2000
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def _csv_chunk(rows):
+    s = io.StringIO(); w = csv.writer(s)
+    w.writerows(rows)
+    return s.getvalue()
+
+def _export_format():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        abort(400, description='format 需為 csv 或 xlsx')
+    return fmt
+
+def _export_response(sheet_name, header, batches, filename, fmt='csv'):
+    """
+    batches：逐批產生資料列的 generator。
+    csv：BOM + 標題後每批一段；xlsx：每批寫入工作表後把已壓縮的 bytes 送出，整份檔案不在記憶體中。
+    """
+    def generate_csv():
+        yield '\ufeff' + _csv_chunk([header])
+        for batch in batches():
+            yield _csv_chunk(batch)
+
+    def generate_xlsx():
+        sink = ChunkSink()
+        book = XlsxWriter(sink)
+        with book.sheet(sheet_name, header) as ws:
+            for batch in batches():
+                ws.writerows(batch)
+                yield sink.drain()
+        book.close()
+        yield sink.drain()
+
+    if fmt == 'xlsx':
+        resp = Response(stream_with_context(generate_xlsx()), mimetype=XLSX_MIMETYPE)
+        filename = f'{filename}.xlsx'
+    else:
+        resp = Response(stream_with_context(generate_csv()), mimetype='text/csv; charset=utf-8')
+        filename = f'{filename}.csv'
+    resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return resp
+
+@app.get('/export/overview.csv')
+def export_overview_csv():
+    """
+    員工總覽全名單：與總覽相同的 all / store_id / as_of 條件，每種假別的應有/已用/剩餘時數。
+    以具名 cursor 每批 EXPORT_BATCH_SIZE 筆讀取，每批一次彙總請假與特休帳本後即寫出。format=xlsx 輸出活頁簿。
+    """
+    init_db()
+    fmt = _export_format()
+    show_all = request.args.get('all') == '1'
+    store_id = request.args.get('store_id', type=int)
+    as_of = _parse_as_of()
+    ref_day = as_of or date.today()
+    where_sql, params = _overview_filters(show_all, store_id, as_of)
+    header = [
+        '員工ID', '姓名', '分店', '部門', '職等', '到職日', '離職日', '年資(年)', '年資(月)', '留職停薪',
+        '特休應有(h)', '特休已用(h)', '特休剩餘(h)', '病假應有(h)', '病假已用(h)', '病假剩餘(h)',
+        '事假應有(h)', '事假已用(h)', '事假剩餘(h)', '婚假應有(h)', '婚假已用(h)', '婚假剩餘(h)',
+    ]
+
+    def batches():
+        # 主查詢用具名 cursor（同一交易內分批取）；各批的彙總查詢走同一連線的一般 cursor，只讀不 commit
+        with get_conn() as conn:
+            with conn.cursor(name='overview_export') as c:
+                c.itersize = EXPORT_BATCH_SIZE
+                c.execute(OVERVIEW_SELECT.format(where_sql=where_sql), tuple(params))
+                while True:
+                    batch = c.fetchmany(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    ids = [r[0] for r in batch]
+                    usage_map = _fetch_leave_usage_hours(conn, ids, as_of)
+                    balances = _fetch_leave_balances(conn, ids, as_of)
+                    out = []
+                    for r in batch:
+                        e = _overview_row(r, balances, usage_map, ref_day)
+                        out.append([
+                            e['id'], e['name'], e['store_name'], e['department'], e['job_level'],
+                            e['start_date'], e['end_date'] or None, e['years'], e['months'], '是' if e['suspend'] else '',
+                            e['entitled'], e['used'], e['remaining'],
+                            e['entitled_sick'] * 8, e['used_sick'] * 8, e['remaining_sick'] * 8,
+                            e['entitled_personal'] * 8, e['used_personal'] * 8, e['remaining_personal'] * 8,
+                            e['entitled_marriage'] * 8, e['used_marriage'] * 8, e['remaining_marriage'] * 8,
+                        ])
+                    yield out
+
+    return _export_response('員工特休總覽', header, batches, f'員工特休總覽_{ref_day.strftime("%Y%m%d")}', fmt)
+
+@app.get('/export/insurance.csv')
+def export_insurance_csv():
+    """保險負擔全名單（all=1 含離職/停用），具名 cursor 分批串流；format=xlsx 輸出活頁簿。"""
+    init_db()
+    fmt = _export_format()
+    show_all = request.args.get('all') == '1'
+    where_clause = "" if show_all else """
+        WHERE (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+          AND COALESCE(e.is_active, TRUE) = TRUE
+          AND COALESCE(e.on_leave_suspend, FALSE) = FALSE
+    """
+
+    header = ['員工ID', '姓名', '個人勞保', '個人健保', '公司勞保', '公司健保',
+              '退休金 (6%)', '職保', '公司負擔總額', '備註', '鎖定']
+
+    def batches():
+        with get_conn() as conn, conn.cursor(name='insurance_export') as c:
+            c.itersize = EXPORT_BATCH_SIZE
+            c.execute(f"""
+                SELECT e.id, e.name,
+                       i.personal_labour, i.personal_health, i.company_labour, i.company_health,
+                       i.retirement6, i.occupational_ins, i.total_company, COALESCE(i.note, ''),
+                       CASE WHEN i.locked THEN '是' ELSE '' END
+                  FROM employees e
+                  LEFT JOIN insurances i ON e.id = i.employee_id
+                  {where_clause}
+                 ORDER BY e.id
+            """)
+            while True:
+                batch = c.fetchmany(EXPORT_BATCH_SIZE)
+                if not batch:
+                    break
+                yield batch
+
+    return _export_response('保險負擔總覽', header, batches, f'保險負擔總覽_{date.today().strftime("%Y%m%d")}', fmt)
 
 # -------------------------
 # 分店管理（列表 + 新增/編輯/啟用）
@@ -620,7 +1734,7 @@ def store_list():
         """)
         rows = c.fetchall()
     # 簡易頁面（用 template 會更漂亮，先用最小可用）
-    html = ["<h1>分店管理</h1>", '<a href="/">← 返回</a><br><br>']
+    html = ["<h1>分店管理</h1>", '<a href="/">← 返回</a> ｜ <a href="/work-calendar">工作日曆 / 排班</a><br><br>']
     html.append("""
     <form method="post" action="/stores/add" style="margin-bottom:16px">
       名稱：<input name="name" required>
@@ -647,6 +1761,7 @@ def store_list():
                 <button type="submit">{'停用' if active else '啟用'}</button>
               </form>
               <a href="/stores/{sid}/departments" style="margin-left:8px">部門管理</a>
+              <a href="/stores/{sid}/calendar" style="margin-left:8px">排班日曆</a>
             </td>
           </tr>
         """)
@@ -663,7 +1778,6 @@ def store_add():
     with get_conn() as conn, conn.cursor() as c:
         c.execute("INSERT INTO stores (name, short_code) VALUES (%s,%s) RETURNING id", (name, code))
         sid = c.fetchone()[0]
-        conn.commit()
         write_audit(conn, 'stores', sid, 'insert', None, {'name': name, 'short_code': code})
     return redirect(url_for('store_list'))
 
@@ -678,7 +1792,6 @@ def store_edit(store_id):
         c.execute("SELECT name, short_code FROM stores WHERE id=%s", (store_id,))
         before = c.fetchone() or ('','')
         c.execute("UPDATE stores SET name=%s, short_code=%s WHERE id=%s", (name, code, store_id))
-        conn.commit()
         write_audit(conn, 'stores', store_id, 'update',
                     {'name': before[0], 'short_code': before[1]},
                     {'name': name, 'short_code': code})
@@ -694,7 +1807,6 @@ def store_toggle(store_id):
             return abort(404)
         newv = not bool(row[0])
         c.execute("UPDATE stores SET is_active=%s WHERE id=%s", (newv, store_id))
-        conn.commit()
         write_audit(conn, 'stores', store_id, 'update', {'is_active': not newv}, {'is_active': newv})
     return redirect(url_for('store_list'))
 
@@ -763,7 +1875,6 @@ def api_store_departments_add(store_id):
         row = c.fetchone()
         if row:
             did = row[0]
-            conn.commit()
             write_audit(conn, 'store_departments', did, 'insert', None, {'store_id': store_id, 'name': name})
     return redirect(url_for('dept_page', store_id=store_id))
 
@@ -777,37 +1888,472 @@ def api_store_departments_toggle(store_id, dep_id):
             return abort(404)
         newv = not bool(row[0])
         c.execute("UPDATE store_departments SET is_active=%s WHERE id=%s", (newv, dep_id))
-        conn.commit()
         write_audit(conn, 'store_departments', dep_id, 'update', {'is_active': not newv}, {'is_active': newv})
     return redirect(url_for('dept_page', store_id=store_id))
 
 # -------------------------
-# 新增員工（支援調整值 + 分店）
+# 分店排班日曆（每日在職/請假人數）
 # -------------------------
-@app.route('/add', methods=['GET','POST'])
-def add_employee():
-    init_db()
-    if request.method == 'POST':
-        name       = request.form['name']
-        start_date = request.form['start_date']
-        end_date_s = request.form.get('end_date') or None
-        dept       = request.form['department']
-        level      = request.form.get('job_level') or ''
-        grade      = request.form['salary_grade']
-        base       = int(request.form.get('base_salary') or 0)
-        allowance  = int(request.form.get('position_allowance') or 0)
-        suspend    = bool(request.form.get('suspend'))
-        store_id_s = request.form.get('store_id')  # 新：分店下拉
-        store_id   = int(store_id_s) if store_id_s else None
-
-        sd_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-        ed_date = datetime.strptime(end_date_s, '%Y-%m-%d').date() if end_date_s else None
-        years, months = calculate_seniority(sd_date)
-
-        entitled_days  = entitled_leave_days(years, months, suspend)
-        entitled_hours = Decimal(str(entitled_days)) * 8
-        used_hours     = _form_used_leave_hours()
-        adj_hours      = _parse_half_hour_any(request.form.get('leave_adjust_hours'))
+# 每日最低可上班人數（低於此值標紅）；0 = 不檢查，可用 ?min_staff= 覆寫
+STORE_MIN_STAFF = int(os.environ.get("STORE_MIN_STAFF", "0"))
+
+def _store_calendar(conn, store_id, month_start, department=None):
+    """
+    一次 SQL 算出整月每日：在職人數、請假人數與名單。
+    以 generate_series 展開當月日期，核准假單只取與當月相交的（daterange &&），
+    再以 day BETWEEN 區間 join 成每日覆蓋。單日部分時數的假以「時數 ÷ 分店每日工時」計入請假人數
+    （同一人同日合計最多 1 人）。
+    """
+    month_end = _add_months(month_start, 1) - timedelta(days=1)
+    dept_sql = "AND department = %(dept)s" if department else ""
+    with conn.cursor() as c:
+        c.execute(f"""
+            WITH days AS (
+              SELECT d::date AS day
+                FROM generate_series(%(start)s::date, %(end)s::date, interval '1 day') d
+            ), staff AS (
+              SELECT id, name, start_date, end_date
+                FROM employees
+               WHERE store_id = %(store_id)s
+                 AND COALESCE(on_leave_suspend, FALSE) = FALSE
+                 AND start_date <= %(end)s
+                 AND (end_date IS NULL OR end_date >= %(start)s)
+                 {dept_sql}
+            ), sched AS (
+              SELECT COALESCE((SELECT day_hours FROM store_work_schedules WHERE store_id = %(store_id)s),
+                              %(day_hours)s) AS day_hours
+            ), lv AS (
+              SELECT lr.employee_id, lr.leave_type,
+                     GREATEST(lr.date_from, %(start)s::date) AS f,
+                     LEAST(lr.date_to, %(end)s::date)       AS t,
+                     CASE WHEN lr.date_from = lr.date_to THEN lr.hours END AS part_hours
+                FROM leave_records lr
+                JOIN staff s ON s.id = lr.employee_id
+               WHERE lr.status='approved' AND COALESCE(lr.deleted,FALSE)=FALSE
+                 AND lr.date_from <= %(end)s
+                 AND daterange(lr.date_from, lr.date_to, '[]') && daterange(%(start)s::date, %(end)s::date, '[]')
+            ), absent AS (
+              SELECT d.day, lv.employee_id,
+                     LEAST(SUM(COALESCE(lv.part_hours / sched.day_hours, 1)), 1) AS share,
+                     jsonb_agg(DISTINCT jsonb_build_object(
+                       'id', lv.employee_id, 'name', s.name, 'leave_type', lv.leave_type,
+                       'hours', lv.part_hours)) AS people
+                FROM days d
+                JOIN lv ON d.day BETWEEN lv.f AND lv.t
+                JOIN staff s ON s.id = lv.employee_id
+               CROSS JOIN sched
+               GROUP BY d.day, lv.employee_id
+            )
+            SELECT d.day,
+                   (SELECT COUNT(*) FROM staff s
+                     WHERE s.start_date <= d.day AND (s.end_date IS NULL OR s.end_date >= d.day)) AS headcount,
+                   COALESCE(SUM(a.share), 0) AS on_leave,
+                   COALESCE(jsonb_agg(p.person) FILTER (WHERE p.person IS NOT NULL), '[]'::jsonb) AS people
+              FROM days d
+              LEFT JOIN absent a ON a.day = d.day
+              LEFT JOIN LATERAL jsonb_array_elements(a.people) p(person) ON TRUE
+             GROUP BY d.day
+             ORDER BY d.day
+        """, {'start': month_start, 'end': month_end, 'store_id': store_id, 'dept': department,
+              'day_hours': WORK_DAY_HOURS})
+        rows = c.fetchall()
+    return [{
+        'date': day.isoformat(),
+        'weekday': day.isoweekday(),
+        'headcount': headcount,
+        'on_leave': float(on_leave),
+        'available': float(headcount - on_leave),
+        'people': people,
+    } for day, headcount, on_leave, people in rows]
+
+def _store_calendar_args():
+    """解析日曆參數；回傳 (月初, 部門, 最低人數)。"""
+    try:
+        month = request.args.get('month') or date.today().strftime('%Y-%m')
+        month_start = datetime.strptime(month, '%Y-%m').date()
+        min_staff = int(request.args['min_staff']) if request.args.get('min_staff') else STORE_MIN_STAFF
+    except ValueError:
+        abort(400, description='參數格式錯誤')
+    department = (request.args.get('department') or '').strip() or None
+    return month_start, department, min_staff
+
+@app.get('/stores/<int:store_id>/calendar')
+def store_calendar(store_id):
+    init_db()
+    month_start, department, min_staff = _store_calendar_args()
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT name FROM stores WHERE id=%s", (store_id,))
+            srow = c.fetchone()
+            if not srow:
+                return abort(404)
+            c.execute("SELECT name FROM store_departments WHERE store_id=%s AND COALESCE(is_active,TRUE)=TRUE ORDER BY id",
+                      (store_id,))
+            departments = [r[0] for r in c.fetchall()]
+        days = _store_calendar(conn, store_id, month_start, department)
+
+    for d in days:
+        d['short'] = bool(min_staff) and d['available'] < min_staff
+    # 週一開頭的月曆格
+    weeks, week = [], [None] * (days[0]['weekday'] - 1)
+    for d in days:
+        week.append(d)
+        if len(week) == 7:
+            weeks.append(week); week = []
+    if week:
+        weeks.append(week + [None] * (7 - len(week)))
+
+    return render_template('store_calendar.html',
+                           store_id=store_id,
+                           store_name=srow[0],
+                           month=month_start.strftime('%Y-%m'),
+                           prev_month=_add_months(month_start, -1).strftime('%Y-%m'),
+                           next_month=_add_months(month_start, 1).strftime('%Y-%m'),
+                           department=department or '',
+                           departments=departments,
+                           min_staff=min_staff,
+                           weeks=weeks,
+                           short_days=sum(1 for d in days if d['short']))
+
+@app.get('/api/stores/<int:store_id>/calendar')
+def api_store_calendar(store_id):
+    """GET /api/stores/<id>/calendar?month=YYYY-MM&department=&min_staff="""
+    init_db()
+    month_start, department, min_staff = _store_calendar_args()
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT 1 FROM stores WHERE id=%s", (store_id,))
+            if c.fetchone() is None:
+                return abort(404)
+        days = _store_calendar(conn, store_id, month_start, department)
+    for d in days:
+        d['short'] = bool(min_staff) and d['available'] < min_staff
+    return jsonify({
+        'store_id': store_id,
+        'month': month_start.strftime('%Y-%m'),
+        'department': department,
+        'min_staff': min_staff,
+        'days': days,
+    })
+
+# -------------------------
+# 工作日曆（假日/颱風假/補班 + 分店排班 → 工作日 bitmap）
+# -------------------------
+def _invalidate_business_days(c, store_id=None, year=None):
+    """
+    假日或排班異動後刪掉受影響的 bitmap；全公司假日（store_id=None）影響所有分店。
+    與 _business_calendar 的重建共用 advisory lock：重建中途的異動會等它提交後再刪，
+    不會留下用舊假日表算出的 bitmap。
+    """
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('business_day_bitmaps'))")
+    conds, params = [], []
+    if store_id:
+        conds.append("store_id = %s"); params.append(store_id)
+    if year:
+        conds.append("year = %s"); params.append(year)
+    c.execute("DELETE FROM business_day_bitmaps" + (" WHERE " + " AND ".join(conds) if conds else ""), params)
+
+def _business_calendar(conn, store_id, year, cache=None):
+    """
+    回傳 (prefix, 每日工時)。bitmap 先查 business_day_bitmaps，沒有就由假日表 + 分店排班建好存回；
+    批次比對時傳入同一個 cache dict，每個 (分店, 年) 只讀一次。
+    """
+    key = (store_id or 0, year)
+    if cache is not None and key in cache:
+        return cache[key]
+    with conn.cursor() as c:
+        c.execute("SELECT bitmap, day_hours FROM business_day_bitmaps WHERE store_id=%s AND year=%s", key)
+        row = c.fetchone()
+        if row is None:
+            # 重建前先拿鎖再讀一次：等進行中的異動提交，並讓同時重建的人沿用先建好的版本
+            c.execute("SELECT pg_advisory_xact_lock(hashtext('business_day_bitmaps'))")
+            c.execute("SELECT bitmap, day_hours FROM business_day_bitmaps WHERE store_id=%s AND year=%s", key)
+            row = c.fetchone()
+        if row:
+            bitmap, day_hours = bytes(row[0]), Decimal(row[1])
+        else:
+            workdays, day_hours = WORK_WEEKDAYS, WORK_DAY_HOURS
+            if store_id:
+                c.execute("SELECT workdays, day_hours FROM store_work_schedules WHERE store_id=%s", (store_id,))
+                srow = c.fetchone()
+                if srow:
+                    workdays, day_hours = srow[0], Decimal(srow[1])
+            # 全公司先、分店後：分店自己的設定可覆蓋全公司（例如國定假日照常營業 → 補班）
+            c.execute("""
+                SELECT day, kind FROM work_calendar_days
+                 WHERE day >= %s AND day < %s AND (store_id IS NULL OR store_id = %s)
+                 ORDER BY (store_id IS NOT NULL), day
+            """, (date(year, 1, 1), date(year + 1, 1, 1), store_id or 0))
+            kinds = dict(c.fetchall())
+            bitmap = build_business_day_bitmap(
+                year, workdays,
+                off_dates=[d for d, k in kinds.items() if k != 'workday'],
+                on_dates=[d for d, k in kinds.items() if k == 'workday'])
+            c.execute("""
+                INSERT INTO business_day_bitmaps (store_id, year, bitmap, day_hours)
+                VALUES (%s,%s,%s,%s) ON CONFLICT (store_id, year) DO NOTHING
+            """, (key[0], year, bitmap, day_hours))
+    result = (business_day_prefix(bitmap, year), day_hours)
+    if cache is not None:
+        cache[key] = result
+    return result
+
+def _business_hours(conn, store_id, df, dt, cache=None):
+    """[df, dt] 的（工作日數, 應扣時數）；每年一次前綴和相減，跨年逐年相加。"""
+    df, dt = _ensure_date(df), _ensure_date(dt)
+    days = 0
+    for y in range(df.year, dt.year + 1):
+        prefix, _ = _business_calendar(conn, store_id, y, cache)
+        days += business_days_between(prefix, y, df, dt)
+    _, day_hours = _business_calendar(conn, store_id, df.year, cache)
+    return days, Decimal(days) * day_hours
+
+def _employee_store_id(conn, emp_id):
+    with conn.cursor() as c:
+        c.execute("SELECT store_id FROM employees WHERE id=%s", (emp_id,))
+        row = c.fetchone()
+    if not row:
+        abort(404)
+    return row[0]
+
+def _leave_hours_mismatches(conn, start, end):
+    """
+    比對 [start, end) 起始的核准假單時數與工作日曆：
+      • 時數 > 區間工作時數（多扣，或整段都是假日）
+      • 時數 ≤ 區間工作時數 − 一天（區間內至少一整個工作日沒扣，日期可能填錯）
+    單日/最後一天請半天等部分時數不算不符。
+    """
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT lr.id, lr.employee_id, e.name, e.store_id, lr.leave_type,
+                   lr.date_from, lr.date_to, COALESCE(lr.hours, 0)
+              FROM leave_records lr
+              JOIN employees e ON e.id = lr.employee_id
+             WHERE lr.status='approved' AND COALESCE(lr.deleted,FALSE)=FALSE
+               AND lr.date_from >= %s AND lr.date_from < %s
+             ORDER BY lr.date_from, lr.id
+        """, (start, end))
+        rows = c.fetchall()
+    cache, out = {}, []
+    for rid, emp_id, name, store_id, leave_type, df, dt, hours in rows:
+        if dt < df:
+            continue
+        days, expected = _business_hours(conn, store_id, df, dt, cache)
+        _, day_hours = _business_calendar(conn, store_id, df.year, cache)
+        if hours > expected or hours <= expected - day_hours:
+            out.append({
+                'id': rid, 'employee_id': emp_id, 'name': name, 'leave_type': leave_type,
+                'date_from': df.isoformat(), 'date_to': dt.isoformat(),
+                'hours': float(hours), 'business_days': days, 'expected_hours': float(expected),
+            })
+    return out
+
+@app.get('/api/business-hours')
+def api_business_hours():
+    """GET /api/business-hours?date_from=&date_to=&emp_id=（或 store_id=）→ 工作日數與應扣時數"""
+    init_db()
+    try:
+        df = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d').date()
+        dt = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        abort(400, description='date_from / date_to 格式需為 YYYY-MM-DD')
+    if dt < df:
+        abort(400, description='結束日期不可早於開始日期')
+    with get_conn() as conn:
+        if request.args.get('emp_id', '').isdigit():
+            store_id = _employee_store_id(conn, int(request.args['emp_id']))
+        else:
+            store_id = request.args.get('store_id', type=int)
+        days, hours = _business_hours(conn, store_id, df, dt)
+        _, day_hours = _business_calendar(conn, store_id, df.year)
+    return jsonify({
+        'store_id': store_id, 'date_from': df.isoformat(), 'date_to': dt.isoformat(),
+        'business_days': days, 'hours': float(hours), 'day_hours': float(day_hours),
+    })
+
+@app.get('/work-calendar')
+def work_calendar_page():
+    init_db()
+    year = request.args.get('year', type=int) or date.today().year
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("SELECT id, name FROM stores ORDER BY id")
+        stores = c.fetchall()
+        c.execute("""
+            SELECT w.id, w.day, w.kind, w.name, s.name
+              FROM work_calendar_days w
+              LEFT JOIN stores s ON s.id = w.store_id
+             WHERE w.day >= %s AND w.day < %s
+             ORDER BY w.day, w.store_id NULLS FIRST
+        """, (date(year, 1, 1), date(year + 1, 1, 1)))
+        days = c.fetchall()
+        c.execute("SELECT store_id, workdays, day_hours FROM store_work_schedules")
+        schedules = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+
+    # 假日名稱/分店名稱為自由輸入，組 HTML 前一律跳脫
+    store_opts = "".join(f'<option value="{sid}">{escape(name)}</option>' for sid, name in stores)
+    kind_opts = "".join(f'<option value="{k}">{v}</option>' for k, v in WORK_CALENDAR_KINDS.items())
+    html = [f"<h1>工作日曆 — {year}</h1>", '<a href="/">← 返回</a>',
+            f' ｜ <a href="/work-calendar?year={year-1}">{year-1}</a> <a href="/work-calendar?year={year+1}">{year+1}</a><br><br>']
+    html.append(f"""
+    <form method="post" action="/work-calendar/add" style="margin-bottom:16px">
+      日期：<input type="date" name="day" required>
+      種類：<select name="kind">{kind_opts}</select>
+      名稱：<input name="name" placeholder="例如：中秋節">
+      適用：<select name="store_id"><option value="">全公司</option>{store_opts}</select>
+      <button type="submit">新增</button>
+    </form>
+    """)
+    html.append("<table border=1 cellpadding=6><tr><th>日期</th><th>種類</th><th>名稱</th><th>適用</th><th>操作</th></tr>")
+    for wid, day, kind, name, store_name in days:
+        html.append(f"""
+          <tr>
+            <td>{day.isoformat()}（{'一二三四五六日'[day.weekday()]}）</td>
+            <td>{escape(WORK_CALENDAR_KINDS.get(kind, kind))}</td>
+            <td>{escape(name or '')}</td>
+            <td>{escape(store_name or '全公司')}</td>
+            <td>
+              <form method="post" action="/work-calendar/{wid}/delete" style="display:inline">
+                <button type="submit">刪除</button>
+              </form>
+            </td>
+          </tr>
+        """)
+    html.append("</table>")
+    html.append(f"<h2>分店排班</h2><p>未設定的分店使用公司預設：星期 {WORK_WEEKDAYS}、每日 {WORK_DAY_HOURS} 小時（1=週一 … 7=週日）</p>")
+    html.append("<table border=1 cellpadding=6><tr><th>分店</th><th>上班星期 / 每日工時</th></tr>")
+    for sid, name in stores:
+        wd, hrs = schedules.get(sid, (WORK_WEEKDAYS, WORK_DAY_HOURS))
+        html.append(f"""
+          <tr>
+            <td>{escape(name)}</td>
+            <td>
+              <form method="post" action="/stores/{sid}/schedule" style="display:inline">
+                <input name="workdays" value="{escape(wd)}" size="8" required>
+                <input type="number" name="day_hours" value="{hrs}" step="0.5" min="0.5" max="24" style="width:5rem" required>
+                <button type="submit">儲存</button>
+              </form>
+            </td>
+          </tr>
+        """)
+    html.append("</table>")
+    return "\n".join(html)
+
+def _parse_work_calendar_entry(obj):
+    """表單或 JSON 的一筆 → (day, store_id, kind, name)；格式錯誤丟 ValueError。"""
+    day = datetime.strptime(str(obj.get('day') or ''), '%Y-%m-%d').date()
+    kind = (obj.get('kind') or '').strip()
+    if kind not in WORK_CALENDAR_KINDS:
+        raise ValueError(f'kind 需為 {"/".join(WORK_CALENDAR_KINDS)}')
+    store_id = int(obj['store_id']) if obj.get('store_id') not in (None, '') else None
+    return day, store_id, kind, (obj.get('name') or '').strip() or None
+
+def _upsert_work_calendar_days(conn, entries):
+    with conn.cursor() as c:
+        for day, store_id, kind, name in entries:
+            c.execute("""
+                INSERT INTO work_calendar_days (day, store_id, kind, name)
+                VALUES (%s,%s,%s,%s)
+                ON CONFLICT (day, (COALESCE(store_id, 0))) DO UPDATE SET kind = EXCLUDED.kind, name = EXCLUDED.name
+            """, (day, store_id, kind, name))
+        for store_id, year in {(e[1], e[0].year) for e in entries}:
+            _invalidate_business_days(c, store_id, year)
+    write_audit(conn, 'work_calendar_days', 0, 'upsert', None, {
+        'days': [{'day': d.isoformat(), 'store_id': s, 'kind': k, 'name': n} for d, s, k, n in entries]
+    })
+
+@app.post('/work-calendar/add')
+def work_calendar_add():
+    init_db()
+    try:
+        entry = _parse_work_calendar_entry(request.form)
+    except ValueError as e:
+        abort(400, description=str(e))
+    with get_conn() as conn:
+        _upsert_work_calendar_days(conn, [entry])
+    return redirect(url_for('work_calendar_page', year=entry[0].year))
+
+@app.post('/api/work-calendar')
+def api_work_calendar_import():
+    """批次匯入（例如整年國定假日）：JSON 陣列 [{day, kind, name?, store_id?}, ...]"""
+    init_db()
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, list) or not payload:
+        abort(400, description='需為 JSON 陣列')
+    try:
+        entries = [_parse_work_calendar_entry(o) for o in payload]
+    except (ValueError, TypeError, AttributeError) as e:
+        abort(400, description=str(e))
+    with get_conn() as conn:
+        _upsert_work_calendar_days(conn, entries)
+    return jsonify({'ok': True, 'count': len(entries)})
+
+@app.post('/work-calendar/<int:wid>/delete')
+def work_calendar_delete(wid):
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("DELETE FROM work_calendar_days WHERE id=%s RETURNING day, store_id, kind, name", (wid,))
+        row = c.fetchone()
+        if not row:
+            return abort(404)
+        _invalidate_business_days(c, row[1], row[0].year)
+        write_audit(conn, 'work_calendar_days', wid, 'delete',
+                    {'day': row[0].isoformat(), 'store_id': row[1], 'kind': row[2], 'name': row[3]}, None)
+    return redirect(url_for('work_calendar_page', year=row[0].year))
+
+@app.post('/stores/<int:store_id>/schedule')
+def store_schedule_edit(store_id):
+    init_db()
+    workdays = ''.join(sorted(set(request.form.get('workdays', '').strip())))
+    if not workdays or not set(workdays) <= set('1234567'):
+        abort(400, description='上班星期需為 1~7 的組合，例如 12345')
+    try:
+        day_hours = _parse_half_hour(request.form.get('day_hours'))
+    except ValueError as e:
+        abort(400, description=str(e))
+    if not (0 < day_hours <= 24):
+        abort(400, description='每日工時需介於 0.5 ~ 24')
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("SELECT workdays, day_hours FROM store_work_schedules WHERE store_id=%s", (store_id,))
+        before = c.fetchone()
+        c.execute("""
+            INSERT INTO store_work_schedules (store_id, workdays, day_hours, updated_at)
+            VALUES (%s,%s,%s,NOW())
+            ON CONFLICT (store_id) DO UPDATE
+               SET workdays = EXCLUDED.workdays, day_hours = EXCLUDED.day_hours, updated_at = NOW()
+        """, (store_id, workdays, str(day_hours)))
+        _invalidate_business_days(c, store_id)
+        write_audit(conn, 'store_work_schedules', store_id, 'update',
+                    {'workdays': before[0], 'day_hours': float(before[1])} if before else None,
+                    {'workdays': workdays, 'day_hours': float(day_hours)})
+    return redirect(url_for('work_calendar_page'))
+
+# -------------------------
+# 新增員工（支援調整值 + 分店）
+# -------------------------
+@app.route('/add', methods=['GET','POST'])
+def add_employee():
+    init_db()
+    if request.method == 'POST':
+        name       = request.form['name']
+        start_date = request.form['start_date']
+        end_date_s = request.form.get('end_date') or None
+        dept       = request.form['department']
+        level      = request.form.get('job_level') or ''
+        grade      = request.form['salary_grade']
+        base       = int(request.form.get('base_salary') or 0)
+        allowance  = int(request.form.get('position_allowance') or 0)
+        suspend    = bool(request.form.get('suspend'))
+        store_id_s = request.form.get('store_id')  # 新：分店下拉
+        store_id   = int(store_id_s) if store_id_s else None
+
+        sd_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+        ed_date = datetime.strptime(end_date_s, '%Y-%m-%d').date() if end_date_s else None
+        years, months = calculate_seniority(sd_date)
+
+        entitled_days  = entitled_leave_days(years, months, suspend)
+        entitled_hours = Decimal(str(entitled_days)) * 8
+        used_hours     = _form_used_leave_hours()
+        adj_hours      = _parse_half_hour_any(request.form.get('leave_adjust_hours'))
 
         sick_ent = entitled_sick_days(years, months)
         per_ent  = entitled_personal_days(years, months)
@@ -839,6 +2385,7 @@ def add_employee():
                   %s,0,
                   %s,%s,%s
                 )
+                RETURNING id
             ''', (
                 name, start_date, ed_date,
                 dept, level, grade,
@@ -851,7 +2398,14 @@ def add_employee():
                 mar_ent,
                 is_active, str(adj_hours), store_id
             ))
-            conn.commit()
+            new_id = c.fetchone()[0]
+            _mark_employee_rollups(conn, [new_id], (sd_date, ed_date))
+            _refresh_milestones(conn, [new_id])
+            _sync_leave_ledger(conn, [new_id])  # 新進人員先建帳，不必等每日同步
+            write_audit(conn, 'employees', new_id, 'insert', None, {
+                'name': name, 'start_date': start_date, 'end_date': end_date_s, 'department': dept,
+                'salary_grade': grade, 'base_salary': base, 'position_allowance': allowance, 'store_id': store_id,
+            })
         return redirect(url_for('index'))
     # 分店清單供表單下拉
     with get_conn() as conn, conn.cursor() as c:
@@ -893,6 +2447,13 @@ def edit_employee(emp_id):
         is_active = is_active_by_end_date(ed_date)
 
         with get_conn() as conn, conn.cursor() as c:
+            c.execute('''
+                SELECT name, start_date, end_date, department, job_level, salary_grade,
+                       base_salary, position_allowance, on_leave_suspend, store_id
+                  FROM employees WHERE id=%s
+            ''', (emp_id,))
+            before = c.fetchone()
+            old_pay = before[6:8] if before else None
             c.execute('''
                 UPDATE employees SET
                   name               = %s,
@@ -930,7 +2491,21 @@ def edit_employee(emp_id):
                 store_id,
                 emp_id
             ))
-            conn.commit()
+            # 到職日/留停/調整值可能變動 → 特休帳本整位重算
+            _sync_leave_ledger(conn, [emp_id])
+            if before and (before[1], bool(before[8])) != (sd_date, suspend):
+                _refresh_milestones(conn, [emp_id])
+            # 到職/離職日或分店/部門變動 → 分析彙總重算受影響月份
+            if before and (tuple(before[1:3]) != (sd_date, ed_date) or before[9] != store_id or before[3] != dept):
+                _mark_employee_rollups(conn, [emp_id], (before[1], before[2], sd_date, ed_date),
+                                       with_leaves=(before[9], before[3]) != (store_id, dept))
+            # 月薪變動 → 依現行級距重算保費（鎖定者略過）
+            if old_pay and tuple(old_pay) != (base, allowance):
+                _insurance_recalc(conn, emp_ids=[emp_id], apply=True)
+            fields = ['name', 'start_date', 'end_date', 'department', 'job_level', 'salary_grade',
+                      'base_salary', 'position_allowance', 'on_leave_suspend', 'store_id']
+            write_audit(conn, 'employees', emp_id, 'update', dict(zip(fields, before or ())), dict(zip(fields, (
+                name, sd_date, ed_date, dept, level, grade, base, allowance, suspend, store_id))))
         return redirect(url_for('index'))
 
     with get_conn() as conn, conn.cursor() as c:
@@ -950,6 +2525,404 @@ def edit_employee(emp_id):
         stores = c.fetchall()
     return render_template('edit_employee.html', emp=r, stores=stores)
 
+# -------------------------
+# 批次異動（調店/調部門、調薪、離職）：篩選出的員工一條 UPDATE 改完，同一語句批次寫稽核
+# -------------------------
+BULK_SALARY_FIELDS = ('base_salary', 'position_allowance')
+BULK_CHANGE_ARGS = ('to_store_id', 'to_department', 'base_salary_pct', 'base_salary_add',
+                    'position_allowance_pct', 'position_allowance_add', 'end_date')
+
+def _bulk_employee_args(values):
+    """
+    篩選：ids（逗號分隔）、store_id（0 = 未分店）、department、all=1（含離職/停用）；
+    三項篩選都沒給時，套用需再帶 scope=all 明確確認（見 employees_bulk）。
+    異動：to_store_id（0 = 未分店）、to_department、<底薪/津貼>_pct（%）與 <底薪/津貼>_add（元）、end_date。
+    回傳 (filters, changes)；沒有任何異動 → 400。
+    """
+    filters, changes = {}, {}
+    try:
+        if values.get('ids'):
+            filters['ids'] = sorted({int(x) for x in values['ids'].replace(',', ' ').split()})
+        if values.get('store_id'):
+            filters['store_id'] = int(values['store_id'])
+        if values.get('to_store_id'):
+            changes['store_id'] = int(values['to_store_id']) or None
+        for f in BULK_SALARY_FIELDS:
+            pct, add = values.get(f'{f}_pct'), values.get(f'{f}_add')
+            if pct or add:
+                changes[f] = (Decimal(pct or '0'), int(add or 0))
+        if values.get('end_date'):
+            changes['end_date'] = datetime.strptime(values['end_date'], '%Y-%m-%d').date()
+    except (ValueError, InvalidOperation):
+        abort(400, description='員工 ID、分店、調薪或離職日格式錯誤')
+    if values.get('department'):
+        filters['department'] = values['department'].strip()
+    if values.get('to_department'):
+        changes['department'] = values['to_department'].strip()
+    filters['all'] = values.get('all') == '1'
+    if not changes:
+        abort(400, description='請至少指定一項異動（分店、部門、調薪或離職日）')
+    if any(changes[f][0] <= -100 for f in BULK_SALARY_FIELDS if f in changes):
+        abort(400, description='調薪百分比需大於 -100')
+    return filters, changes
+
+def _bulk_employee_update(conn, filters, changes, apply=False, acted_by=None):
+    """
+    apply=False 回傳會變動的員工與前後值（預覽）；apply=True 以單一語句鎖定、更新並批次寫入 audit_logs
+    （每位一筆，只記變動欄位），回傳 [(id, 原到職日, 原離職日, 新離職日)]。不 commit。
+    """
+    conds, params = [], {'acted_by': acted_by or getattr(g, 'current_user', None)}
+    if not filters.get('all'):
+        conds.append("(e.end_date IS NULL OR e.end_date >= CURRENT_DATE) AND COALESCE(e.is_active, TRUE) = TRUE")
+    if 'ids' in filters:
+        conds.append("e.id = ANY(%(ids)s)")
+        params['ids'] = filters['ids']
+    if 'store_id' in filters:
+        conds.append("COALESCE(e.store_id, 0) = %(store_id)s")
+        params['store_id'] = filters['store_id']
+    if 'department' in filters:
+        conds.append("e.department = %(department)s")
+        params['department'] = filters['department']
+
+    # 欄位 → 新值運算式（沒指定的欄位不動）
+    exprs = {}
+    if 'store_id' in changes:
+        exprs['store_id'] = "%(to_store_id)s::int"
+        params['to_store_id'] = changes['store_id']
+    if 'department' in changes:
+        exprs['department'] = "%(to_department)s::text"
+        params['to_department'] = changes['department']
+    for f in BULK_SALARY_FIELDS:
+        if f in changes:
+            # 原本沒填（NULL）的維持 NULL，不當成 0 調薪
+            exprs[f] = f"CASE WHEN e.{f} IS NULL THEN NULL ELSE (ROUND(e.{f} * (100 + %({f}_pct)s) / 100) + %({f}_add)s)::int END"
+            params[f'{f}_pct'], params[f'{f}_add'] = changes[f]
+    if 'end_date' in changes:
+        exprs['end_date'] = "%(end_date)s::date"
+        exprs['is_active'] = "%(end_date)s::date >= CURRENT_DATE"
+        params['end_date'] = changes['end_date']
+
+    def _obj(vals):
+        return "jsonb_build_object(" + ", ".join(f"'{k}', {v}" for k, v in vals.items()) + ")"
+    base = f"""
+        WITH cur AS (
+          SELECT e.* FROM employees e
+           WHERE {' AND '.join(conds) if conds else 'TRUE'}
+           {'FOR UPDATE' if apply else ''}
+        ),
+        calc AS (
+          SELECT e.id, e.name, e.store_id AS cur_store_id, e.start_date, e.end_date,
+                 {', '.join(f'{v} AS new_{k}' for k, v in exprs.items())},
+                 {_obj({k: f'e.{k}' for k in exprs})} AS old_j,
+                 {_obj(exprs)} AS new_j
+            FROM cur e
+        )
+    """
+    salary = [f for f in BULK_SALARY_FIELDS if f in exprs]
+    if salary:
+        with conn.cursor() as c:
+            c.execute(base + f"""
+                SELECT array_agg(id ORDER BY id) FROM calc WHERE {' OR '.join(f'new_{f} < 0' for f in salary)}
+            """, params)
+            negative = c.fetchone()[0]
+        if negative:
+            abort(400, description='調薪後底薪/職務津貼不可為負數（員工 ID：'
+                                   + ', '.join(map(str, negative[:20])) + ('…' if len(negative) > 20 else '') + '）')
+    if not apply:
+        with conn.cursor(row_factory=dict_row) as c:
+            c.execute(base + """
+                SELECT calc.id, calc.name, s.name AS store_name, calc.old_j AS before, calc.new_j AS after
+                  FROM calc
+                  LEFT JOIN stores s ON s.id = calc.cur_store_id
+                 WHERE calc.old_j IS DISTINCT FROM calc.new_j
+                 ORDER BY calc.id
+            """, params)
+            return c.fetchall()
+    with conn.cursor() as c:
+        c.execute(base + f""",
+            up AS (
+              UPDATE employees t SET {', '.join(f'{k} = calc.new_{k}' for k in exprs)}
+                FROM calc
+               WHERE t.id = calc.id AND calc.old_j IS DISTINCT FROM calc.new_j
+              RETURNING t.id, t.end_date
+            ),
+            audit AS (
+              INSERT INTO audit_logs (table_name, row_id, action, before_json, after_json, acted_by)
+              SELECT 'employees', d.id, 'update',
+                     (SELECT jsonb_object_agg(k, val) FROM jsonb_each(d.old_j) o(k, val) WHERE d.new_j -> k IS DISTINCT FROM val),
+                     (SELECT jsonb_object_agg(k, val) FROM jsonb_each(d.new_j) n(k, val) WHERE d.old_j -> k IS DISTINCT FROM val),
+                     %(acted_by)s
+                FROM up JOIN calc d USING (id)
+              RETURNING row_id
+            )
+            SELECT up.id, calc.start_date, calc.end_date AS old_end, up.end_date AS new_end
+              FROM up JOIN calc USING (id)
+             ORDER BY up.id
+        """, params)
+        return c.fetchall()
+
+def _bulk_employee_apply(conn, filters, changes):
+    """套用批次異動並接上單筆編輯的後續處理（同一交易）；最後的總結稽核一併 commit。回傳更新人數。"""
+    rows = _bulk_employee_update(conn, filters, changes, apply=True)
+    ids = [r[0] for r in rows]
+    if ids:
+        # 離職日影響特休給假期別（給到離職日為止）
+        if 'end_date' in changes:
+            for i in range(0, len(ids), 500):
+                _sync_leave_ledger(conn, ids[i:i + 500])
+        # 分店/部門 → 請假彙總；到職/離職月份 → 人數彙總
+        _mark_employee_rollups(conn, ids, {d for r in rows for d in r[1:]},
+                               with_leaves='store_id' in changes or 'department' in changes)
+        # 月薪變動 → 依現行級距重算保費（鎖定者略過）
+        if any(f in changes for f in BULK_SALARY_FIELDS):
+            _insurance_recalc(conn, emp_ids=ids, apply=True)
+    summary = {k: (list(v) if isinstance(v, tuple) else v) for k, v in changes.items()}
+    write_audit(conn, 'employees', 0, 'bulk_update', None,
+                {'filters': filters, 'changes': summary, 'updated': len(ids)})
+    return len(ids)
+
+@app.route('/employees/bulk', methods=['GET', 'POST'])
+def employees_bulk():
+    """GET：篩選 + 異動預覽（?format=json）；POST：套用（一條語句更新 + 批次稽核，整批同一交易）。"""
+    init_db()
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT id, name FROM stores ORDER BY id")
+            stores = c.fetchall()
+        rows = None
+        if request.method == 'POST' or any(request.args.get(k) for k in BULK_CHANGE_ARGS):
+            filters, changes = _bulk_employee_args(request.values)
+            if changes.get('store_id') and changes['store_id'] not in {s[0] for s in stores}:
+                abort(400, description='目標分店不存在')
+            if request.method == 'POST':
+                # 沒有任何篩選 = 全體在職員工，需明確帶 scope=all 才套用
+                if not any(k in filters for k in ('ids', 'store_id', 'department')) \
+                        and request.values.get('scope') != 'all':
+                    abort(400, description='未指定員工/分店/部門篩選；要套用到全部員工請加上 scope=all')
+                n = _bulk_employee_apply(conn, filters, changes)
+                if request.form.get('format') == 'json':
+                    return jsonify({'updated': n})
+                return redirect(url_for('index'))
+            rows = _bulk_employee_update(conn, filters, changes)
+    if request.args.get('format') == 'json':
+        return jsonify({'count': len(rows or []), 'items': rows or []})
+    return render_template('employees_bulk.html', rows=rows, stores=stores, args=request.args)
+
+# -------------------------
+# 勞健保級距試算（insurance_rate_versions / insurance_brackets → insurances）
+# -------------------------
+# 114 年投保金額分級表（健保全表；勞保/職保/勞退依各自上限截取）
+DEFAULT_INSURED_SALARIES = [
+    28590, 28800, 30300, 31800, 33300, 34800, 36300, 38200, 40100, 42000, 43900, 45800,
+    48200, 50600, 53000, 55400, 57800, 60800, 63800, 66800, 69800, 72800, 76500, 80200,
+    83900, 87600, 92100, 96600, 101100, 105600, 110100, 115500, 120900, 126300, 131700,
+    137100, 142500, 147900, 150000, 156400, 162800, 169200, 175600, 182000, 189500,
+    197000, 204500, 212000, 219500,
+]
+INSURANCE_BRACKET_CAPS = {'labour': 45800, 'occupational': 72800, 'pension': 150000, 'health': 219500}
+INSURANCE_RATE_FIELDS = [
+    'labour_rate', 'labour_employee_share', 'labour_employer_share',
+    'health_rate', 'health_employee_share', 'health_employer_share', 'health_dependents',
+    'occupational_rate', 'pension_rate',
+]
+INSURANCE_AMOUNT_FIELDS = [
+    'personal_labour', 'personal_health', 'company_labour', 'company_health',
+    'retirement6', 'occupational_ins', 'total_company',
+]
+
+def _insurance_diff_sql(emp_filter=""):
+    """
+    一條 SQL 算出所有在職、未鎖定員工的應有保費，與 insurances 現值比對，只留有差異的列。
+    月薪 = 底薪 + 職務津貼，各險別取「投保金額 ≥ 月薪」的最小一級，超過最高級以最高級計。
+    月薪 ≤ 0（尚未填薪資）的員工不套最低級距，略過不算（見 _insurance_missing_wage）。
+    參數：%(as_of)s（取該日生效的費率版本）；emp_filter 需自帶 %(ids)s。
+    """
+    laterals = "\n".join(f"""
+        CROSS JOIN LATERAL (
+          SELECT COALESCE(MIN(b.insured_salary) FILTER (WHERE b.insured_salary >= w.wage), MAX(b.insured_salary), 0) AS amt
+            FROM insurance_brackets b WHERE b.version_id = v.id AND b.kind = '{kind}'
+        ) {kind}""" for kind in INSURANCE_BRACKET_CAPS)
+    return f"""
+      WITH v AS (
+        SELECT * FROM insurance_rate_versions WHERE effective_from <= %(as_of)s
+         ORDER BY effective_from DESC LIMIT 1
+      ),
+      calc AS (
+        SELECT e.id AS employee_id, e.name, w.wage, i.id AS insurance_id,
+               labour.amt AS labour_insured, health.amt AS health_insured,
+               pension.amt AS pension_insured, occupational.amt AS occupational_insured,
+               ROUND(labour.amt * v.labour_rate * v.labour_employee_share)::int                           AS personal_labour,
+               ROUND(health.amt * v.health_rate * v.health_employee_share)::int                           AS personal_health,
+               ROUND(labour.amt * v.labour_rate * v.labour_employer_share)::int                           AS company_labour,
+               ROUND(health.amt * v.health_rate * v.health_employer_share * (1 + v.health_dependents))::int AS company_health,
+               ROUND(pension.amt * v.pension_rate)::int                                                   AS retirement6,
+               ROUND(occupational.amt * v.occupational_rate)::int                                         AS occupational_ins,
+               jsonb_build_object('personal_labour', i.personal_labour, 'personal_health', i.personal_health,
+                                  'company_labour', i.company_labour, 'company_health', i.company_health,
+                                  'retirement6', i.retirement6, 'occupational_ins', i.occupational_ins,
+                                  'total_company', i.total_company) AS old_j
+          FROM employees e
+          CROSS JOIN v
+          LEFT JOIN insurances i ON i.employee_id = e.id
+          CROSS JOIN LATERAL (SELECT COALESCE(e.base_salary, 0) + COALESCE(e.position_allowance, 0) AS wage) w
+          {laterals}
+         WHERE (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+           AND COALESCE(e.is_active, TRUE) = TRUE
+           AND COALESCE(e.on_leave_suspend, FALSE) = FALSE
+           AND COALESCE(i.locked, FALSE) = FALSE
+           AND w.wage > 0
+           {emp_filter}
+      ),
+      diff AS (
+        SELECT calc.*, calc.company_labour + calc.company_health + calc.retirement6 + calc.occupational_ins AS total_company,
+               jsonb_build_object('personal_labour', personal_labour, 'personal_health', personal_health,
+                                  'company_labour', company_labour, 'company_health', company_health,
+                                  'retirement6', retirement6, 'occupational_ins', occupational_ins,
+                                  'total_company', company_labour + company_health + retirement6 + occupational_ins) AS new_j
+          FROM calc
+      )
+    """
+
+def _insurance_missing_wage(conn):
+    """在職、未鎖定但月薪 ≤ 0 的員工 [{employee_id, name}]：重算時略過，需先補薪資。"""
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute("""
+            SELECT e.id AS employee_id, e.name
+              FROM employees e
+              LEFT JOIN insurances i ON i.employee_id = e.id
+             WHERE (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+               AND COALESCE(e.is_active, TRUE) = TRUE
+               AND COALESCE(e.on_leave_suspend, FALSE) = FALSE
+               AND COALESCE(i.locked, FALSE) = FALSE
+               AND COALESCE(e.base_salary, 0) + COALESCE(e.position_allowance, 0) <= 0
+             ORDER BY e.id
+        """)
+        return c.fetchall()
+
+def _insurance_recalc(conn, as_of=None, emp_ids=None, apply=False, acted_by=None):
+    """
+    依費率版本重算 insurances。apply=False 只回傳差異清單（預覽）；
+    apply=True 以單一語句 upsert 差異列並同時批次寫入 audit_logs（每位一筆，只記變動欄位），回傳更新筆數。不 commit。
+    """
+    params = {'as_of': as_of or date.today(), 'ids': list(emp_ids or []),
+              'acted_by': acted_by or getattr(g, 'current_user', None)}
+    base = _insurance_diff_sql("AND e.id = ANY(%(ids)s)" if emp_ids is not None else "")
+    cols = ', '.join(INSURANCE_AMOUNT_FIELDS)
+    with conn.cursor(row_factory=dict_row) as c:
+        if not apply:
+            c.execute(base + f"""
+                SELECT employee_id, name, wage, labour_insured, health_insured, pension_insured, occupational_insured,
+                       old_j AS before, new_j AS after, insurance_id IS NULL AS is_new
+                  FROM diff WHERE old_j IS DISTINCT FROM new_j ORDER BY employee_id
+            """, params)
+            return c.fetchall()
+        c.execute(base + f""",
+            up AS (
+              INSERT INTO insurances (employee_id, {cols})
+              SELECT employee_id, {cols} FROM diff WHERE old_j IS DISTINCT FROM new_j
+              ON CONFLICT (employee_id) DO UPDATE SET
+                {', '.join(f'{f} = EXCLUDED.{f}' for f in INSURANCE_AMOUNT_FIELDS)}
+              RETURNING id, employee_id
+            ),
+            audit AS (
+              INSERT INTO audit_logs (table_name, row_id, action, before_json, after_json, acted_by)
+              SELECT 'insurances', up.id, 'recalc',
+                     CASE WHEN d.insurance_id IS NULL THEN '{{}}'::jsonb ELSE
+                       (SELECT jsonb_object_agg(k, val) FROM jsonb_each(d.old_j) o(k, val) WHERE d.new_j -> k IS DISTINCT FROM val) END,
+                     CASE WHEN d.insurance_id IS NULL THEN d.new_j ELSE
+                       (SELECT jsonb_object_agg(k, val) FROM jsonb_each(d.new_j) n(k, val) WHERE d.old_j -> k IS DISTINCT FROM val) END,
+                     %(acted_by)s
+                FROM up JOIN diff d USING (employee_id)
+              RETURNING 1
+            )
+            SELECT COUNT(*) AS n FROM audit
+        """, params)
+        return c.fetchone()['n']
+
+def _insurance_versions(conn):
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute("""
+            SELECT v.*,
+                   (SELECT jsonb_object_agg(kind, amts) FROM (
+                      SELECT kind, array_agg(insured_salary ORDER BY insured_salary) AS amts
+                        FROM insurance_brackets b WHERE b.version_id = v.id GROUP BY kind) k) AS brackets
+              FROM insurance_rate_versions v
+             ORDER BY effective_from DESC
+        """)
+        return c.fetchall()
+
+def _parse_brackets(text):
+    """表單級距：以逗號/空白分隔的投保金額，回傳排序後的整數清單。"""
+    try:
+        amts = sorted({int(x) for x in text.replace(',', ' ').split()})
+    except ValueError:
+        abort(400, description='級距需為整數金額，以逗號或空白分隔')
+    if any(a <= 0 for a in amts):
+        abort(400, description='投保金額需大於 0')
+    return amts
+
+@app.route('/insurance/rates', methods=['GET', 'POST'])
+def insurance_rates():
+    """費率版本：新增一版（級距留白沿用上一版），既有版本不可改，改費率請新增生效日。"""
+    init_db()
+    with get_conn() as conn:
+        if request.method == 'POST':
+            try:
+                eff = datetime.strptime(request.form.get('effective_from', ''), '%Y-%m-%d').date()
+                rates = [Decimal(request.form[f]) for f in INSURANCE_RATE_FIELDS]
+            except (KeyError, ValueError, InvalidOperation):
+                abort(400, description='生效日或費率格式錯誤')
+            if any(r < 0 for r in rates):
+                abort(400, description='費率不可為負數')
+            versions = _insurance_versions(conn)
+            if any(v['effective_from'] == eff for v in versions):
+                abort(400, description=f'{eff} 已有費率版本')
+            prev = next((v for v in versions if v['effective_from'] < eff), versions[-1] if versions else None)
+            brackets = {}
+            for kind in INSURANCE_BRACKET_CAPS:
+                amts = _parse_brackets(request.form.get(f'brackets_{kind}', ''))
+                if not amts:
+                    amts = (prev['brackets'] or {}).get(kind, []) if prev else []
+                if not amts:
+                    abort(400, description=f'{kind} 級距不可為空')
+                brackets[kind] = amts
+            with conn.cursor() as c:
+                c.execute(f"""
+                    INSERT INTO insurance_rate_versions (effective_from, {', '.join(INSURANCE_RATE_FIELDS)}, note)
+                    VALUES (%s, {', '.join(['%s'] * len(INSURANCE_RATE_FIELDS))}, %s) RETURNING id
+                """, [eff] + rates + [request.form.get('note', '')])
+                vid = c.fetchone()[0]
+                c.executemany("INSERT INTO insurance_brackets (version_id, kind, insured_salary) VALUES (%s,%s,%s)",
+                              [(vid, kind, a) for kind, amts in brackets.items() for a in amts])
+            write_audit(conn, 'insurance_rate_versions', vid, 'insert', None,
+                        dict(zip(INSURANCE_RATE_FIELDS, map(str, rates)), effective_from=eff.isoformat()))
+            return redirect(url_for('insurance_recalc', as_of=eff.isoformat()))
+        versions = _insurance_versions(conn)
+    return render_template('insurance_rates.html', versions=versions,
+                           rate_fields=INSURANCE_RATE_FIELDS, bracket_kinds=list(INSURANCE_BRACKET_CAPS))
+
+@app.route('/insurance/recalc', methods=['GET', 'POST'])
+def insurance_recalc():
+    """GET：差異預覽（?format=json）；POST：套用（一條語句更新 + 批次稽核）。"""
+    init_db()
+    try:
+        v = request.values.get('as_of')
+        as_of = datetime.strptime(v, '%Y-%m-%d').date() if v else date.today()
+    except ValueError:
+        abort(400, description='as_of 格式需為 YYYY-MM-DD')
+    with get_conn() as conn:
+        if request.method == 'POST':
+            n = _insurance_recalc(conn, as_of=as_of, apply=True)
+            conn.commit()
+            write_audit(conn, 'insurances', 0, 'recalc', None, {'as_of': as_of.isoformat(), 'updated': n})
+            return redirect(url_for('list_insurance'))
+        rows = _insurance_recalc(conn, as_of=as_of)
+        skipped = _insurance_missing_wage(conn)
+    if request.args.get('format') == 'json':
+        return jsonify({'as_of': as_of.isoformat(), 'count': len(rows), 'items': rows, 'skipped_no_wage': skipped})
+    return render_template('insurance_recalc.html', rows=rows, as_of=as_of, fields=INSURANCE_AMOUNT_FIELDS,
+                           skipped=skipped)
+
 # -------------------------
 # 保險列表（預設只顯示在職）
 # -------------------------
@@ -1002,10 +2975,14 @@ def edit_insurance(emp_id):
             oi  = int(request.form.get('occupational_ins')  or 0)
             tot = int(request.form.get('total_company')     or 0)
             note= request.form.get('note','')
+            locked = bool(request.form.get('locked'))
 
+            fields = ['personal_labour', 'personal_health', 'company_labour', 'company_health',
+                      'retirement6', 'occupational_ins', 'total_company', 'note', 'locked']
             with conn.cursor() as c:
-                c.execute('SELECT id FROM insurances WHERE employee_id=%s', (emp_id,))
-                if c.fetchone():
+                c.execute(f"SELECT id, {', '.join(fields)} FROM insurances WHERE employee_id=%s", (emp_id,))
+                existing = c.fetchone()
+                if existing:
                     c.execute('''
                         UPDATE insurances SET
                           personal_labour  = %s,
@@ -1015,9 +2992,10 @@ def edit_insurance(emp_id):
                           retirement6      = %s,
                           occupational_ins = %s,
                           total_company    = %s,
-                          note             = %s
+                          note             = %s,
+                          locked           = %s
                         WHERE employee_id = %s
-                    ''', (pl, ph, cl, ch, r6, oi, tot, note, emp_id))
+                    ''', (pl, ph, cl, ch, r6, oi, tot, note, locked, emp_id))
                 else:
                     c.execute('''
                         INSERT INTO insurances (
@@ -1025,62 +3003,246 @@ def edit_insurance(emp_id):
                           personal_labour, personal_health,
                           company_labour,  company_health,
                           retirement6,     occupational_ins,
-                          total_company,   note
-                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    ''', (emp_id, pl, ph, cl, ch, r6, oi, tot, note))
-                conn.commit()
+                          total_company,   note, locked
+                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                    ''', (emp_id, pl, ph, cl, ch, r6, oi, tot, note, locked))
+                c.execute('SELECT id FROM insurances WHERE employee_id=%s', (emp_id,))
+                ins_id = c.fetchone()[0]
+            write_audit(conn, 'insurances', ins_id, 'update' if existing else 'insert',
+                        dict(zip(fields, existing[1:])) if existing else None,
+                        dict(zip(fields, (pl, ph, cl, ch, r6, oi, tot, note, locked))))
         with conn.cursor() as c:
             c.execute('''
                 SELECT id, employee_id,
                        personal_labour, personal_health,
                        company_labour, company_health,
                        retirement6, occupational_ins,
-                       total_company, note
+                       total_company, note, locked
                   FROM insurances
                  WHERE employee_id=%s
             ''', (emp_id,))
-            r = c.fetchone() or [None, emp_id, 0, 0, 0, 0, 0, 0, 0, '']
+            r = c.fetchone() or [None, emp_id, 0, 0, 0, 0, 0, 0, 0, '', False]
 
     return render_template('edit_insurance.html', emp_id=emp_id, ins=r)
 
 # -------------------------
 # 請假紀錄（小時制 + 審核）
 # -------------------------
+def _form_leave_hours(conn, emp_id, df, dt) -> Decimal:
+    """請假表單時數；填天數時依員工分店的每日工時換算，未填時依分店工作日曆推算區間工時。"""
+    store_id = _employee_store_id(conn, emp_id)
+    def from_calendar():
+        try:
+            days, hours = _business_hours(conn, store_id, df, dt)
+        except ValueError:
+            abort(400, description='日期格式錯誤')
+        if hours <= 0:
+            abort(400, description='區間內沒有工作日，請手動輸入時數')
+        return hours
+    def day_hours():
+        try:
+            return _business_calendar(conn, store_id, _ensure_date(df).year)[1]
+        except ValueError:
+            abort(400, description='日期格式錯誤')
+    try:
+        return _form_hours_or_days('hours', 'days', default=from_calendar, day_hours=day_hours)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+def _find_overlapping_leaves(conn, emp_id, df, dt, exclude_id=None):
+    """同員工、日期區間重疊的核准假單（走 leave_records_overlap_idx）。"""
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT id, leave_type, date_from, date_to, COALESCE(hours, 0)
+              FROM leave_records
+             WHERE employee_id = %s
+               AND status='approved' AND COALESCE(deleted,FALSE)=FALSE
+               AND daterange(date_from, date_to, '[]') && daterange(%s::date, %s::date, '[]')
+               AND id <> %s
+             ORDER BY date_from, id
+             LIMIT 20
+        """, (emp_id, df, dt, exclude_id or 0))
+        return c.fetchall()
+
+def _is_partial_day(df, dt, hours, day_hours=WORK_DAY_HOURS) -> bool:
+    """單日且時數不滿一天（day_hours：員工所屬分店的每日工時）。"""
+    return _ensure_date(df) == _ensure_date(dt) and Decimal(str(hours)) < Decimal(str(day_hours))
+
+def _employee_day_hours(conn, emp_id, d, cache=None):
+    """員工所屬分店在 d 那年的每日工時（分店排班 / WORK_DAY_HOURS）。"""
+    with conn.cursor() as c:
+        c.execute("SELECT store_id FROM employees WHERE id=%s", (emp_id,))
+        row = c.fetchone()
+    return _business_calendar(conn, row[0] if row else None, _ensure_date(d).year, cache)[1]
+
+def _check_leave_overlap(conn, emp_id, df, dt, hours, exclude_id=None):
+    """
+    依 LEAVE_OVERLAP_POLICY 檢查重疊；回傳 (是否允許, 重疊的假單)。
+    同一交易內先取 advisory lock，避免同員工兩筆同時送出都通過檢查。
+    """
+    if _ensure_date(dt) < _ensure_date(df):
+        abort(400, description='結束日期不可早於開始日期')
+    with conn.cursor() as c:
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('leave_overlap'), %s)", (emp_id,))
+    conflicts = _find_overlapping_leaves(conn, emp_id, df, dt, exclude_id)
+    if not conflicts or LEAVE_OVERLAP_POLICY == 'warn':
+        return True, conflicts
+    if LEAVE_OVERLAP_POLICY == 'allow_partial':
+        day_hours = Decimal(str(_employee_day_hours(conn, emp_id, df)))
+        total = Decimal(str(hours)) + sum(Decimal(str(r[4])) for r in conflicts)
+        if (_is_partial_day(df, dt, hours, day_hours)
+                and all(_is_partial_day(r[2], r[3], r[4], day_hours) for r in conflicts)
+                and total <= day_hours):
+            return True, conflicts
+    return False, conflicts
+
+def _overlap_message(conflicts) -> str:
+    items = '、'.join(f"#{r[0]} {r[1]} {r[2]}~{r[3]}（{float(r[4])}h）" for r in conflicts)
+    return f"與既有核准假單重疊：{items}"
+
+LEAVE_STATUSES = ('pending', 'approved', 'rejected', 'canceled')
+LEAVE_STATUS_LABELS = {'pending': '待審核', 'approved': '核准', 'rejected': '退回', 'canceled': '作廢'}
+
+def _query_leave_history(conn, emp_id, leave_type, args):
+    """
+    請假紀錄查詢（頁面與 JSON 共用）：
+      date_from/date_to：以請假起日篩選（可讓分區表只掃相關年度）
+      status：可多選（status=approved&status=pending 或逗號分隔），預設全部
+      include_deleted=1：連同軟刪紀錄
+      cursor=YYYY-MM-DD_id：keyset 分頁，依 (date_from, id) 由新到舊
+      period=year|month：小計的期間粒度
+    小計於 SQL 依篩選條件彙總（不受分頁影響）。
+    """
+    try:
+        page_size = max(min(int(args.get('page_size', '50')), 200), 10)
+        d_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') else None
+        d_to   = datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else None
+        cursor = None
+        if args.get('cursor'):
+            cd, cid = args['cursor'].split('_', 1)
+            cursor = (datetime.strptime(cd, '%Y-%m-%d').date(), int(cid))
+    except (ValueError, KeyError):
+        abort(400, description='參數格式錯誤')
+    statuses = [s for v in args.getlist('status') for s in v.split(',') if s in LEAVE_STATUSES]
+    include_deleted = args.get('include_deleted') == '1'
+    period = 'month' if args.get('period') == 'month' else 'year'
+
+    where = ["employee_id = %s", "leave_type = %s"]
+    params = [emp_id, leave_type]
+    if d_from:
+        where.append("date_from >= %s"); params.append(d_from)
+    if d_to:
+        where.append("date_from <= %s"); params.append(d_to)
+    if statuses:
+        where.append("COALESCE(status, 'approved') = ANY(%s)"); params.append(statuses)
+    if not include_deleted:
+        where.append("COALESCE(deleted, FALSE) = FALSE")
+    where_sql = " AND ".join(where)
+    page_where, page_params = where_sql, list(params)
+    if cursor:
+        page_where += " AND (date_from, id) < (%s, %s)"
+        page_params.extend(cursor)
+
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute(f"""
+            SELECT id,
+                   to_char(date_from, 'YYYY-MM-DD') AS start_date,
+                   to_char(date_to,   'YYYY-MM-DD') AS end_date,
+                   COALESCE(hours, 0)::float8       AS hours,
+                   COALESCE(days, 0)                AS days,
+                   COALESCE(note, '')               AS note,
+                   to_char(created_at, 'YYYY-MM-DD HH24:MI') AS created_at,
+                   COALESCE(status, 'approved')     AS status,
+                   COALESCE(created_by, '')         AS created_by,
+                   COALESCE(approved_by, '')        AS approved_by,
+                   CASE WHEN approved_by IS NOT NULL
+                        THEN to_char(approved_at, 'YYYY-MM-DD HH24:MI') ELSE '' END AS approved_at,
+                   COALESCE(deleted, FALSE)         AS deleted,
+                   date_from
+              FROM leave_records
+             WHERE {page_where}
+             ORDER BY date_from DESC, id DESC
+             LIMIT %s
+        """, tuple(page_params) + (page_size + 1,))
+        records = c.fetchall()
+        fmt = 'YYYY-MM' if period == 'month' else 'YYYY'
+        c.execute(f"""
+            SELECT to_char(date_trunc('{period}', date_from), '{fmt}') AS period,
+                   COALESCE(status, 'approved') AS status,
+                   COUNT(*) AS count,
+                   COALESCE(SUM(hours), 0)::float8 AS hours
+              FROM leave_records
+             WHERE {where_sql}
+             GROUP BY 1, 2
+             ORDER BY 1 DESC, 2
+        """, tuple(params))
+        subtotals = c.fetchall()
+
+    next_cursor = None
+    if len(records) > page_size:
+        records = records[:page_size]
+        last = records[-1]
+        next_cursor = f"{last['date_from'].isoformat()}_{last['id']}"
+    for r in records:
+        del r['date_from']
+    return {
+        'filters': {
+            'date_from': d_from.isoformat() if d_from else '',
+            'date_to': d_to.isoformat() if d_to else '',
+            'status': statuses,
+            'include_deleted': include_deleted,
+            'period': period,
+            'page_size': page_size,
+        },
+        'records': records,
+        'next_cursor': next_cursor,
+        'subtotals': subtotals,
+    }
+
 @app.route('/history/<int:emp_id>/<leave_type>')
 def leave_history(emp_id, leave_type):
     init_db()
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute('SELECT name FROM employees WHERE id=%s', (emp_id,))
-        name = c.fetchone()[0]
-        c.execute('''
-            SELECT id, date_from, date_to, hours, days, note, created_at, status, created_by, approved_by, approved_at
-              FROM leave_records
-             WHERE employee_id=%s AND leave_type=%s
-             ORDER BY date_from DESC
-        ''', (emp_id, leave_type))
-        rows = c.fetchall()
-
-    records = []
-    for rid, df, dt, hours, days, note, created, status, created_by, approved_by, approved_at in rows:
-        records.append(SimpleNamespace(
-            id=rid,
-            start_date = df.strftime('%Y-%m-%d'),
-            end_date   = dt.strftime('%Y-%m-%d'),
-            hours      = float(hours or 0),
-            days       = int(days or 0),
-            note       = note or '',
-            created_at = created.strftime('%Y-%m-%d %H:%M'),
-            status     = status or 'approved',
-            created_by = created_by or '',
-            approved_by= approved_by or '',
-            approved_at= approved_at.strftime('%Y-%m-%d %H:%M') if approved_by else ''
-        ))
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute('SELECT name FROM employees WHERE id=%s', (emp_id,))
+            row = c.fetchone()
+        if not row:
+            return abort(404)
+        result = _query_leave_history(conn, emp_id, leave_type, request.args)
 
     return render_template('history.html',
                            emp_id=emp_id,
-                           name=name,
+                           name=row[0],
                            leave_type=leave_type,
-                           records=records)
+                           records=result['records'],
+                           filters=result['filters'],
+                           subtotals=result['subtotals'],
+                           next_cursor=result['next_cursor'],
+                           is_first_page=not request.args.get('cursor'),
+                           statuses=LEAVE_STATUSES,
+                           status_labels=LEAVE_STATUS_LABELS)
+
+@app.get('/api/history/<int:emp_id>/<leave_type>')
+def api_leave_history(emp_id, leave_type):
+    """請假紀錄 JSON（參數同 /history 頁面）。"""
+    init_db()
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute('SELECT name FROM employees WHERE id=%s', (emp_id,))
+            row = c.fetchone()
+        if not row:
+            return abort(404)
+        result = _query_leave_history(conn, emp_id, leave_type, request.args)
+    return jsonify({
+        'employee_id': emp_id,
+        'name': row[0],
+        'leave_type': leave_type,
+        'filters': result['filters'],
+        'count': len(result['records']),
+        'items': result['records'],
+        'next_cursor': result['next_cursor'],
+        'subtotals': result['subtotals'],
+    })
 
 @app.route('/history/<int:emp_id>/<leave_type>/add', methods=['GET','POST'])
 def add_leave_record(emp_id, leave_type):
@@ -1089,10 +3251,14 @@ def add_leave_record(emp_id, leave_type):
         df   = request.form['start_date']
         dt   = request.form['end_date']
         note = request.form.get('note','')
-        hours = _form_hours_or_days('hours', 'days')
-        days_int = int(hours // 8)
 
         with get_conn() as conn, conn.cursor() as c:
+            hours = _form_leave_hours(conn, emp_id, df, dt)
+            days_int = int(hours // 8)
+            _ensure_leave_partition_for(conn, df)
+            allowed, conflicts = _check_leave_overlap(conn, emp_id, df, dt, hours)
+            if not allowed:
+                return abort(400, description=_overlap_message(conflicts))
             c.execute('''
                 INSERT INTO leave_records
                   (employee_id, leave_type, date_from, date_to, hours, days, note, status, created_by, approved_by, approved_at)
@@ -1101,12 +3267,13 @@ def add_leave_record(emp_id, leave_type):
             ''', (emp_id, leave_type, df, dt, str(hours), days_int, note,
                   getattr(g,'current_user', None), getattr(g,'current_user', None)))
             rid = c.fetchone()[0]
-            conn.commit()
+            _after_leave_write(conn, emp_id, leave_type, df)
             write_audit(conn, 'leave_records', rid, 'insert', None, {
                 'employee_id': emp_id, 'leave_type': leave_type,
                 'hours': float(hours), 'note': note, 'status':'approved'
             })
-        return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
+        return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type,
+                                overlap=','.join(str(r[0]) for r in conflicts) or None))
 
     return render_template('add_leave.html', emp_id=emp_id, leave_type=leave_type)
 
@@ -1118,12 +3285,16 @@ def edit_leave_record(emp_id, leave_type, record_id):
         df   = request.form['start_date']
         dt   = request.form['end_date']
         note = request.form.get('note','')
-        hours = _form_hours_or_days('hours', 'days')
-        days_int = int(hours // 8)
 
         with get_conn() as conn, conn.cursor() as c:
+            hours = _form_leave_hours(conn, emp_id, df, dt)
+            days_int = int(hours // 8)
             c.execute('SELECT date_from, date_to, hours, days, note, status FROM leave_records WHERE id=%s', (record_id,))
             bdf, bdt, bhrs, bdays, bnote, bstatus = c.fetchone()
+            _ensure_leave_partition_for(conn, df)
+            allowed, conflicts = _check_leave_overlap(conn, emp_id, df, dt, hours, exclude_id=record_id)
+            if not allowed:
+                return abort(400, description=_overlap_message(conflicts))
 
             c.execute('''
                 UPDATE leave_records
@@ -1137,7 +3308,7 @@ def edit_leave_record(emp_id, leave_type, record_id):
                        approved_at = NOW()
                  WHERE id = %s
             ''', (df, dt, str(hours), days_int, note, getattr(g,'current_user', None), record_id))
-            conn.commit()
+            _after_leave_write(conn, emp_id, leave_type, min(bdf, _ensure_date(df)), dates=(bdf, _ensure_date(df)))
             write_audit(conn, 'leave_records', record_id, 'update', {
                 'date_from': bdf.strftime('%Y-%m-%d'), 'date_to': bdt.strftime('%Y-%m-%d'),
                 'hours': float(bhrs or 0), 'days': int(bdays or 0),
@@ -1146,7 +3317,8 @@ def edit_leave_record(emp_id, leave_type, record_id):
                 'date_from': df, 'date_to': dt, 'hours': float(hours),
                 'days': days_int, 'note': note, 'status': 'approved'
             })
-        return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
+        return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type,
+                                overlap=','.join(str(r[0]) for r in conflicts) or None))
 
     with get_conn() as conn, conn.cursor() as c:
         c.execute('''
@@ -1179,17 +3351,20 @@ def edit_leave_record(emp_id, leave_type, record_id):
 def approve_leave(emp_id, leave_type, record_id):
     init_db()
     with get_conn() as conn, conn.cursor() as c:
-        c.execute('SELECT status FROM leave_records WHERE id=%s', (record_id,))
+        c.execute('SELECT status, date_from, date_to, hours FROM leave_records WHERE id=%s', (record_id,))
         row = c.fetchone()
         if not row:
             return abort(404)
         before = {'status': row[0]}
+        allowed, conflicts = _check_leave_overlap(conn, emp_id, row[1], row[2], row[3] or 0, exclude_id=record_id)
+        if not allowed:
+            return abort(400, description=_overlap_message(conflicts))
         c.execute("""
           UPDATE leave_records
              SET status='approved', approved_by=%s, approved_at=NOW()
            WHERE id=%s
         """, (getattr(g,'current_user', None), record_id))
-        conn.commit()
+        _after_leave_write(conn, emp_id, leave_type, row[1])
         write_audit(conn, 'leave_records', record_id, 'approve', before, {'status':'approved'})
     return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
 
@@ -1198,7 +3373,7 @@ def approve_leave(emp_id, leave_type, record_id):
 def reject_leave(emp_id, leave_type, record_id):
     init_db()
     with get_conn() as conn, conn.cursor() as c:
-        c.execute('SELECT status FROM leave_records WHERE id=%s', (record_id,))
+        c.execute('SELECT status, date_from FROM leave_records WHERE id=%s', (record_id,))
         row = c.fetchone()
         if not row:
             return abort(404)
@@ -1208,7 +3383,7 @@ def reject_leave(emp_id, leave_type, record_id):
              SET status='rejected', approved_by=%s, approved_at=NOW()
            WHERE id=%s
         """, (getattr(g,'current_user', None), record_id))
-        conn.commit()
+        _after_leave_write(conn, emp_id, leave_type, row[1])
         write_audit(conn, 'leave_records', record_id, 'reject', before, {'status':'rejected'})
     return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
 
@@ -1218,7 +3393,7 @@ def cancel_leave_record(emp_id, leave_type, record_id):
     """作廢：僅更新 status=canceled，不列入特休扣抵"""
     init_db()
     with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT status, deleted FROM leave_records WHERE id=%s", (record_id,))
+        c.execute("SELECT status, deleted, date_from FROM leave_records WHERE id=%s", (record_id,))
         row = c.fetchone()
         if not row:
             return abort(404)
@@ -1230,7 +3405,7 @@ def cancel_leave_record(emp_id, leave_type, record_id):
                  approved_at=NOW()
            WHERE id=%s
         """, (getattr(g,'current_user', None), record_id))
-        conn.commit()
+        _after_leave_write(conn, emp_id, leave_type, row[2])
         write_audit(conn, 'leave_records', record_id, 'cancel', before, {'status': 'canceled'})
     return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
 
@@ -1240,7 +3415,7 @@ def delete_leave_record(emp_id, leave_type, record_id):
     """刪除（軟刪）：deleted=true，不列入任何計算"""
     init_db()
     with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT status, deleted FROM leave_records WHERE id=%s", (record_id,))
+        c.execute("SELECT status, deleted, date_from FROM leave_records WHERE id=%s", (record_id,))
         row = c.fetchone()
         if not row:
             return abort(404)
@@ -1251,48 +3426,1028 @@ def delete_leave_record(emp_id, leave_type, record_id):
                  deleted_at=NOW()
            WHERE id=%s
         """, (record_id,))
-        conn.commit()
+        _after_leave_write(conn, emp_id, leave_type, row[2])
         write_audit(conn, 'leave_records', record_id, 'delete', before, {'deleted': True})
     return redirect(url_for('leave_history', emp_id=emp_id, leave_type=leave_type))
 
 
-# -------------------------
-# 薪資/保險明細
-# -------------------------
-@app.route('/salary/<int:emp_id>')
-def salary_detail(emp_id):
+@app.get('/api/leave-overlaps')
+def api_leave_overlaps():
+    """
+    全公司核准假單重疊稽核：GET /api/leave-overlaps?date_from=&date_to=&store_id=&limit=
+    每筆 a 以 GiST 索引找出同員工、區間相交且 id 較大的 b（O(n log n)，不在 Python 逐筆比對）。
+    allowed 表示依目前 LEAVE_OVERLAP_POLICY 這組重疊是否可接受。
+    """
     init_db()
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute('SELECT name, salary_grade FROM employees WHERE id=%s', (emp_id,))
-        row = c.fetchone()
-        if not row:
-            return abort(404)
-        name, grade = row
+    args = request.args
+    try:
+        limit = max(min(int(args.get('limit', '1000')), 10000), 1)
+        d_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') else None
+        d_to   = datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else None
+        store_id = int(args['store_id']) if args.get('store_id') else None
+    except (ValueError, KeyError):
+        return abort(400, description='參數格式錯誤')
+
+    where, params = [], []
+    if d_from:
+        where.append("a.date_to >= %s"); params.append(d_from)
+    if d_to:
+        where.append("a.date_from <= %s"); params.append(d_to)
+    if store_id:
+        where.append("e.store_id = %s"); params.append(store_id)
+    extra = ("AND " + " AND ".join(where)) if where else ""
 
     with get_conn() as conn, conn.cursor() as c:
-        c.execute('''
-            SELECT personal_labour, personal_health,
-                   company_labour, company_health,
-                   retirement6, occupational_ins, total_company, note
-              FROM insurances
-             WHERE employee_id = %s
-        ''', (emp_id,))
-        ins = c.fetchone() or (0,0,0,0,0,0,0,'')
-        (pl, ph, cl, ch, ret6, oi, total, note) = ins
+        c.execute(f"""
+            SELECT a.employee_id, e.name, e.store_id,
+                   a.id, a.leave_type, a.date_from, a.date_to, COALESCE(a.hours, 0),
+                   b.id, b.leave_type, b.date_from, b.date_to, COALESCE(b.hours, 0)
+              FROM leave_records a
+              JOIN employees e ON e.id = a.employee_id
+              JOIN leave_records b
+                ON b.employee_id = a.employee_id
+               AND b.status='approved' AND COALESCE(b.deleted,FALSE)=FALSE
+               AND daterange(b.date_from, b.date_to, '[]') && daterange(a.date_from, a.date_to, '[]')
+               AND b.id > a.id
+             WHERE a.status='approved' AND COALESCE(a.deleted,FALSE)=FALSE
+                   {extra}
+             ORDER BY a.employee_id, a.date_from, a.id, b.id
+             LIMIT %s
+        """, tuple(params) + (limit,))
+        rows = c.fetchall()
 
-    return render_template('salary_detail.html',
-                           emp_id=emp_id,
-                           name=name,
-                           grade=grade,
-                           personal_labour=pl,
-                           personal_health=ph,
-                           company_labour=cl,
-                           company_health=ch,
+        # 「不滿一天」依員工所屬分店的每日工時；同一 (分店, 年) 只讀一次
+        cache, items = {}, []
+        for (eid, name, store_id, aid, at, adf, adt, ah, bid, bt, bdf, bdt, bh) in rows:
+            day_hours = Decimal(str(_business_calendar(conn, store_id, adf.year, cache)[1]))
+            partial_ok = (_is_partial_day(adf, adt, ah, day_hours) and _is_partial_day(bdf, bdt, bh, day_hours)
+                          and Decimal(str(ah)) + Decimal(str(bh)) <= day_hours)
+            items.append({
+                'employee_id': eid, 'name': name,
+                'a': {'id': aid, 'leave_type': at, 'date_from': adf.isoformat(), 'date_to': adt.isoformat(), 'hours': float(ah)},
+                'b': {'id': bid, 'leave_type': bt, 'date_from': bdf.isoformat(), 'date_to': bdt.isoformat(), 'hours': float(bh)},
+                'allowed': LEAVE_OVERLAP_POLICY == 'warn' or (LEAVE_OVERLAP_POLICY == 'allow_partial' and partial_ok),
+            })
+    return jsonify({'policy': LEAVE_OVERLAP_POLICY, 'count': len(items), 'items': items})
+
+# -------------------------
+# 特休制度試算（不切換 LEAVE_POLICY，先比較各種設定對全體的影響）
+# -------------------------
+def _parse_policy_scenario(text):
+    """'calendar' / 'anniversary' / 'anniversary:12' → (policy, 遞延月數)"""
+    policy, _, months = (text or '').strip().partition(':')
+    if policy not in ('calendar', 'anniversary'):
+        raise ValueError(f'未知制度：{policy}')
+    return policy, int(months or 0) if policy == 'anniversary' else 0
+
+def _policy_label(scenario):
+    policy, months = scenario
+    return 'calendar' if policy == 'calendar' else f'anniversary:{months}'
+
+def _simulate_leave_policies(conn, scenarios, as_of=None, window_days=365):
+    """
+    以特休帳本的實際期別（含調整值、留停不新增期別）與所有核准特休，
+    在每個制度設定下重算到期日並重跑 FIFO 扣抵。一次撈齊全體資料，逐人在記憶體中計算，不寫入。
+    回傳 (各制度合計, 每人明細)；第一個制度為比較基準，明細帶各制度與基準的差額。
+    """
+    as_of = as_of or date.today()
+    window_end = as_of + timedelta(days=window_days)
+    labels = [_policy_label(s) for s in scenarios]
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT e.id, e.name, e.store_id, COALESCE(e.base_salary, 0), COALESCE(e.position_allowance, 0)
+              FROM employees e
+             WHERE e.start_date <= %s AND (e.end_date IS NULL OR e.end_date >= %s)
+             ORDER BY e.id
+        """, (as_of, as_of))
+        emps = c.fetchall()
+        c.execute("""
+            SELECT employee_id, grant_date, granted_hours + adjust_hours
+              FROM leave_grants ORDER BY employee_id, grant_date
+        """)
+        grants = {}
+        for emp_id, gd, hours in c.fetchall():
+            grants.setdefault(emp_id, []).append((gd, float(hours)))
+        c.execute("""
+            SELECT employee_id, date_from, COALESCE(hours, 0)
+              FROM leave_records
+             WHERE leave_type = %s AND status='approved' AND COALESCE(deleted,FALSE)=FALSE
+             ORDER BY employee_id, date_from, id
+        """, (ANNUAL_LEAVE_TYPE,))
+        leaves = {}
+        for emp_id, df, hours in c.fetchall():
+            leaves.setdefault(emp_id, []).append((df, float(hours)))
+
+    # 到期日只跟給假日有關，同一天給假的人共用
+    expiry = {}
+    def _expires(gd, scenario):
+        key = (gd, scenario)
+        if key not in expiry:
+            expiry[key] = compute_expiry_dates(gd, scenario[0], scenario[1])[1]
+        return expiry[key]
+
+    totals = {l: {'entitled_hours': 0.0, 'available_hours': 0.0, 'expiring_hours': 0.0, 'payout_cost': 0}
+              for l in labels}
+    items = []
+    for emp_id, name, store_id, base, allowance in emps:
+        emp_grants = grants.get(emp_id)
+        if not emp_grants:
+            continue
+        # 與 _settle_store 相同：時薪先四捨五入到分，折現金額再四捨五入到元（ROUND_HALF_UP）
+        rate = Decimal(hourly_wage(Decimal(base or 0), Decimal(allowance or 0), PAYROLL_MONTHLY_HOURS)) \
+            .quantize(Decimal('0.01'), ROUND_HALF_UP)
+        row = {'employee_id': emp_id, 'name': name, 'store_id': store_id, 'scenarios': {}}
+        for scenario, label in zip(scenarios, labels):
+            entitled, available, expiring = fifo_grant_balances(
+                [(gd, _expires(gd, scenario), h) for gd, h in emp_grants], leaves.get(emp_id, ()), as_of, window_end)
+            hours = Decimal(str(expiring)).quantize(Decimal('0.1'), ROUND_HALF_UP)
+            payout = int((hours * rate).quantize(Decimal('1'), ROUND_HALF_UP))
+            row['scenarios'][label] = {'entitled_hours': entitled, 'available_hours': available,
+                                       'expiring_hours': expiring, 'payout_cost': payout}
+            t = totals[label]
+            t['entitled_hours'] += entitled; t['available_hours'] += available
+            t['expiring_hours'] += expiring; t['payout_cost'] += payout
+        base_r = row['scenarios'][labels[0]]
+        row['delta'] = {l: {k: round(v - base_r[k], 1) for k, v in row['scenarios'][l].items()} for l in labels[1:]}
+        items.append(row)
+    for t in totals.values():
+        for k in ('entitled_hours', 'available_hours', 'expiring_hours'):
+            t[k] = round(t[k], 1)
+    return totals, items
+
+def _default_policy_scenarios():
+    """現行設定排第一（基準），再補上常見的替代方案。"""
+    current = (LEAVE_POLICY if LEAVE_POLICY == 'calendar' else 'anniversary',
+               ANNIV_CARRYOVER_MONTHS if LEAVE_POLICY != 'calendar' else 0)
+    out = [current]
+    for s in (('anniversary', 0), ('anniversary', 12), ('calendar', 0)):
+        if s not in out:
+            out.append(s)
+    return out
+
+@app.get('/api/leave-policy/simulate')
+def api_leave_policy_simulate():
+    """
+    GET /api/leave-policy/simulate?scenario=anniversary:12&scenario=calendar&as_of=&window_days=365
+    未指定 scenario：現行設定 vs 常見替代方案。第一個為基準。
+    changed_only=1（預設）只列出與基準有差異的員工；limit 限制明細筆數。
+    """
+    init_db()
+    try:
+        scenarios = [_parse_policy_scenario(s) for s in request.args.getlist('scenario')] or _default_policy_scenarios()
+        window_days = int(request.args.get('window_days', 365))
+        limit = int(request.args.get('limit', 1000))
+    except ValueError as e:
+        abort(400, description=str(e))
+    as_of = _parse_as_of() or date.today()
+    with get_conn() as conn:
+        totals, items = _simulate_leave_policies(conn, scenarios, as_of, window_days)
+    if request.args.get('changed_only', '1') == '1':
+        items = [r for r in items if any(v for d in r['delta'].values() for v in d.values())]
+    return jsonify({
+        'as_of': as_of.isoformat(), 'window_days': window_days,
+        'baseline': _policy_label(scenarios[0]), 'totals': totals,
+        'changed_employees': len(items), 'items': items[:limit],
+    })
+
+# -------------------------
+# 特休負債推估（未來 N 個月，逐月、分店彙總；每日快取）
+# -------------------------
+LEAVE_FORECAST_FIELDS = ['headcount', 'granted_hours', 'used_hours', 'expiring_hours',
+                         'balance_hours', 'liability', 'payout_cost']
+
+def _forecast_periods(as_of, months):
+    """[(起日, 迄日)]：第一段 as_of～當月底，其後整月，共 months+1 段（首段不足月）。"""
+    periods, start = [], as_of
+    for _ in range(months + 1):
+        nxt = _add_months(start.replace(day=1), 1)
+        periods.append((start, nxt - timedelta(days=1)))
+        start = nxt
+    return periods
+
+def _compute_leave_forecast(conn, as_of, months):
+    """
+    全體在職員工：帳本中未到期的餘額（只扣 as_of 以前的請休）+ 依到職日推出的未來給假（entitled_leave_days 級距，留停者不給），
+    預期請休 = 過去 12 個月核准特休時數 ÷ 12，逐月 FIFO 扣抵、到期與離職折現。
+    回傳 {(store_key, 月份): {欄位: 值}}。
+    """
+    periods = _forecast_periods(as_of, months)
+    horizon = periods[-1][1]
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT e.id, COALESCE(e.store_id, 0), e.start_date, e.end_date, COALESCE(e.on_leave_suspend, FALSE),
+                   COALESCE(e.base_salary, 0), COALESCE(e.position_allowance, 0)
+              FROM employees e
+             WHERE e.start_date <= %s AND (e.end_date IS NULL OR e.end_date >= %s)
+               AND COALESCE(e.is_active, TRUE) = TRUE
+        """, (as_of, as_of))
+        emps = c.fetchall()
+        # 期初餘額只扣到 as_of（含）為止的扣抵：used_hours 已含排定的未來特休，再扣預期請休會重複
+        c.execute("""
+            SELECT g.employee_id, g.grant_date, g.expires_on,
+                   g.granted_hours + g.adjust_hours - COALESCE(u.hours, 0)
+                     - CASE WHEN g.paid_out_on <= %(d)s THEN g.paid_out_hours ELSE 0 END
+              FROM leave_grants g
+              LEFT JOIN LATERAL (
+                SELECT SUM(x.hours) AS hours FROM leave_grant_usage x
+                 WHERE x.grant_id = g.id AND x.leave_date <= %(d)s
+              ) u ON TRUE
+             WHERE g.expires_on >= %(d)s AND g.grant_date <= %(d)s
+        """, {'d': as_of})
+        open_grants = {}
+        for emp_id, gd, exp, left in c.fetchall():
+            if left > 0:
+                open_grants.setdefault(emp_id, []).append((gd, exp, float(left)))
+        c.execute("""
+            SELECT employee_id, SUM(COALESCE(hours, 0)) / 12.0
+              FROM leave_records
+             WHERE leave_type = %s AND status='approved' AND COALESCE(deleted,FALSE)=FALSE
+               AND date_from > %s AND date_from <= %s
+             GROUP BY employee_id
+        """, (ANNUAL_LEAVE_TYPE, _add_months(as_of, -12), as_of))
+        usage_rate = {r[0]: float(r[1]) for r in c.fetchall()}
+
+    expiry = {}
+    agg = {}
+    for emp_id, store_key, sd, ed, suspend, base, allowance in emps:
+        sd, ed = _ensure_date(sd), _ensure_date(ed) if ed else None
+        grants = list(open_grants.get(emp_id, []))
+        if not suspend:
+            for gd, days in annual_leave_grants(sd, min(horizon, ed) if ed else horizon):
+                if gd > as_of:
+                    if gd not in expiry:
+                        expiry[gd] = compute_expiry_dates(gd, LEAVE_POLICY)[1]
+                    grants.append((gd, expiry[gd], float(days * 8)))
+        rate = hourly_wage(base, allowance, float(PAYROLL_MONTHLY_HOURS))
+        rows = forecast_leave_months(grants, usage_rate.get(emp_id, 0.0), periods, ed)
+        for (p_from, p_to), (granted, used, expiring, balance) in zip(periods, rows):
+            if ed and p_from > ed:
+                break
+            a = agg.setdefault((store_key, p_from.replace(day=1)), dict.fromkeys(LEAVE_FORECAST_FIELDS, 0))
+            a['headcount'] += 1
+            a['granted_hours'] += granted
+            a['used_hours'] += used
+            a['expiring_hours'] += expiring
+            a['balance_hours'] += balance
+            a['liability'] += balance * rate
+            a['payout_cost'] += expiring * rate
+    return agg
+
+def _leave_forecast(conn, months=12, refresh=False):
+    """讀今日快取；沒有（或 refresh）才重算並寫入，同時清掉前幾天的快取。回傳依分店/月份排序的 dict 清單。"""
+    as_of = date.today()
+    with conn.cursor(row_factory=dict_row) as c:
+        if refresh:
+            c.execute("DELETE FROM leave_forecast_cache WHERE as_of=%s AND months=%s", (as_of, months))
+        else:
+            c.execute("SELECT 1 FROM leave_forecast_cache WHERE as_of=%s AND months=%s LIMIT 1", (as_of, months))
+        if refresh or c.fetchone() is None:
+            agg = _compute_leave_forecast(conn, as_of, months)
+            c.execute("DELETE FROM leave_forecast_cache WHERE as_of < %s", (as_of,))
+            c.executemany(f"""
+                INSERT INTO leave_forecast_cache (as_of, months, store_id, month, {', '.join(LEAVE_FORECAST_FIELDS)})
+                VALUES (%s,%s,%s,%s,{', '.join(['%s'] * len(LEAVE_FORECAST_FIELDS))})
+                ON CONFLICT DO NOTHING
+            """, [(as_of, months, store_key, month, a['headcount'],
+                   round(a['granted_hours'], 1), round(a['used_hours'], 1), round(a['expiring_hours'], 1),
+                   round(a['balance_hours'], 1), int(round(a['liability'])), int(round(a['payout_cost'])))
+                  for (store_key, month), a in agg.items()])
+            conn.commit()
+        c.execute("""
+            SELECT f.store_id, s.name AS store_name, f.month, f.headcount, f.granted_hours, f.used_hours,
+                   f.expiring_hours, f.balance_hours, f.liability, f.payout_cost, f.computed_at
+              FROM leave_forecast_cache f
+              LEFT JOIN stores s ON s.id = f.store_id
+             WHERE f.as_of=%s AND f.months=%s
+             ORDER BY f.store_id, f.month
+        """, (as_of, months))
+        return c.fetchall()
+
+def _leave_forecast_args():
+    try:
+        months = int(request.args.get('months', 12))
+    except ValueError:
+        abort(400, description='months 需為整數')
+    if not 1 <= months <= 36:
+        abort(400, description='months 需介於 1～36')
+    return months, request.args.get('store_id', type=int), request.args.get('refresh') == '1'
+
+@app.get('/api/leave-forecast')
+def api_leave_forecast():
+    """
+    GET /api/leave-forecast?months=12&store_id=&refresh=1
+    未來 N 個月逐月特休餘額（時數）與負債（元）；首月為今天～月底。每日第一次查詢時計算並快取。
+    """
+    init_db()
+    months, store_id, refresh = _leave_forecast_args()
+    with get_conn() as conn:
+        rows = _leave_forecast(conn, months, refresh)
+    if store_id is not None:
+        rows = [r for r in rows if r['store_id'] == store_id]
+    totals = {}
+    for r in rows:
+        t = totals.setdefault(r['month'], dict.fromkeys(LEAVE_FORECAST_FIELDS, 0))
+        for f in LEAVE_FORECAST_FIELDS:
+            t[f] += r[f]
+    def _out(d):
+        return {k: (float(v) if isinstance(v, Decimal) else v.isoformat() if isinstance(v, (date, datetime)) else v)
+                for k, v in d.items()}
+    return jsonify({
+        'as_of': date.today().isoformat(), 'months': months,
+        'computed_at': rows[0]['computed_at'].isoformat() if rows else None,
+        'totals': [_out(dict(month=m, **t)) for m, t in sorted(totals.items())],
+        'stores': [_out({k: v for k, v in r.items() if k != 'computed_at'}) for r in rows],
+    })
+
+@app.get('/leave-forecast.csv')
+def leave_forecast_csv():
+    init_db()
+    months, store_id, refresh = _leave_forecast_args()
+    with get_conn() as conn:
+        rows = _leave_forecast(conn, months, refresh)
+    s = io.StringIO(); w = csv.writer(s)
+    w.writerow(['分店ID', '分店', '月份', '人數', '新給假(h)', '預期請休(h)', '到期(h)', '月底餘額(h)', '負債(元)', '折現(元)'])
+    for r in rows:
+        if store_id is None or r['store_id'] == store_id:
+            w.writerow([r['store_id'], r['store_name'] or '未分店', r['month'].strftime('%Y-%m'), r['headcount'],
+                        r['granted_hours'], r['used_hours'], r['expiring_hours'], r['balance_hours'],
+                        r['liability'], r['payout_cost']])
+    resp = make_response('\ufeff' + s.getvalue())
+    resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    resp.headers['Content-Disposition'] = f'attachment; filename=leave_forecast_{date.today().isoformat()}.csv'
+    return resp
+
+# -------------------------
+# 年資里程碑：employees.next_anniversary / next_tier_change 預先算好並建索引，查詢只做範圍掃描
+# 日期過了（<= 今天）或從未算過的列在查詢前補算；到職日/留停異動時立即重算該員
+# -------------------------
+LEAVE_TIER_CHANGES = leave_tier_changes()
+MILESTONE_MAX_DAYS = 366
+
+def _refresh_milestones(conn, emp_ids=None):
+    """
+    一個 UPDATE 重算里程碑（不 commit）：emp_ids=None → 只處理過期/未算過的列。
+    週年日與 next_anniversary() 同規則（今天之後、2/29 → 平年 2/28）；級距依 LEAVE_TIER_CHANGES，留停者不計。
+    """
+    cond = "id = ANY(%(ids)s)" if emp_ids is not None else \
+        "(milestones_synced_on IS NULL OR next_anniversary <= CURRENT_DATE OR next_tier_change <= CURRENT_DATE)"
+    with conn.cursor() as c:
+        c.execute(f"""
+            UPDATE employees
+               SET next_anniversary = (
+                     SELECT (start_date + make_interval(years => k))::date
+                       FROM generate_series(GREATEST(date_part('year', age(CURRENT_DATE, start_date))::int, 0) + 1,
+                                            GREATEST(date_part('year', age(CURRENT_DATE, start_date))::int, 0) + 2) k
+                      WHERE start_date + make_interval(years => k) > CURRENT_DATE
+                      ORDER BY k LIMIT 1),
+                   (next_tier_change, next_tier_days) = (
+                     SELECT (start_date + make_interval(months => t.m))::date, t.days
+                       FROM unnest(%(months)s::int[], %(days)s::int[]) AS t(m, days)
+                      WHERE start_date + make_interval(months => t.m) > CURRENT_DATE
+                        AND NOT COALESCE(on_leave_suspend, FALSE)
+                      ORDER BY t.m LIMIT 1),
+                   milestones_synced_on = CURRENT_DATE
+             WHERE {cond}
+        """, {'ids': list(emp_ids or []), 'months': [m for m, _ in LEAVE_TIER_CHANGES],
+              'days': [d for _, d in LEAVE_TIER_CHANGES]})
+        return c.rowcount
+
+@app.get('/api/milestones')
+def api_milestones():
+    """
+    GET /api/milestones?days=30&kind=tier|anniversary&store_id=
+    在職員工未來 N 天內（不含今天，最多 366 天）的到職週年與特休級距變動，依日期排序。
+    tier 項目附目前與變動後的特休天數。
+    """
+    init_db()
+    days = request.args.get('days', 30, type=int)
+    kind = request.args.get('kind')
+    store_id = request.args.get('store_id', type=int)
+    if not 1 <= days <= MILESTONE_MAX_DAYS:
+        abort(400, description=f'days 需介於 1～{MILESTONE_MAX_DAYS}')
+    if kind not in (None, '', 'tier', 'anniversary'):
+        abort(400, description='kind 需為 tier 或 anniversary')
+    parts = []
+    for k, col in (('tier', 'next_tier_change'), ('anniversary', 'next_anniversary')):
+        if kind in (None, '', k):
+            parts.append(f"""
+                SELECT '{k}' AS kind, e.id, e.name, e.store_id, s.name AS store_name, e.start_date,
+                       e.{col} AS on_date, {'e.next_tier_days' if k == 'tier' else 'NULL::int'} AS leave_days_after
+                  FROM employees e
+                  LEFT JOIN stores s ON s.id = e.store_id
+                 WHERE e.{col} > CURRENT_DATE AND e.{col} <= CURRENT_DATE + %(days)s
+                   AND COALESCE(e.is_active, TRUE) = TRUE
+                   AND (e.end_date IS NULL OR e.end_date >= e.{col})
+                   AND (%(store)s::int IS NULL OR e.store_id = %(store)s)
+            """)
+    with get_conn() as conn:
+        _refresh_milestones(conn)
+        conn.commit()
+        with conn.cursor(row_factory=dict_row) as c:
+            c.execute(" UNION ALL ".join(parts) + " ORDER BY on_date, id", {'days': days, 'store': store_id})
+            rows = c.fetchall()
+    today = date.today()
+    items = []
+    for r in rows:
+        years, months = calculate_seniority(r['start_date'], r['on_date'])
+        item = {
+            'kind': r['kind'], 'employee_id': r['id'], 'name': r['name'],
+            'store_id': r['store_id'], 'store_name': r['store_name'],
+            'start_date': r['start_date'].isoformat(), 'date': r['on_date'].isoformat(),
+            'days_left': days_until(r['on_date'], today), 'years': years, 'months': months,
+        }
+        if r['kind'] == 'tier':
+            item['leave_days_before'] = entitled_leave_days(*calculate_seniority(r['start_date']), False)
+            item['leave_days_after'] = r['leave_days_after']
+        items.append(item)
+    return jsonify({'today': today.isoformat(), 'days': days, 'count': len(items), 'items': items})
+
+# -------------------------
+# 分析彙總：請假（月 × 分店 × 部門 × 假別）與人數（月 × 分店 到職/離職/月底人數/離職率）
+# 寫入路徑只在同一交易標記 dirty 月份；查詢前（及 `flask rollup-refresh`）逐月以一次分組彙總重算
+# -------------------------
+def _mark_rollup_months(conn, kind, days):
+    months = sorted({_ensure_date(d).replace(day=1) for d in days if d})
+    if months:
+        with conn.cursor() as c:
+            c.executemany("INSERT INTO rollup_dirty_months (kind, month) VALUES (%s,%s) ON CONFLICT DO NOTHING",
+                          [(kind, m) for m in months])
+
+def _mark_employee_rollups(conn, emp_ids, days=(), with_leaves=False):
+    """到職/離職日 → 人數月份；with_leaves：分店/部門變動，該員所有請假月份也要重算。"""
+    _mark_rollup_months(conn, 'headcount', days)
+    if with_leaves:
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO rollup_dirty_months (kind, month)
+                SELECT DISTINCT 'leave', date_trunc('month', date_from)::date
+                  FROM leave_records WHERE employee_id = ANY(%s)
+                ON CONFLICT DO NOTHING
+            """, (list(emp_ids),))
+
+def _refresh_rollups(conn):
+    """重算所有 dirty 月份並 commit；advisory lock 讓同時呼叫的人排隊（後到的通常已無事可做）。回傳月份數。"""
+    with conn.cursor() as c:
+        c.execute("SELECT 1 FROM rollup_dirty_months LIMIT 1")
+        if c.fetchone() is None:
+            return 0
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('rollup_refresh'))")
+        c.execute("DELETE FROM rollup_dirty_months RETURNING kind, month")
+        dirty = c.fetchall()
+        for kind, month in dirty:
+            nxt = _add_months(month, 1)
+            if kind == 'leave':
+                c.execute("DELETE FROM leave_monthly_rollup WHERE month = %s", (month,))
+                c.execute("""
+                    INSERT INTO leave_monthly_rollup (month, store_key, department, leave_type, hours, records)
+                    SELECT %s, COALESCE(e.store_id, 0), COALESCE(e.department, ''), lr.leave_type,
+                           SUM(COALESCE(lr.hours, 0)), COUNT(*)
+                      FROM leave_records lr
+                      JOIN employees e ON e.id = lr.employee_id
+                     WHERE lr.date_from >= %s AND lr.date_from < %s
+                       AND lr.status = 'approved' AND COALESCE(lr.deleted, FALSE) = FALSE
+                     GROUP BY 2, 3, 4
+                """, (month, month, nxt))
+            else:
+                c.execute("DELETE FROM headcount_monthly_rollup WHERE month = %s", (month,))
+                c.execute("""
+                    INSERT INTO headcount_monthly_rollup (month, store_key, hires, leavers)
+                    SELECT %(m)s, store_key, SUM(hire), SUM(leave)
+                      FROM (SELECT COALESCE(store_id, 0) AS store_key, 1 AS hire, 0 AS leave
+                              FROM employees WHERE start_date >= %(m)s AND start_date < %(n)s
+                            UNION ALL
+                            SELECT COALESCE(store_id, 0), 0, 1
+                              FROM employees WHERE end_date >= %(m)s AND end_date < %(n)s) x
+                     GROUP BY store_key
+                """, {'m': month, 'n': nxt})
+    conn.commit()
+    return len(dirty)
+
+def _analytics_args():
+    """from/to = YYYY-MM（預設最近 24 個月），store_id 選填。"""
+    this_month = date.today().replace(day=1)
+    try:
+        m_to = datetime.strptime(request.args['to'], '%Y-%m').date() if request.args.get('to') else this_month
+        m_from = (datetime.strptime(request.args['from'], '%Y-%m').date() if request.args.get('from')
+                  else _add_months(m_to, -23))
+    except ValueError:
+        abort(400, description='from/to 格式需為 YYYY-MM')
+    if m_from > m_to or (m_to.year - m_from.year) * 12 + m_to.month - m_from.month >= 120:
+        abort(400, description='from～to 需在 120 個月以內')
+    return m_from, m_to, request.args.get('store_id', type=int)
+
+def _fetch_rollups(conn, m_from, m_to, store_id=None):
+    """回傳 (請假列, 人數列)；人數列每個分店每個月一筆（沒有異動的月份也有）。"""
+    store_sql = "AND store_key = %(store)s" if store_id is not None else ""
+    params = {'from': m_from, 'to': m_to, 'store': store_id}
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute(f"""
+            SELECT r.month, r.store_key AS store_id, s.name AS store_name, r.department, r.leave_type,
+                   r.hours, r.records
+              FROM leave_monthly_rollup r
+              LEFT JOIN stores s ON s.id = r.store_key
+             WHERE r.month BETWEEN %(from)s AND %(to)s {store_sql}
+             ORDER BY r.month, r.store_key, r.department, r.leave_type
+        """, params)
+        leave = c.fetchall()
+        c.execute(f"""
+            WITH keys AS (
+              SELECT DISTINCT store_key FROM headcount_monthly_rollup WHERE month <= %(to)s {store_sql}
+            ), base AS (
+              SELECT store_key, SUM(hires - leavers) AS n
+                FROM headcount_monthly_rollup WHERE month < %(from)s {store_sql}
+               GROUP BY store_key
+            ), grid AS (
+              SELECT m::date AS month, k.store_key, COALESCE(r.hires, 0) AS hires, COALESCE(r.leavers, 0) AS leavers
+                FROM keys k
+               CROSS JOIN generate_series(%(from)s::date, %(to)s::date, INTERVAL '1 month') m
+                LEFT JOIN headcount_monthly_rollup r ON r.month = m::date AND r.store_key = k.store_key
+            ), running AS (
+              SELECT g.*, COALESCE(b.n, 0)
+                          + SUM(g.hires - g.leavers) OVER (PARTITION BY g.store_key ORDER BY g.month) AS headcount
+                FROM grid g LEFT JOIN base b USING (store_key)
+            )
+            SELECT r.month, r.store_key AS store_id, s.name AS store_name, r.hires, r.leavers,
+                   r.headcount - r.hires + r.leavers AS opening, r.headcount,
+                   ROUND(r.leavers * 100.0 / NULLIF((2 * r.headcount - r.hires + r.leavers) / 2.0, 0), 2) AS turnover_pct
+              FROM running r
+              LEFT JOIN stores s ON s.id = r.store_key
+             ORDER BY r.month, r.store_key
+        """, params)
+        headcount = c.fetchall()
+    return leave, headcount
+
+def _rollup_json(d):
+    return {k: (float(v) if isinstance(v, Decimal) else v.strftime('%Y-%m') if isinstance(v, date) else v)
+            for k, v in d.items()}
+
+@app.get('/api/analytics')
+def api_analytics():
+    """
+    GET /api/analytics?from=YYYY-MM&to=YYYY-MM&store_id=
+    leave：每月 × 分店 × 部門 × 假別的核准請假時數/筆數；headcount：每月 × 分店的期初/到職/離職/月底人數與離職率(%)。
+    只讀彙總表（先補算 dirty 月份）。
+    """
+    init_db()
+    m_from, m_to, store_id = _analytics_args()
+    with get_conn() as conn:
+        _refresh_rollups(conn)
+        leave, headcount = _fetch_rollups(conn, m_from, m_to, store_id)
+    return jsonify({
+        'from': m_from.strftime('%Y-%m'), 'to': m_to.strftime('%Y-%m'), 'store_id': store_id,
+        'leave': [_rollup_json(r) for r in leave],
+        'headcount': [_rollup_json(r) for r in headcount],
+    })
+
+@app.get('/analytics')
+def analytics_page():
+    """分析儀表板：每月各假別時數（全公司或單一分店）+ 每月人數/到職/離職/離職率。"""
+    init_db()
+    m_from, m_to, store_id = _analytics_args()
+    with get_conn() as conn:
+        _refresh_rollups(conn)
+        leave, headcount = _fetch_rollups(conn, m_from, m_to, store_id)
+        with conn.cursor() as c:
+            c.execute("SELECT id, name FROM stores ORDER BY id")
+            stores = c.fetchall()
+    months, leave_types, by_month = [], sorted({r['leave_type'] for r in leave}), {}
+    m = m_from
+    while m <= m_to:
+        months.append(m); m = _add_months(m, 1)
+    for r in leave:
+        d = by_month.setdefault(r['month'], {})
+        d[r['leave_type']] = d.get(r['leave_type'], 0) + r['hours']
+    totals = {}
+    for r in headcount:
+        t = totals.setdefault(r['month'], {'opening': 0, 'hires': 0, 'leavers': 0, 'headcount': 0})
+        for k in t:
+            t[k] += r[k]
+    for t in totals.values():
+        avg = (t['opening'] + t['headcount']) / 2
+        t['turnover_pct'] = round(t['leavers'] * 100 / avg, 2) if avg else None
+    peak = max([v for d in by_month.values() for v in d.values()] or [1])
+    return render_template('analytics.html', months=months, leave_types=leave_types, by_month=by_month,
+                           peak=peak, totals=totals, stores=stores, store_id=store_id,
+                           m_from=m_from.strftime('%Y-%m'), m_to=m_to.strftime('%Y-%m'))
+
+# -------------------------
+# 薪資/保險明細
+# -------------------------
+@app.route('/salary/<int:emp_id>')
+def salary_detail(emp_id):
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute('SELECT name, salary_grade FROM employees WHERE id=%s', (emp_id,))
+        row = c.fetchone()
+        if not row:
+            return abort(404)
+        name, grade = row
+        c.execute('''
+            SELECT personal_labour, personal_health,
+                   company_labour, company_health,
+                   retirement6, occupational_ins, total_company, note
+              FROM insurances
+             WHERE employee_id = %s
+        ''', (emp_id,))
+        ins = c.fetchone() or (0,0,0,0,0,0,0,'')
+        (pl, ph, cl, ch, ret6, oi, total, note) = ins
+        # 最近一個月最新一次的薪資計算
+        c.execute('''
+            SELECT month, gross, personal_leave_deduction, sick_leave_deduction,
+                   personal_labour + personal_health, leave_cashout, net, run_id
+              FROM payroll_lines
+             WHERE employee_id = %s
+             ORDER BY month DESC, run_id DESC
+             LIMIT 1
+        ''', (emp_id,))
+        payroll = c.fetchone()
+
+    return render_template('salary_detail.html',
+                           payroll=payroll,
+                           emp_id=emp_id,
+                           name=name,
+                           grade=grade,
+                           personal_labour=pl,
+                           personal_health=ph,
+                           company_labour=cl,
+                           company_health=ch,
                            retirement6=ret6,
                            occupational_ins=oi,
                            total_company=total,
                            note=note)
 
+# -------------------------
+# 員工 360（基本資料、分店、保險、各假別餘額、最近假單/稽核/薪資；一次查詢組好）
+# -------------------------
+EMPLOYEE_RECENT_LIMIT = 20
+
+# 前 24 欄與 OVERVIEW_SELECT 相同（交給 _overview_row 算餘額），其餘各區塊以 LATERAL 子查詢組成 JSON
+EMPLOYEE_360_SQL = '''
+    SELECT
+        e.id, e.name, e.start_date, e.end_date,
+        e.department, e.job_level,
+        e.salary_grade, e.base_salary, e.position_allowance,
+        e.on_leave_suspend, e.used_leave, e.entitled_leave,
+        e.entitled_leave_hours, e.used_leave_hours,
+        e.entitled_sick, e.used_sick,
+        e.entitled_personal, e.used_personal,
+        e.entitled_marriage, e.used_marriage,
+        e.is_active,
+        e.leave_adjust_hours,
+        e.store_id,
+        s.name AS store_name,
+        e.next_anniversary, e.next_tier_change, e.next_tier_days,
+        ins.j, usage.j, bal.ent, bal.used, bal.paid, recent.j, audit.j, pay.j
+    FROM employees e
+    LEFT JOIN stores s ON s.id = e.store_id
+    LEFT JOIN LATERAL (
+      SELECT to_jsonb(i) - 'employee_id' AS j FROM insurances i WHERE i.employee_id = e.id
+    ) ins ON TRUE
+    LEFT JOIN LATERAL (
+      SELECT jsonb_object_agg(leave_type, h) AS j
+        FROM (SELECT leave_type, SUM(hours) AS h FROM leave_records
+               WHERE employee_id = e.id AND status = 'approved' AND COALESCE(deleted, FALSE) = FALSE
+               GROUP BY leave_type) u
+    ) usage ON TRUE
+    LEFT JOIN LATERAL (
+      -- 離職員工看離職日當時有效的期別（與 _fetch_leave_balances 相同）
+      SELECT SUM(granted_hours + adjust_hours) AS ent, SUM(used_hours) AS used, SUM(paid_out_hours) AS paid
+        FROM leave_grants
+       WHERE employee_id = e.id
+         AND expires_on >= LEAST(COALESCE(e.end_date, CURRENT_DATE), CURRENT_DATE)
+         AND grant_date <= LEAST(COALESCE(e.end_date, CURRENT_DATE), CURRENT_DATE)
+    ) bal ON TRUE
+    LEFT JOIN LATERAL (
+      SELECT json_agg(r ORDER BY r.date_from DESC, r.id DESC) AS j
+        FROM (SELECT id, leave_type, date_from, date_to, hours, status, note, created_by, approved_by
+                FROM leave_records
+               WHERE employee_id = e.id AND COALESCE(deleted, FALSE) = FALSE
+               ORDER BY date_from DESC, id DESC
+               LIMIT %(limit)s) r
+    ) recent ON TRUE
+    LEFT JOIN LATERAL (
+      -- 各 (table_name, row_id) 分開走 audit_logs_table_row_idx，再合併取最新幾筆
+      SELECT json_agg(a ORDER BY a.acted_at DESC, a.id DESC) AS j
+        FROM (SELECT l.id, l.table_name, l.row_id, l.action, l.before_json, l.after_json, l.acted_by, l.acted_at
+                FROM (SELECT 'employees' AS t, e.id AS rid
+                      UNION ALL SELECT 'insurances', (ins.j->>'id')::int
+                      UNION ALL SELECT DISTINCT 'leave_records', id FROM leave_records WHERE employee_id = e.id) k
+                CROSS JOIN LATERAL (
+                  SELECT * FROM audit_logs
+                   WHERE table_name = k.t AND row_id = k.rid
+                   ORDER BY acted_at DESC
+                   LIMIT %(limit)s
+                ) l
+               ORDER BY l.acted_at DESC, l.id DESC
+               LIMIT %(limit)s) a
+    ) audit ON TRUE
+    LEFT JOIN LATERAL (
+      SELECT to_jsonb(p) - 'employee_id' AS j FROM payroll_lines p
+       WHERE p.employee_id = e.id
+       ORDER BY p.month DESC, p.run_id DESC
+       LIMIT 1
+    ) pay ON TRUE
+    WHERE e.id = %(id)s
+'''
+_OVERVIEW_WIDTH = 24
+
+def _employee_360(conn, emp_id):
+    """
+    員工 360 dict（查無此人回 None），一次查詢。特休帳本由 `flask leave-ledger-sync` 每日推進，這裡只讀。
+    各假別餘額與總覽同一套算法（_overview_row）。
+    """
+    with conn.cursor() as c:
+        c.execute(EMPLOYEE_360_SQL, {'id': emp_id, 'limit': EMPLOYEE_RECENT_LIMIT})
+        row = c.fetchone()
+    if row is None:
+        return None
+    (next_anniv, next_tier, next_tier_days,
+     insurance, usage, ent, used, paid, recent, audit, payroll) = row[_OVERVIEW_WIDTH:]
+    usage = {k: float(v) for k, v in (usage or {}).items()}
+    balances = {emp_id: (float(ent or 0), float(used or 0), float(paid or 0))}
+    e = _overview_row(row[:_OVERVIEW_WIDTH], balances, {emp_id: usage}, date.today())
+    return {
+        'profile': {
+            'id': e['id'], 'name': e['name'], 'start_date': e['start_date'], 'end_date': e['end_date'] or None,
+            'is_active': row[20], 'job_level': e['job_level'], 'salary_grade': e['salary_grade'],
+            'base_salary': e['base_salary'], 'position_allowance': e['position_allowance'],
+            'on_leave_suspend': e['suspend'], 'seniority': {'years': e['years'], 'months': e['months']},
+            'next_anniversary': next_anniv, 'next_tier_change': next_tier, 'next_tier_days': next_tier_days,
+        },
+        'store': {'id': e['store_id'], 'name': e['store_name']},
+        'department': e['department'],
+        'insurance': insurance,
+        'balances': {
+            ANNUAL_LEAVE_TYPE: {'unit': 'hours', 'entitled': e['entitled'], 'used': e['used'],
+                                'paid_out': balances[emp_id][2], 'remaining': e['remaining']},
+            '病假': {'unit': 'days', 'entitled': e['entitled_sick'], 'used': e['used_sick'],
+                     'remaining': e['remaining_sick']},
+            '事假': {'unit': 'days', 'entitled': e['entitled_personal'], 'used': e['used_personal'],
+                     'remaining': e['remaining_personal']},
+            '婚假': {'unit': 'days', 'entitled': e['entitled_marriage'], 'used': e['used_marriage'],
+                     'remaining': e['remaining_marriage']},
+        },
+        'used_hours_by_type': usage,
+        'recent_leaves': recent or [],
+        'recent_audit': audit or [],
+        'latest_payroll': payroll,
+    }
+
+@app.get('/api/employee/<int:emp_id>')
+def api_employee(emp_id):
+    """GET /api/employee/<id>：員工 360 JSON（最近假單/稽核各 EMPLOYEE_RECENT_LIMIT 筆）"""
+    init_db()
+    with get_conn() as conn:
+        data = _employee_360(conn, emp_id)
+    if data is None:
+        return abort(404)
+    p = data['profile']
+    for k in ('start_date', 'end_date', 'next_anniversary', 'next_tier_change'):
+        if isinstance(p[k], date):
+            p[k] = p[k].isoformat()
+    return jsonify(data)
+
+@app.get('/employee/<int:emp_id>')
+def employee_detail(emp_id):
+    init_db()
+    with get_conn() as conn:
+        data = _employee_360(conn, emp_id)
+    if data is None:
+        return abort(404)
+    return render_template('employee.html', **data)
+
+# -------------------------
+# 薪資計算（payroll_runs / payroll_lines）
+# -------------------------
+PAYROLL_LINE_FIELDS = [
+    'employee_id', 'store_id', 'base_salary', 'position_allowance', 'employed_days', 'hourly_rate',
+    'gross', 'personal_leave_hours', 'personal_leave_deduction', 'sick_leave_hours', 'sick_half_pay_hours',
+    'sick_leave_deduction', 'personal_labour', 'personal_health', 'leave_cashout', 'net',
+]
+
+def _compute_payroll_lines(conn, month_start, store_key=None, emp_ids=None):
+    """
+    計算某月薪資明細（不寫入）：當月有在職的員工，store_key（0 = 未分店）或 emp_ids 二擇一篩選。
+    事假/病假時數用月報的跨月分攤；病假半薪上限看今年本月之前已請的時數；特休折現取當月結算。
+    """
+    next_month = _add_months(month_start, 1)
+    month_end = next_month - timedelta(days=1)
+    year_start = month_start.replace(month=1)
+    conds, params = [], {'start': month_start, 'end': month_end, 'year_start': year_start}
+    if store_key is not None:
+        conds.append("COALESCE(e.store_id, 0) = %(store)s"); params['store'] = store_key
+    if emp_ids is not None:
+        conds.append("e.id = ANY(%(ids)s)"); params['ids'] = list(emp_ids)
+    with conn.cursor() as c:
+        c.execute(f"""
+            SELECT e.id, e.store_id, COALESCE(e.base_salary, 0), COALESCE(e.position_allowance, 0),
+                   GREATEST(e.start_date, %(start)s::date), LEAST(COALESCE(e.end_date, %(end)s::date), %(end)s::date),
+                   COALESCE(i.personal_labour, 0), COALESCE(i.personal_health, 0),
+                   COALESCE((SELECT SUM(s.amount) FROM leave_settlements s
+                              WHERE s.employee_id = e.id AND s.settle_date BETWEEN %(start)s AND %(end)s), 0)
+              FROM employees e
+              LEFT JOIN insurances i ON i.employee_id = e.id
+             WHERE e.start_date <= %(end)s AND (e.end_date IS NULL OR e.end_date >= %(start)s)
+               {"AND " + " AND ".join(conds) if conds else ""}
+             ORDER BY e.id
+        """, params)
+        emps = c.fetchall()
+        ids = [r[0] for r in emps]
+
+    # 今年本月以前已請的病假（供半薪上限）與本月假別時數，跨月假單都依工作日比例分攤
+    sick_ytd = {}
+    if year_start < month_start:
+        for emp_id, _, leave_type, hours in _monthly_leave_allocation(conn, year_start, month_start, ids):
+            if leave_type == '病假':
+                sick_ytd[emp_id] = hours
+    leave = {}
+    for emp_id, _, leave_type, hours in _monthly_leave_allocation(conn, month_start, next_month, ids):
+        leave[(emp_id, leave_type)] = hours
+
+    month_days = month_end.day
+    lines = []
+    for emp_id, store_id, base, allowance, d_from, d_to, labour, health, cashout in emps:
+        employed_days = (d_to - d_from).days + 1
+        line = payroll_line(base, allowance, employed_days, month_days,
+                            personal_hours=leave.get((emp_id, '事假'), Decimal(0)),
+                            sick_hours=leave.get((emp_id, '病假'), Decimal(0)),
+                            sick_ytd_hours=sick_ytd.get(emp_id, Decimal(0)),
+                            personal_labour=labour, personal_health=health,
+                            leave_cashout=cashout, monthly_hours=PAYROLL_MONTHLY_HOURS)
+        line.update(employee_id=emp_id, store_id=store_id, base_salary=base,
+                    position_allowance=allowance, employed_days=employed_days)
+        lines.append(line)
+    return lines
+
+def _run_payroll(conn, month_start, store_key=None, emp_ids=None, scope='store', created_by=None):
+    """計算並寫入一筆 payroll_run（含明細）；回傳 (run_id, 筆數, 實發合計)。不 commit。"""
+    lines = _compute_payroll_lines(conn, month_start, store_key, emp_ids)
+    with conn.cursor() as c:
+        c.execute("INSERT INTO payroll_runs (month, scope, store_id, created_by) VALUES (%s,%s,%s,%s) RETURNING id",
+                  (month_start, scope, store_key, created_by))
+        run_id = c.fetchone()[0]
+        if lines:
+            cols = ', '.join(PAYROLL_LINE_FIELDS)
+            c.executemany(
+                f"INSERT INTO payroll_lines (run_id, month, {cols}) VALUES (%s, %s, {', '.join(['%s'] * len(PAYROLL_LINE_FIELDS))})",
+                [(run_id, month_start) + tuple(l[f] for f in PAYROLL_LINE_FIELDS) for l in lines])
+    return run_id, len(lines), sum(l['net'] for l in lines)
+
+def _run_payroll_store(store_key, month_start, created_by=None):
+    """單一分店一個交易（可在子行程執行）。"""
+    with get_conn() as conn:
+        result = _run_payroll(conn, month_start, store_key=store_key, scope='store', created_by=created_by)
+        conn.commit()
+    return (store_key,) + result
+
+def _payroll_store_keys(conn):
+    with conn.cursor() as c:
+        c.execute("SELECT DISTINCT COALESCE(store_id, 0) FROM employees ORDER BY 1")
+        return [r[0] for r in c.fetchall()]
+
+def _payroll_month_arg(value):
+    try:
+        return datetime.strptime(value or date.today().strftime('%Y-%m'), '%Y-%m').date()
+    except ValueError:
+        abort(400, description='month 格式需為 YYYY-MM')
+
+# 每位員工每月以最新一次計算為準
+PAYROLL_CURRENT_SQL = """
+    SELECT DISTINCT ON (pl.employee_id) pl.*
+      FROM payroll_lines pl
+     WHERE pl.month = %(month)s
+     ORDER BY pl.employee_id, pl.run_id DESC
+"""
+
+@app.post('/payroll/run')
+def payroll_run():
+    """重新計算：指定 emp_id 只算一人、store_id 只算一店，否則全公司（逐店各一筆 run）。"""
+    init_db()
+    month_start = _payroll_month_arg(request.form.get('month'))
+    user = getattr(g, 'current_user', None)
+    emp_id = request.form.get('emp_id', type=int)
+    store_id = request.form.get('store_id', type=int)
+    with get_conn() as conn:
+        if emp_id:
+            # payroll_run 不可修改：查無此人或該月不在職就不建立空的 run
+            with conn.cursor() as c:
+                c.execute("""
+                    SELECT 1 FROM employees
+                     WHERE id=%s AND start_date <= %s AND (end_date IS NULL OR end_date >= %s)
+                """, (emp_id, _add_months(month_start, 1) - timedelta(days=1), month_start))
+                if c.fetchone() is None:
+                    abort(404, description='查無此員工，或該員工當月未在職')
+            runs = [(None,) + _run_payroll(conn, month_start, emp_ids=[emp_id], scope='employee', created_by=user)]
+        else:
+            keys = [store_id] if store_id is not None else _payroll_store_keys(conn)
+            runs = [(k,) + _run_payroll(conn, month_start, store_key=k, scope='store', created_by=user) for k in keys]
+        conn.commit()
+        write_audit(conn, 'payroll_runs', runs[0][1] if runs else 0, 'run', None, {
+            'month': month_start.strftime('%Y-%m'), 'emp_id': emp_id, 'store_id': store_id,
+            'runs': [r[1] for r in runs], 'lines': sum(r[2] for r in runs),
+        })
+    if request.form.get('format') == 'json':
+        return jsonify({'month': month_start.strftime('%Y-%m'),
+                        'runs': [{'store_id': k, 'run_id': rid, 'lines': n, 'net': net} for k, rid, n, net in runs]})
+    return redirect(url_for('payroll_page', month=month_start.strftime('%Y-%m')))
+
+@app.get('/payroll')
+def payroll_page():
+    init_db()
+    month_start = _payroll_month_arg(request.args.get('month'))
+    month = month_start.strftime('%Y-%m')
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(f"""
+            SELECT COALESCE(cur.store_id, 0), st.name, COUNT(*), SUM(cur.gross), SUM(cur.personal_leave_deduction + cur.sick_leave_deduction),
+                   SUM(cur.personal_labour + cur.personal_health), SUM(cur.leave_cashout), SUM(cur.net), MAX(cur.run_id)
+              FROM ({PAYROLL_CURRENT_SQL}) cur
+              LEFT JOIN stores st ON st.id = cur.store_id
+             GROUP BY 1, 2 ORDER BY 1
+        """, {'month': month_start})
+        rows = c.fetchall()
+    html = [f"<h1>薪資計算 — {month}</h1>", '<a href="/">← 返回</a><br><br>']
+    html.append(f"""
+    <form method="get" action="/payroll" style="display:inline">
+      月份：<input type="month" name="month" value="{month}"> <button type="submit">查看</button>
+    </form>
+    <form method="post" action="/payroll/run" style="display:inline;margin-left:16px">
+      <input type="hidden" name="month" value="{month}">
+      <button type="submit" onclick="return confirm('重新計算 {month} 全公司薪資？');">全公司重新計算</button>
+    </form>
+    <form method="post" action="/payroll/run" style="display:inline;margin-left:16px">
+      <input type="hidden" name="month" value="{month}">
+      員工ID <input name="emp_id" size="6" required> <button type="submit">單人重算</button>
+    </form>
+    <br><br>
+    """)
+    html.append("<table border=1 cellpadding=6><tr><th>分店</th><th>人數</th><th>應發</th><th>請假扣款</th>"
+                "<th>勞健保自付</th><th>特休折現</th><th>實發</th><th>最新 run</th><th>操作</th></tr>")
+    for key, sname, n, gross, leave_ded, ins, cashout, net, run_id in rows:
+        html.append(f"""
+          <tr>
+            <td>{sname or '未分店'}</td><td>{n}</td><td>{gross}</td><td>{leave_ded}</td>
+            <td>{ins}</td><td>{cashout}</td><td>{net}</td><td>#{run_id}</td>
+            <td>
+              <form method="post" action="/payroll/run" style="display:inline">
+                <input type="hidden" name="month" value="{month}"><input type="hidden" name="store_id" value="{key}">
+                <button type="submit">重算本店</button>
+              </form>
+              <a href="/payroll/export.csv?month={month}&store_id={key}" style="margin-left:8px">CSV</a>
+            </td>
+          </tr>
+        """)
+    if not rows:
+        html.append('<tr><td colspan="9">本月尚未計算</td></tr>')
+    html.append("</table>")
+    return "\n".join(html)
+
+@app.get('/payroll/export.csv')
+def payroll_export():
+    init_db()
+    month_start = _payroll_month_arg(request.args.get('month'))
+    store_id = request.args.get('store_id', type=int)
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(f"""
+            SELECT cur.employee_id, e.name, st.name, cur.employed_days, cur.base_salary, cur.position_allowance,
+                   cur.hourly_rate, cur.gross, cur.personal_leave_hours, cur.personal_leave_deduction,
+                   cur.sick_leave_hours, cur.sick_half_pay_hours, cur.sick_leave_deduction,
+                   cur.personal_labour, cur.personal_health, cur.leave_cashout, cur.net, cur.run_id
+              FROM ({PAYROLL_CURRENT_SQL}) cur
+              JOIN employees e ON e.id = cur.employee_id
+              LEFT JOIN stores st ON st.id = cur.store_id
+             WHERE %(store)s::int IS NULL OR COALESCE(cur.store_id, 0) = %(store)s
+             ORDER BY cur.employee_id
+        """, {'month': month_start, 'store': store_id})
+        rows = c.fetchall()
+    s = io.StringIO(); w = csv.writer(s)
+    w.writerow(['員工ID','姓名','分店','在職日數','底薪','職務津貼','時薪','應發','事假時數','事假扣款',
+                '病假時數','病假半薪時數','病假扣款','勞保自付','健保自付','特休折現','實發','run'])
+    for r in rows:
+        w.writerow(r)
+    resp = make_response('\ufeff' + s.getvalue())
+    resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    resp.headers['Content-Disposition'] = f'attachment; filename=payroll_{month_start.strftime("%Y-%m")}.csv'
+    return resp
+
+@app.get('/api/payroll/<int:emp_id>')
+def api_payroll(emp_id):
+    """GET /api/payroll/<id>?month=YYYY-MM → 該月最新一次計算的明細；history=1 附上所有 run"""
+    init_db()
+    month_start = _payroll_month_arg(request.args.get('month'))
+    with get_conn() as conn, conn.cursor(row_factory=dict_row) as c:
+        c.execute("SELECT * FROM payroll_lines WHERE employee_id=%s AND month=%s ORDER BY run_id DESC",
+                  (emp_id, month_start))
+        lines = c.fetchall()
+    if not lines:
+        return abort(404)
+    for l in lines:
+        for k, v in l.items():
+            if isinstance(v, Decimal):
+                l[k] = float(v)
+            elif isinstance(v, date):
+                l[k] = v.isoformat()
+    return jsonify({'current': lines[0], 'history': lines if request.args.get('history') == '1' else None})
+
 # -------------------------
 # 軟刪除/還原
 # -------------------------
@@ -1320,63 +4475,70 @@ def restore_employee(emp_id):
                    end_date   = NULL
              WHERE id = %s
         ''', (emp_id,))
+        # 復職：封存分區中的紀錄移回 hot 分區
+        c.execute("UPDATE leave_records SET archived = FALSE WHERE employee_id = %s AND archived", (emp_id,))
         conn.commit()
     return redirect(url_for('index', all='1'))
 
 # -------------------------
 # 特休到期提醒（到職日制）
 # -------------------------
-def _fetch_active_employees_for_expiry():
-    """抓取在職員工與計算特休剩餘（小時），並給出『最終到期日』（週年制=入職+24個月-1天）。"""
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute('''
-            SELECT
-                id, name, start_date, end_date,
-                COALESCE(entitled_leave_hours, COALESCE(entitled_leave,0)*8.0) AS ent_hours,
-                COALESCE(used_leave_hours,     COALESCE(used_leave,0)    *8.0) AS used_hours,
-                COALESCE(leave_adjust_hours, 0) AS adj_hours,
-                COALESCE(is_active, TRUE) AS is_active
-            FROM employees
-            WHERE (end_date IS NULL OR end_date >= CURRENT_DATE)
-              AND COALESCE(is_active, TRUE) = TRUE
-            ORDER BY id
-        ''')
-        rows = c.fetchall()
-
-    today = date.today()
-    result = []
-    for (eid, name, sd, ed, ent_h, used_h, adj_h, is_act) in rows:
-        sd = _ensure_date(sd)
-        if not sd:
-            continue
-
-        # 🔽 週年制：用 compute_expiry_dates 計算；以「最終到期日」為提醒基準
-        first_expiry, final_expiry = compute_expiry_dates(sd, LEAVE_POLICY)
-        expiry = final_expiry or next_anniversary(sd, today)  # 沒算到時退回原本周年日
-
-        entitled = max(float(ent_h or 0) + float(adj_h or 0), 0.0)
-        used = float(used_h or 0)
-        remaining = max(entitled - used, 0.0)
-        if remaining <= 0:
-            continue
-
-        result.append({
-            "id": eid,
-            "name": name,
-            "start_date": sd.isoformat(),
-            "expiry_date": expiry.isoformat(),
-            "days_left": days_until(expiry, today),
-            "remain_hours": round(remaining, 1)
-        })
-    return result
+def _fetch_active_employees_for_expiry(within_days=None, as_of=None):
+    """
+    在職員工各特休期別的剩餘時數與最終到期日（讀特休帳本）。
+    只取還有餘額、尚未到期（within_days：N 天內到期）的期別，走 leave_grants_open_expiry_idx；
+    同一人兩期都有餘額時各列一筆。as_of：以該日為「今天」，剩餘只扣到該日為止的扣抵/折現。
+    """
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            if as_of is None:
+                c.execute('''
+                    SELECT e.id, e.name, e.start_date, g.grant_date, g.expires_on,
+                           g.granted_hours + g.adjust_hours - g.used_hours - g.expired_hours - g.paid_out_hours
+                      FROM leave_grants g
+                      JOIN employees e ON e.id = g.employee_id
+                     WHERE g.used_hours + g.expired_hours + g.paid_out_hours < g.granted_hours + g.adjust_hours
+                       AND g.expires_on >= CURRENT_DATE
+                       AND (%s::int IS NULL OR g.expires_on <= CURRENT_DATE + %s::int)
+                       AND (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+                       AND COALESCE(e.is_active, TRUE) = TRUE
+                     ORDER BY g.expires_on, e.id
+                ''', (within_days, within_days))
+            else:
+                c.execute('''
+                    SELECT * FROM (
+                      SELECT e.id, e.name, e.start_date, g.grant_date, g.expires_on,
+                             g.granted_hours + g.adjust_hours
+                               - COALESCE((SELECT SUM(x.hours) FROM leave_grant_usage x
+                                            WHERE x.grant_id = g.id AND x.leave_date <= %(d)s), 0)
+                               - CASE WHEN g.paid_out_on <= %(d)s THEN g.paid_out_hours ELSE 0 END AS remaining
+                        FROM leave_grants g
+                        JOIN employees e ON e.id = g.employee_id
+                       WHERE g.grant_date <= %(d)s AND g.expires_on >= %(d)s
+                         AND (%(w)s::int IS NULL OR g.expires_on <= %(d)s::date + %(w)s::int)
+                         AND e.start_date <= %(d)s AND (e.end_date IS NULL OR e.end_date >= %(d)s)
+                    ) t
+                     WHERE remaining > 0
+                     ORDER BY expires_on, id
+                ''', {'d': as_of, 'w': within_days})
+            rows = c.fetchall()
+
+    today = as_of or date.today()
+    return [{
+        "id": eid,
+        "name": name,
+        "start_date": _ensure_date(sd).isoformat(),
+        "grant_date": gd.isoformat(),
+        "expiry_date": expiry.isoformat(),
+        "days_left": days_until(expiry, today),
+        "remain_hours": round(float(remaining), 1)
+    } for eid, name, sd, gd, expiry, remaining in rows]
 
 
 @app.route('/alerts/leave-expiring')
 def leave_expiring():
     init_db()
-    data = _fetch_active_employees_for_expiry()
-    data = [d for d in data if 0 <= d["days_left"] <= ALERT_WINDOW_DAYS]
-    data.sort(key=lambda x: x["days_left"])
+    data = _fetch_active_employees_for_expiry(ALERT_WINDOW_DAYS)
 
     html_rows = []
     for d in data:
@@ -1535,7 +4697,6 @@ def add_branch():
     with get_conn() as conn, conn.cursor() as c:
         c.execute("INSERT INTO stores (name, short_code, is_active) VALUES (%s,%s,TRUE) RETURNING id;", (name, short_code))
         new_id = c.fetchone()[0]
-        conn.commit()
         write_audit(conn, 'stores', new_id, 'insert', None, {'name': name, 'short_code': short_code, 'is_active': True})
     return redirect(url_for('branch_management'))
 
@@ -1550,7 +4711,6 @@ def toggle_branch(store_id: int):
         active, name, code = row
         before = {'name': name, 'short_code': code, 'is_active': bool(active)}
         c.execute("UPDATE stores SET is_active = NOT COALESCE(is_active, TRUE) WHERE id=%s;", (store_id,))
-        conn.commit()
         c.execute("SELECT is_active FROM stores WHERE id=%s;", (store_id,))
         now_active = c.fetchone()[0]
         write_audit(conn, 'stores', store_id, 'update', before, {'is_active': bool(now_active)})
@@ -1570,7 +4730,6 @@ def rename_branch(store_id: int):
             return abort(404)
         before = {'name': row[0], 'short_code': row[1], 'is_active': bool(row[2])}
         c.execute("UPDATE stores SET name=%s, short_code=%s WHERE id=%s;", (name, short_code, store_id))
-        conn.commit()
         write_audit(conn, 'stores', store_id, 'update', before, {'name': name, 'short_code': short_code})
     return redirect(url_for('branch_management'))
 
@@ -1578,11 +4737,10 @@ def rename_branch(store_id: int):
 @app.route('/alerts/leave-expiring/json')
 def leave_expiring_json():
     init_db()
-    data = _fetch_active_employees_for_expiry()
-    data = [d for d in data if 0 <= d["days_left"] <= ALERT_WINDOW_DAYS]
-    data.sort(key=lambda x: x["days_left"])
+    as_of = _parse_as_of()
+    data = _fetch_active_employees_for_expiry(ALERT_WINDOW_DAYS, as_of)
     return jsonify({
-        "today": date.today().isoformat(),
+        "today": (as_of or date.today()).isoformat(),
         "alert_within_days": ALERT_WINDOW_DAYS,
         "count": len(data),
         "items": data
@@ -1591,12 +4749,81 @@ def leave_expiring_json():
 # -------------------------
 # 月結報表（ZIP：請假彙總/員工清單/保險）
 # -------------------------
-@app.get('/reports')
-def monthly_reports():
-    init_db()
-    month = request.args.get('month')
-    if not month:
-        month = date.today().strftime('%Y-%m')
+def _monthly_leave_allocation(conn, month_start, next_month, emp_ids=None):
+    """
+    [month_start, next_month) 的請假時數彙總，回傳 [(員工ID, 姓名, 假別, 時數)]；emp_ids 只算這些員工。
+    只取日期區間與本月相交的假單（date_from < 月底 做分區裁剪，daterange && 走 GiST 索引）；
+    跨月假單依工作日比例分攤（整段都沒有工作日時改用日曆天），
+    以「累計比例四捨五入後相減」分配，各月加總必等於原時數。
+    """
+    with conn.cursor() as c:
+        c.execute(f"""
+          SELECT e.id, e.name, e.store_id, lr.leave_type, lr.date_from, lr.date_to, COALESCE(lr.hours, 0)
+            FROM leave_records lr
+            JOIN employees e ON e.id = lr.employee_id
+           WHERE lr.status='approved' AND COALESCE(lr.deleted,FALSE)=FALSE
+             AND lr.date_from < %s
+             AND daterange(lr.date_from, lr.date_to, '[]') && daterange(%s::date, %s::date)
+             {"AND lr.employee_id = ANY(%s)" if emp_ids is not None else ""}
+        """, (next_month, month_start, next_month) + ((list(emp_ids),) if emp_ids is not None else ()))
+        rows = c.fetchall()
+
+    month_end = next_month - timedelta(days=1)
+    cache, totals = {}, {}
+    for emp_id, name, store_id, leave_type, df, dt, hours in rows:
+        if month_start <= df and dt <= month_end:
+            part = hours
+        else:
+            total, _ = _business_hours(conn, store_id, df, dt, cache)
+            before, _ = _business_hours(conn, store_id, df, month_start - timedelta(days=1), cache) if df < month_start else (0, 0)
+            inside, _ = _business_hours(conn, store_id, max(df, month_start), min(dt, month_end), cache)
+            if total == 0:
+                total = (dt - df).days + 1
+                before = max((month_start - df).days, 0)
+                inside = (min(dt, month_end) - max(df, month_start)).days + 1
+            q = Decimal('0.1')
+            part = ((hours * (before + inside) / total).quantize(q)
+                    - (hours * before / total).quantize(q))
+        key = (emp_id, name, leave_type)
+        totals[key] = totals.get(key, Decimal('0')) + part
+    return [(k[0], k[1], k[2], v) for k, v in sorted(totals.items(), key=lambda kv: (kv[0][0], kv[0][2])) if v]
+
+class CsvZipWriter:
+    """與 XlsxWriter 相同介面：每個 sheet 寫成 ZIP 內一個 CSV（UTF-8 BOM），逐列壓縮寫入。"""
+
+    def __init__(self, fileobj):
+        self._zf = zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    @contextmanager
+    def sheet(self, name, header=()):
+        with self._zf.open(f'{name}.csv', mode='w', force_zip64=True) as raw, \
+                io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+            w = csv.writer(text)
+            if header:
+                w.writerow(header)
+            yield w
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+REPORT_FORMATS = {
+    # format → (writer, 副檔名, mimetype)
+    'csv':  (CsvZipWriter, 'zip', 'application/zip'),
+    'xlsx': (XlsxWriter, 'xlsx', XLSX_MIMETYPE),
+}
+
+def _build_monthly_report(book, conn, month, progress=lambda pct, msg=None: None):
+    """
+    月結報表寫入 book（CsvZipWriter / XlsxWriter）：請假彙總/員工清單/保險/假單時數不符，各一張表。
+    員工與保險以具名 cursor 逐批讀出直接寫入，不把整張表載入記憶體。
+    """
     start = f'{month}-01'
     y, m = map(int, month.split('-'))
     if m == 12:
@@ -1604,42 +4831,31 @@ def monthly_reports():
     else:
         next_month = f'{y}-{m+1:02d}-01'
 
-    buf = io.BytesIO()
-    zf = zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED)
-
-    with get_conn() as conn, conn.cursor() as c:
-        # 1) 本月請假彙總（approved）
-        c.execute("""
-          SELECT e.id, e.name, lr.leave_type,
-                 COALESCE(SUM(lr.hours),0) AS total_hours
-            FROM leave_records lr
-            JOIN employees e ON e.id = lr.employee_id
-           WHERE lr.status='approved'
-             AND lr.date_from >= %s AND lr.date_from < %s
-           GROUP BY e.id, e.name, lr.leave_type
-           ORDER BY e.id, lr.leave_type
-        """, (start, next_month))
-        rows = c.fetchall()
-        s = io.StringIO(); w = csv.writer(s)
-        w.writerow(['員工ID','姓名','假別','本月合計(小時)'])
-        for r in rows:
-            w.writerow(r)
-        zf.writestr('leave_summary.csv', '\ufeff' + s.getvalue())
-
-        # 2) 當月在職員工清單
+    # 1) 本月請假彙總（approved；跨月假單依工作日分攤）
+    progress(5, '請假彙總')
+    rows = _monthly_leave_allocation(conn, date.fromisoformat(start), date.fromisoformat(next_month))
+    with book.sheet('leave_summary', ['員工ID','姓名','假別','本月合計(小時)']) as w:
+        w.writerows(rows)
+
+    # 2) 當月在職員工清單
+    progress(40, '員工清單')
+    with book.sheet('employees', ['ID','姓名','部門','職等','薪資級距','底薪','職務津貼','到職日','離職日','分店ID']) as w, \
+            conn.cursor(name='report_employees') as c:
+        c.itersize = EXPORT_BATCH_SIZE
         c.execute("""
           SELECT id, name, department, job_level, salary_grade, base_salary, position_allowance, start_date, end_date, store_id
             FROM employees
            WHERE (end_date IS NULL OR end_date >= %s)
            ORDER BY id
         """, (start,))
-        s = io.StringIO(); w = csv.writer(s)
-        w.writerow(['ID','姓名','部門','職等','薪資級距','底薪','職務津貼','到職日','離職日','分店ID'])
-        for r in c.fetchall():
+        for r in c:
             w.writerow(r)
-        zf.writestr('employees.csv', '\ufeff' + s.getvalue())
 
-        # 3) 保險負擔（在職）
+    # 3) 保險負擔（在職）
+    progress(55, '保險負擔')
+    with book.sheet('insurances', ['ID','姓名','個人勞保','個人健保','公司勞保','公司健保','退6%','職保','公司負擔合計','備註']) as w, \
+            conn.cursor(name='report_insurances') as c:
+        c.itersize = EXPORT_BATCH_SIZE
         c.execute("""
           SELECT e.id, e.name,
                  i.personal_labour, i.personal_health,
@@ -1650,48 +4866,1413 @@ def monthly_reports():
            WHERE (e.end_date IS NULL OR e.end_date >= %s)
            ORDER BY e.id
         """, (start,))
-        s = io.StringIO(); w = csv.writer(s)
-        w.writerow(['ID','姓名','個人勞保','個人健保','公司勞保','公司健保','退6%','職保','公司負擔合計','備註'])
-        for r in c.fetchall():
+        for r in c:
             w.writerow(r)
-        zf.writestr('insurances.csv', '\ufeff' + s.getvalue())
 
-    zf.close()
-    buf.seek(0)
+    # 4) 本月假單時數與工作日曆不符（多扣 / 區間內有整天沒扣）
+    progress(70, '假單時數比對')
+    with book.sheet('leave_hours_mismatch',
+                    ['假單ID','員工ID','姓名','假別','開始日','結束日','登記時數','工作日數','應扣時數']) as w:
+        for m in _leave_hours_mismatches(conn, start, next_month):
+            w.writerow([m['id'], m['employee_id'], m['name'], m['leave_type'], m['date_from'], m['date_to'],
+                        m['hours'], m['business_days'], m['expected_hours']])
+
+def _build_backup(book, conn, progress=lambda pct, msg=None: None):
+    """全庫備份（每表一個 CSV）寫入 book；具名 cursor 逐批讀，大表不整張載入。"""
+    tables = ['stores', 'store_departments', 'employees', 'insurances', 'leave_records', 'audit_logs']
+    # audit_logs 只會讀到仍掛在主表上的分區；已卸離封存（audit-archive）的月份不在備份內
+    for i, t in enumerate(tables):
+        progress(int(i * 100 / len(tables)), t)
+        with conn.cursor(name=f'backup_{t}') as c:
+            c.itersize = EXPORT_BATCH_SIZE
+            c.execute(f"SELECT * FROM {t}")
+            with book.sheet(t, [desc[0] for desc in c.description]) as w:
+                for row in c:
+                    w.writerow([json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v
+                                for v in row])
+
+def _report_touched_since(conn, month_start, version, generated_at):
+    """
+    產生後（id > version）是否有稽核紀錄觸及該月報表的內容：
+      • leave_records：假單現在或變更前的日期區間與該月相交
+      • employees / insurances：該月在職（或離職日被改過）的員工
+      • 工作日曆/分店排班：影響跨月分攤與時數比對，一律視為觸及
+    只掃 generated_at 之後的稽核分區（往前留 1 分鐘給交易先後順序）。
+    """
+    next_month = _add_months(month_start, 1)
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT 1
+              FROM audit_logs a
+              LEFT JOIN leave_records lr ON a.table_name = 'leave_records' AND lr.id = a.row_id
+              LEFT JOIN insurances i ON a.table_name = 'insurances' AND i.id = a.row_id
+              LEFT JOIN employees e ON e.id = CASE a.table_name WHEN 'employees' THEN a.row_id
+                                                                WHEN 'insurances' THEN i.employee_id END
+             WHERE a.acted_at >= %(since)s - INTERVAL '1 minute' AND a.id > %(version)s
+               AND (
+                 (a.table_name = 'leave_records' AND (
+                    daterange(lr.date_from, lr.date_to, '[]') && daterange(%(ms)s, %(next)s)
+                    OR (a.before_json ?| ARRAY['date_from', 'date_to'] AND daterange(
+                          COALESCE((a.before_json->>'date_from')::date, lr.date_from),
+                          COALESCE((a.before_json->>'date_to')::date, lr.date_to), '[]') && daterange(%(ms)s, %(next)s))))
+                 OR (a.table_name IN ('employees', 'insurances') AND a.row_id <> 0
+                     AND (e.end_date IS NULL OR e.end_date >= %(ms)s OR a.before_json ? 'end_date'))
+                 OR a.table_name IN ('work_calendar_days', 'store_work_schedules')
+               )
+             LIMIT 1
+        """, {'since': generated_at, 'version': version, 'ms': month_start, 'next': next_month})
+        return c.fetchone() is not None
+
+def _cached_report(conn, month_start, fmt='csv'):
+    """仍有效的快取 (version, path, name)；沒有或已過期回傳 None。"""
+    with conn.cursor() as c:
+        c.execute("SELECT version, generated_at, path, name FROM report_cache WHERE month=%s AND format=%s",
+                  (month_start, fmt))
+        row = c.fetchone()
+    if not row or not os.path.exists(row[2]):
+        return None
+    version, generated_at, path, name = row
+    if _report_touched_since(conn, month_start, version, generated_at):
+        return None
+    return version, path, name
+
+@app.get('/reports')
+def monthly_reports():
+    """
+    月結報表：快取有效時直接回傳檔案（ETag = 月份+資料版本，可 304）；
+    沒有或已被回溯異動 → 排入背景工作（同月份同格式已在排隊/執行就沿用），導向進度頁。refresh=1 強制重產。
+    format=xlsx：一個活頁簿、每張表一個工作表（預設 csv = ZIP 內多個 CSV）。
+    """
+    init_db()
+    fmt = request.args.get('format', 'csv')
+    if fmt not in REPORT_FORMATS:
+        abort(400, description='format 需為 csv 或 xlsx')
+    month = request.args.get('month')
+    if not month:
+        month = date.today().strftime('%Y-%m')
+    try:
+        month_start = datetime.strptime(month, '%Y-%m').date()
+    except ValueError:
+        abort(400, description='month 格式需為 YYYY-MM')
     with get_conn() as conn:
-        write_audit(conn, 'reports', 0, 'report', None, {'month': month})
-    return send_file(buf, mimetype='application/zip', as_attachment=True,
-                     download_name=f'reports_{month}.zip')
+        cached = None if request.args.get('refresh') == '1' else _cached_report(conn, month_start, fmt)
+        if cached:
+            version, path, name = cached
+            resp = send_file(path, mimetype=REPORT_FORMATS[fmt][2], as_attachment=True, download_name=name,
+                             etag=f'{month}-{fmt}-{version}', conditional=True)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT id FROM jobs
+                 WHERE kind = 'monthly_report' AND params->>'month' = %s
+                   AND COALESCE(params->>'format', 'csv') = %s AND status IN ('queued', 'running')
+                 ORDER BY id LIMIT 1
+            """, (month, fmt))
+            row = c.fetchone()
+        job_id = row[0] if row else _enqueue_job(conn, 'monthly_report', {'month': month, 'format': fmt})
+    return redirect(url_for('job_page', job_id=job_id))
 
 # -------------------------
 # 全庫備份（CSV ZIP）
 # -------------------------
 @app.get('/admin/backup')
 def admin_backup():
+    """全庫備份改為背景工作；下載時同樣需要 token。"""
     init_db()
     if BACKUP_TOKEN and request.args.get('token') != BACKUP_TOKEN:
         return abort(403)
+    with get_conn() as conn:
+        job_id = _enqueue_job(conn, 'backup', {})
+    return redirect(url_for('job_page', job_id=job_id, token=request.args.get('token')))
 
-    tables = ['stores', 'store_departments', 'employees', 'insurances', 'leave_records', 'audit_logs']
-    buf = io.BytesIO()
-    zf = zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED)
+# -------------------------
+# 背景工作：jobs 表 + `flask job-worker`（SKIP LOCKED 取件、進度、重試、取消）
+# -------------------------
+class JobCancelled(Exception):
+    pass
+
+class JobLost(Exception):
+    """這次取件已失效（逾時被重新排隊/改派）：停止執行，不再動 jobs 列。"""
+
+def _job_format(job):
+    fmt = (job['params'] or {}).get('format', 'csv')
+    return fmt if fmt in REPORT_FORMATS else 'csv'
+
+def _job_result_path(job):
+    return os.path.join(JOB_OUTPUT_DIR, f"job_{job['id']}.{REPORT_FORMATS[_job_format(job)][1]}")
+
+def _job_tmp_path(job):
+    """每次取件各自的暫存檔（worker + 第幾次嘗試），逾時的舊 worker 不會和新 worker 寫同一個檔。"""
+    claim = f"{job['locked_by']}.{job['attempts']}".replace(os.sep, '_')
+    return f"{_job_result_path(job)}.{claim}.part"
+
+def _job_monthly_report(job, f, conn, progress):
+    month = job['params']['month']
+    fmt = _job_format(job)
+    writer, ext, _ = REPORT_FORMATS[fmt]
+    with conn.cursor() as c:
+        # 版本取在查資料之前：產生期間的異動 id 一定較大，下次會被判定過期
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM audit_logs")
+        version = c.fetchone()[0]
+    with writer(f) as book:
+        _build_monthly_report(book, conn, month, progress)
+    name = f"reports_{month}.{ext}"
+    with conn.cursor() as c:
+        c.execute("""
+            INSERT INTO report_cache (month, format, version, generated_at, job_id, path, name)
+            VALUES (%s, %s, %s, NOW(), %s, %s, %s)
+            ON CONFLICT (month, format) DO UPDATE
+               SET version = EXCLUDED.version, generated_at = EXCLUDED.generated_at,
+                   job_id = EXCLUDED.job_id, path = EXCLUDED.path, name = EXCLUDED.name
+        """, (datetime.strptime(month, '%Y-%m').date(), fmt, version, job['id'], _job_result_path(job), name))
+    return name
+
+def _job_backup(job, f, conn, progress):
+    with CsvZipWriter(f) as book:
+        _build_backup(book, conn, progress)
+    return f'backup_{date.today().isoformat()}.zip'
+
+# kind → (handler, 稽核 table/action)；handler(job, f, conn, progress) 寫入二進位檔 f，回傳下載檔名
+JOB_HANDLERS = {
+    'monthly_report': (_job_monthly_report, 'reports', 'report'),
+    'backup':         (_job_backup, 'backup', 'backup'),
+}
+
+def _enqueue_job(conn, kind, params):
+    with conn.cursor() as c:
+        c.execute("""
+            INSERT INTO jobs (kind, params, max_attempts, created_by) VALUES (%s, %s::jsonb, %s, %s) RETURNING id
+        """, (kind, json.dumps(params, ensure_ascii=False), JOB_MAX_ATTEMPTS, getattr(g, 'current_user', None)))
+        job_id = c.fetchone()[0]
+    conn.commit()
+    return job_id
 
+def _claim_job(conn, worker_id):
+    """
+    先把心跳逾時的 running 放回佇列（次數已用完的直接 failed），再以 FOR UPDATE SKIP LOCKED 取一件；
+    多個 worker 不會拿到同一件。
+    """
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute("""
+            UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                            locked_by = NULL,
+                            message = CASE WHEN attempts >= max_attempts THEN 'worker 逾時，已達重試上限'
+                                           ELSE 'worker 逾時，重新排隊' END,
+                            error = CASE WHEN attempts >= max_attempts THEN 'worker 逾時' ELSE error END,
+                            finished_at = CASE WHEN attempts >= max_attempts THEN NOW() ELSE finished_at END
+             WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s)
+        """, (JOB_STALE_SECONDS,))
+        c.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = %s,
+                            heartbeat_at = NOW(), started_at = COALESCE(started_at, NOW()), progress = 0, error = NULL
+             WHERE id = (
+               SELECT id FROM jobs
+                WHERE status = 'queued' AND run_after <= NOW() AND NOT cancel_requested
+                ORDER BY run_after, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+             )
+            RETURNING id, kind, params, attempts, max_attempts, created_by, locked_by
+        """, (worker_id,))
+        job = c.fetchone()
+    conn.commit()
+    return job
+
+def _run_job(job):
+    """
+    執行一件工作：進度/心跳用獨立連線（autocommit）回報，並在回報點檢查是否被要求取消。
+    對 jobs 列的更新都帶 locked_by = 本次取件者；取件已被逾時回收就停手（JobLost），不覆寫新 worker 的狀態與結果。
+    """
+    handler, audit_table, audit_action = JOB_HANDLERS[job['kind']]
+    os.makedirs(JOB_OUTPUT_DIR, exist_ok=True)
+    path = _job_result_path(job)
+    tmp = _job_tmp_path(job)
+    claim = (job['id'], job['locked_by'])
+    with get_conn() as pconn, get_conn() as conn:
+        pconn.autocommit = True
+
+        def progress(pct, msg=None):
+            with pconn.cursor() as c:
+                c.execute("""
+                    UPDATE jobs SET progress=%s, message=%s, heartbeat_at=NOW()
+                     WHERE id=%s AND locked_by=%s AND status='running'
+                    RETURNING cancel_requested
+                """, (pct, msg) + claim)
+                row = c.fetchone()
+                if row is None:
+                    raise JobLost()
+                if row[0]:
+                    raise JobCancelled()
+
+        try:
+            with open(tmp, 'wb') as f:
+                name = handler(job, f, conn, progress)
+            progress(100, '完成')
+            # 先鎖住並改成 done、搬好檔案再 commit：確認仍是本次取件才覆蓋結果檔
+            with pconn.transaction(), pconn.cursor() as c:
+                c.execute("""
+                    UPDATE jobs SET status='done', progress=100, result_path=%s, result_name=%s, finished_at=NOW()
+                     WHERE id=%s AND locked_by=%s AND status='running'
+                    RETURNING id
+                """, (path, name) + claim)
+                if c.fetchone() is None:
+                    raise JobLost()
+                os.replace(tmp, path)
+            write_audit(conn, audit_table, 0, audit_action, None,
+                        dict(job['params'], job_id=job['id']), acted_by=job['created_by'])
+            return 'done'
+        except JobLost:
+            conn.rollback()
+            return 'lost'
+        except JobCancelled:
+            conn.rollback()
+            with pconn.cursor() as c:
+                c.execute("""
+                    UPDATE jobs SET status='cancelled', message='已取消', finished_at=NOW()
+                     WHERE id=%s AND locked_by=%s AND status='running'
+                """, claim)
+            return 'cancelled'
+        except Exception as e:
+            # 失敗：次數未滿 → 指數退避後重新排隊；滿了 → failed
+            conn.rollback()
+            retry = job['attempts'] < job['max_attempts']
+            with pconn.cursor() as c:
+                c.execute("""
+                    UPDATE jobs SET status=%s, error=%s, locked_by=NULL,
+                                    run_after = NOW() + make_interval(secs => %s),
+                                    finished_at = CASE WHEN %s THEN NULL ELSE NOW() END
+                     WHERE id=%s AND locked_by=%s AND status='running'
+                """, ('queued' if retry else 'failed', f'{type(e).__name__}: {e}',
+                      30 * 2 ** (job['attempts'] - 1), retry) + claim)
+            return 'retry' if retry else 'failed'
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+def _job_json(row):
+    return {k: (v.isoformat() if isinstance(v, datetime) else v)
+            for k, v in row.items() if k not in ('result_path',)}
+
+def _fetch_job(conn, job_id):
+    with conn.cursor(row_factory=dict_row) as c:
+        c.execute("SELECT * FROM jobs WHERE id=%s", (job_id,))
+        job = c.fetchone()
+    if not job:
+        abort(404)
+    return job
+
+def _check_job_token(job):
+    if job['kind'] == 'backup' and BACKUP_TOKEN and request.values.get('token') != BACKUP_TOKEN:
+        abort(403)
+
+@app.post('/api/jobs')
+def api_enqueue_job():
+    """POST /api/jobs  {"kind": "monthly_report", "params": {"month": "2025-06", "format": "xlsx"}} → 202 + job id"""
+    init_db()
+    body = request.get_json(silent=True) or {}
+    kind, params = body.get('kind'), body.get('params') or {}
+    if kind not in JOB_HANDLERS:
+        abort(400, description=f'kind 需為 {", ".join(JOB_HANDLERS)}')
+    if kind == 'monthly_report':
+        try:
+            datetime.strptime(params.get('month') or '', '%Y-%m')
+        except ValueError:
+            abort(400, description='params.month 格式需為 YYYY-MM')
+        if params.get('format', 'csv') not in REPORT_FORMATS:
+            abort(400, description='params.format 需為 csv 或 xlsx')
+    if kind == 'backup' and BACKUP_TOKEN and body.get('token') != BACKUP_TOKEN:
+        abort(403)
+    with get_conn() as conn:
+        job_id = _enqueue_job(conn, kind, params)
+    return jsonify({'id': job_id, 'status': 'queued', 'status_url': url_for('api_job', job_id=job_id)}), 202
+
+@app.get('/api/jobs/<int:job_id>')
+def api_job(job_id):
+    init_db()
+    with get_conn() as conn:
+        job = _fetch_job(conn, job_id)
+    out = _job_json(job)
+    if job['status'] == 'done':
+        out['download_url'] = url_for('job_download', job_id=job_id)
+    return jsonify(out)
+
+@app.post('/api/jobs/<int:job_id>/cancel')
+def api_cancel_job(job_id):
+    """排隊中直接取消；執行中設旗標，worker 在下一個進度點停止。"""
+    init_db()
     with get_conn() as conn, conn.cursor() as c:
-        for t in tables:
-            c.execute(f"SELECT * FROM {t}")
-            colnames = [desc[0] for desc in c.description]
-            s = io.StringIO(); w = csv.writer(s)
-            w.writerow(colnames)
-            for row in c.fetchall():
-                w.writerow(row)
-            zf.writestr(f'{t}.csv', '\ufeff' + s.getvalue())
-
-    zf.close()
-    buf.seek(0)
+        c.execute("""
+            UPDATE jobs SET cancel_requested = TRUE,
+                            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                            finished_at = CASE WHEN status = 'queued' THEN NOW() ELSE finished_at END
+             WHERE id = %s AND status IN ('queued', 'running')
+            RETURNING status
+        """, (job_id,))
+        row = c.fetchone()
+        conn.commit()
+        if row is None:
+            _fetch_job(conn, job_id)
+            abort(409, description='工作已結束，無法取消')
+    if request.form.get('redirect'):
+        return redirect(url_for('job_page', job_id=job_id))
+    return jsonify({'id': job_id, 'status': row[0], 'cancel_requested': True})
+
+@app.get('/jobs/<int:job_id>/download')
+def job_download(job_id):
+    init_db()
+    with get_conn() as conn:
+        job = _fetch_job(conn, job_id)
+    _check_job_token(job)
+    if job['status'] != 'done' or not job['result_path'] or not os.path.exists(job['result_path']):
+        abort(404, description='結果尚未產生或已清除')
+    mimetype = {ext: mt for _, ext, mt in REPORT_FORMATS.values()}.get(
+        job['result_name'].rsplit('.', 1)[-1], 'application/octet-stream')
+    return send_file(job['result_path'], mimetype=mimetype, as_attachment=True, download_name=job['result_name'])
+
+@app.get('/jobs/<int:job_id>')
+def job_page(job_id):
+    """進度頁：未結束前每 3 秒自動重新整理。"""
+    init_db()
+    with get_conn() as conn:
+        job = _fetch_job(conn, job_id)
+    _check_job_token(job)
+    token = f"?token={quote(request.args['token'])}" if request.args.get('token') else ''
+    running = job['status'] in ('queued', 'running')
+    html = ['<meta charset="utf-8">']
+    if running:
+        html.append('<meta http-equiv="refresh" content="3">')
+    # 錯誤訊息/進度說明/參數可能含使用者輸入，一律跳脫後再組 HTML
+    html.append(f"<h1>背景工作 #{job['id']}（{escape(job['kind'])}）</h1>")
+    html.append('<a href="/jobs">← 全部工作</a><br><br>')
+    html.append(f"狀態：<b>{escape(job['status'])}</b>　進度：{job['progress']}%　{escape(job['message'] or '')}<br>")
+    html.append(f"嘗試：{job['attempts']}/{job['max_attempts']}　建立：{job['created_at']:%Y-%m-%d %H:%M:%S}<br>")
+    if job['error']:
+        html.append(f"<pre>{escape(job['error'])}</pre>")
+    if job['status'] == 'done':
+        html.append(f'<br><a href="/jobs/{job_id}/download{token}">下載 {escape(job["result_name"])}</a>')
+    if running:
+        html.append(f"""
+        <form method="post" action="/api/jobs/{job_id}/cancel" style="margin-top:12px">
+          <input type="hidden" name="redirect" value="1">
+          <button type="submit">取消</button>
+        </form>
+        """)
+    return "\n".join(html)
+
+@app.get('/jobs')
+def job_list():
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT id, kind, params, status, progress, attempts, created_by, created_at, finished_at
+              FROM jobs ORDER BY created_at DESC, id DESC LIMIT 100
+        """)
+        rows = c.fetchall()
+    html = ['<meta charset="utf-8"><h1>背景工作</h1>', '<a href="/">← 返回</a><br><br>']
+    html.append("<table border=1 cellpadding=6><tr><th>ID</th><th>種類</th><th>參數</th><th>狀態</th>"
+                "<th>進度</th><th>嘗試</th><th>建立者</th><th>建立</th><th>完成</th></tr>")
+    for jid, kind, params, status, pct, attempts, by, created, finished in rows:
+        html.append(f"""
+          <tr>
+            <td><a href="/jobs/{jid}">#{jid}</a></td><td>{escape(kind)}</td><td>{escape(json.dumps(params, ensure_ascii=False))}</td>
+            <td>{escape(status)}</td><td>{pct}%</td><td>{attempts}</td><td>{escape(by or '')}</td>
+            <td>{created:%Y-%m-%d %H:%M}</td><td>{f'{finished:%Y-%m-%d %H:%M}' if finished else ''}</td>
+          </tr>
+        """)
+    html.append("</table>")
+    return "\n".join(html)
+
+# -------------------------
+# 稽核紀錄查詢（篩選 + keyset 分頁）
+# -------------------------
+@app.get('/api/audit')
+def api_audit():
+    """
+    GET /api/audit?table=&row_id=&user=&action=&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD&limit=50&cursor=
+    依 (acted_at, id) 由新到舊；回傳 next_cursor 供下一頁使用。日期條件可讓 PostgreSQL 只掃相關月份分區。
+    """
+    init_db()
+    args = request.args
+    try:
+        limit = max(min(int(args.get('limit', '50')), 500), 1)
+        row_id = int(args['row_id']) if args.get('row_id') else None
+        d_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') else None
+        d_to   = datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else None
+        cursor = None
+        if args.get('cursor'):
+            ts, cid = args['cursor'].rsplit('|', 1)
+            cursor = (datetime.fromisoformat(ts), int(cid))
+    except (ValueError, KeyError):
+        return abort(400, description='參數格式錯誤')
+
+    where, params = [], []
+    if args.get('table'):
+        where.append("table_name = %s"); params.append(args['table'])
+    if row_id is not None:
+        where.append("row_id = %s"); params.append(row_id)
+    if args.get('user'):
+        where.append("acted_by = %s"); params.append(args['user'])
+    if args.get('action'):
+        where.append("action = %s"); params.append(args['action'])
+    if d_from:
+        where.append("acted_at >= %s"); params.append(d_from)
+    if d_to:
+        where.append("acted_at < %s"); params.append(d_to + timedelta(days=1))
+    if cursor:
+        where.append("(acted_at, id) < (%s, %s)"); params.extend(cursor)
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(f"""
+            SELECT id, table_name, row_id, action, before_json, after_json, acted_by, acted_at
+              FROM audit_logs
+              {where_sql}
+             ORDER BY acted_at DESC, id DESC
+             LIMIT %s
+        """, tuple(params) + (limit + 1,))
+        rows = c.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{
+        'id': r[0], 'table': r[1], 'row_id': r[2], 'action': r[3],
+        'before': r[4] or {}, 'after': r[5] or {},
+        'acted_by': r[6], 'acted_at': r[7].isoformat(sep=' ', timespec='seconds'),
+    } for r in rows]
+    next_cursor = f"{rows[-1][7].isoformat()}|{rows[-1][0]}" if has_more else None
+    return jsonify({'count': len(items), 'items': items, 'next_cursor': next_cursor})
+
+# -------------------------
+# 變更 feed（下游同步用）：依 (txid, id) keyset 由舊到新，只回傳已確定提交完成的交易
+# -------------------------
+CHANGE_FEED_TABLES = ('employees', 'stores', 'insurances', 'leave_records')
+# 稽核 action → 事件類型（approve/reject/cancel/recalc… 都是 update；假單刪除為軟刪，仍回傳 delete）
+CHANGE_FEED_OPS = {'insert': 'insert', 'delete': 'delete'}
+
+@app.get('/api/changes')
+def api_changes():
+    """
+    GET /api/changes?since=<cursor>&tables=employees,leave_records&limit=500
+    回傳 since 之後的 insert/update/delete 事件（before/after 為變動欄位，row 為該列目前內容，已刪除為 null）。
+    next_cursor 一律回傳（沒有新事件時等於 since），下次帶回即可續讀；has_more 為 true 時可立刻再取。
+    只回傳 txid < 目前快照 xmin 的紀錄：比它小的交易都已結束，之後不會再冒出排在游標前面的事件。
+    游標比 audit_logs 保留期（audit-archive 卸離的月份）還舊時，請先用備份全量同步。
+    """
+    init_db()
+    args = request.args
+    try:
+        limit = max(min(int(args.get('limit', '500')), 5000), 1)
+        since = ('0', 0)
+        if args.get('since'):
+            txid, cid = args['since'].split('|', 1)
+            since = (str(int(txid)), int(cid))
+    except ValueError:
+        return abort(400, description='since 格式錯誤')
+    tables = [t for t in (args.get('tables') or '').split(',') if t] or list(CHANGE_FEED_TABLES)
+    if any(t not in CHANGE_FEED_TABLES for t in tables):
+        return abort(400, description=f'tables 只能是 {", ".join(CHANGE_FEED_TABLES)}')
+
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT a.txid::text, a.id, a.table_name, a.row_id, a.action, a.before_json, a.after_json,
+                   a.acted_by, a.acted_at,
+                   CASE a.table_name
+                     WHEN 'employees'     THEN (SELECT to_jsonb(x) FROM employees x WHERE x.id = a.row_id)
+                     WHEN 'stores'        THEN (SELECT to_jsonb(x) FROM stores x WHERE x.id = a.row_id)
+                     WHEN 'insurances'    THEN (SELECT to_jsonb(x) FROM insurances x WHERE x.id = a.row_id)
+                     WHEN 'leave_records' THEN (SELECT to_jsonb(x) FROM leave_records x
+                                                 WHERE x.id = a.row_id AND NOT COALESCE(x.deleted, FALSE))
+                   END
+              FROM audit_logs a
+             WHERE (a.txid, a.id) > (%s::xid8, %s)
+               AND a.txid < pg_snapshot_xmin(pg_current_snapshot())
+               AND a.table_name = ANY(%s) AND a.row_id <> 0
+             ORDER BY a.txid, a.id
+             LIMIT %s
+        """, (since[0], since[1], tables, limit + 1))
+        rows = c.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{
+        'cursor': f'{r[0]}|{r[1]}', 'id': r[1], 'table': r[2], 'row_id': r[3],
+        'op': CHANGE_FEED_OPS.get(r[4], 'update'), 'action': r[4],
+        'before': r[5] or {}, 'after': r[6] or {}, 'row': r[9],
+        'acted_by': r[7], 'acted_at': r[8].isoformat(sep=' ', timespec='seconds'),
+    } for r in rows]
+    next_cursor = items[-1]['cursor'] if items else f'{since[0]}|{since[1]}'
+    return jsonify({'count': len(items), 'items': items, 'next_cursor': next_cursor, 'has_more': has_more})
+
+# -------------------------
+# 維運指令（flask --app app <command>）
+# -------------------------
+@app.cli.command('audit-archive')
+@click.option('--before', 'before_month', required=True, help='YYYY-MM；此月份（不含）以前的分區卸離')
+def audit_archive_command(before_month):
+    """把舊月份的 audit_logs 分區卸離並移到 audit_archive schema（可另行 pg_dump 後刪除）。"""
+    cutoff = datetime.strptime(before_month, '%Y-%m').date()
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT ch.relname
+              FROM pg_inherits i
+              JOIN pg_class ch ON ch.oid = i.inhrelid
+             WHERE i.inhparent = 'audit_logs'::regclass
+             ORDER BY ch.relname
+        """)
+        names = [r[0] for r in c.fetchall()]
+        c.execute(f"CREATE SCHEMA IF NOT EXISTS {AUDIT_ARCHIVE_SCHEMA}")
+        for name in names:
+            if not name.startswith('audit_logs_y'):
+                continue  # DEFAULT 分區不動
+            y, m = name[len('audit_logs_y'):].split('m')
+            if date(int(y), int(m), 1) >= cutoff:
+                continue
+            c.execute(f"ALTER TABLE audit_logs DETACH PARTITION {name}")
+            c.execute(f"ALTER TABLE {name} SET SCHEMA {AUDIT_ARCHIVE_SCHEMA}")
+            conn.commit()
+            click.echo(f"detached {name} → {AUDIT_ARCHIVE_SCHEMA}.{name}")
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """建立/補齊 HOT_INDEXES（CONCURRENTLY，可在上線中執行、可重跑）。"""
+    init_db()
+    with get_conn() as conn:
+        conn.autocommit = True
+        ensure_hot_indexes(conn, echo=click.echo)
+
+# 熱點查詢（與各路由的 SQL 同形）；%(name)s 以資料庫中的樣本值代入
+PLAN_CHECKS = [
+    ('overview_count', """
+        SELECT COUNT(*) FROM employees e
+         WHERE (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+           AND COALESCE(e.is_active, TRUE) = TRUE AND e.store_id = %(store_id)s
+    """),
+    ('overview_page', """
+        SELECT e.id, e.name, e.start_date, e.end_date, s.name
+          FROM employees e LEFT JOIN stores s ON s.id = e.store_id
+         WHERE (e.end_date IS NULL OR e.end_date >= CURRENT_DATE)
+           AND COALESCE(e.is_active, TRUE) = TRUE AND e.store_id = %(store_id)s
+         ORDER BY e.id LIMIT 20 OFFSET 0
+    """),
+    ('leave_usage_page', """
+        SELECT employee_id, leave_type, COALESCE(SUM(hours),0)
+          FROM leave_records
+         WHERE status='approved' AND COALESCE(deleted,FALSE)=FALSE
+           AND employee_id = ANY(%(emp_ids)s)
+         GROUP BY employee_id, leave_type
+    """),
+    ('leave_history_page', """
+        SELECT id, date_from, date_to, hours, status
+          FROM leave_records
+         WHERE employee_id = %(emp_id)s AND leave_type = %(leave_type)s
+           AND COALESCE(deleted, FALSE) = FALSE
+           AND (date_from, id) < (%(month_end)s, 0)
+         ORDER BY date_from DESC, id DESC
+         LIMIT 51
+    """),
+    ('leave_history_subtotals', """
+        SELECT date_trunc('year', date_from), COALESCE(status, 'approved'), COUNT(*), SUM(hours)
+          FROM leave_records
+         WHERE employee_id = %(emp_id)s AND leave_type = %(leave_type)s
+           AND COALESCE(deleted, FALSE) = FALSE
+         GROUP BY 1, 2
+    """),
+    ('leave_by_id', "SELECT status, deleted FROM leave_records WHERE id=%(record_id)s"),
+    ('leave_overlap_check', """
+        SELECT id FROM leave_records
+         WHERE employee_id = %(emp_id)s
+           AND status='approved' AND COALESCE(deleted,FALSE)=FALSE
+           AND daterange(date_from, date_to, '[]') && daterange(%(month_start)s::date, %(month_end)s::date, '[]')
+    """),
+    ('monthly_leave_summary', """
+        SELECT e.id, e.name, e.store_id, lr.leave_type, lr.date_from, lr.date_to, lr.hours
+          FROM leave_records lr JOIN employees e ON e.id = lr.employee_id
+         WHERE lr.status='approved' AND COALESCE(lr.deleted,FALSE)=FALSE
+           AND lr.date_from < %(month_end)s
+           AND daterange(lr.date_from, lr.date_to, '[]') && daterange(%(month_start)s::date, %(month_end)s::date)
+    """),
+    ('leave_balances_page', """
+        SELECT employee_id, SUM(granted_hours + adjust_hours), SUM(used_hours)
+          FROM leave_grants
+         WHERE employee_id = ANY(%(emp_ids)s) AND expires_on >= CURRENT_DATE AND grant_date <= CURRENT_DATE
+         GROUP BY employee_id
+    """),
+    ('leave_expiring_grants', """
+        SELECT employee_id, expires_on FROM leave_grants
+         WHERE used_hours + expired_hours + paid_out_hours < granted_hours + adjust_hours
+           AND expires_on >= CURRENT_DATE AND expires_on <= CURRENT_DATE + 60
+    """),
+    ('insurance_by_employee', "SELECT * FROM insurances WHERE employee_id = %(emp_id)s"),
+    ('audit_by_row', """
+        SELECT * FROM audit_logs WHERE table_name = 'leave_records' AND row_id = %(record_id)s
+         ORDER BY acted_at DESC, id DESC LIMIT 50
+    """),
+    ('audit_by_user', """
+        SELECT * FROM audit_logs WHERE acted_by = %(acted_by)s
+         ORDER BY acted_at DESC, id DESC LIMIT 50
+    """),
+]
+
+def _plan_seq_scans(plan):
+    """走訪 EXPLAIN (FORMAT JSON) 的節點，回傳所有 Seq Scan 的資料表名稱。"""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(_plan_seq_scans(child))
+    return found
+
+def _seed_plan_check_data(conn, employees):
+    """在本機資料庫灌入測試資料（員工 × 約 10 筆假單、保險、稽核紀錄）。"""
+    today = date.today()
+    with conn.cursor() as c:
+        c.execute("""
+            INSERT INTO stores (name, short_code)
+            SELECT '測試分店' || i, 'T' || i FROM generate_series(1, 10) i
+            ON CONFLICT DO NOTHING
+        """)
+        c.execute("""
+            INSERT INTO employees (name, start_date, end_date, department, salary_grade,
+                                   base_salary, position_allowance, on_leave_suspend, is_active, store_id)
+            SELECT '員工' || i,
+                   CURRENT_DATE - (365 + (i * 37) %% 3650),
+                   CASE WHEN i %% 10 = 0 THEN CURRENT_DATE - (i %% 700) END,
+                   (ARRAY['門市','行政','倉儲'])[1 + i %% 3], 'A',
+                   28000 + (i %% 40) * 500, (i %% 5) * 1000, FALSE, i %% 10 <> 0,
+                   (SELECT id FROM stores ORDER BY id OFFSET (i %% 10) LIMIT 1)
+              FROM generate_series(1, %s) i
+        """, (employees,))
+        for y in range(today.year - 6, today.year + 1):
+            _ensure_leave_partition_for(conn, date(y, 1, 1))
+        c.execute("""
+            INSERT INTO leave_records (employee_id, leave_type, date_from, date_to, hours, days,
+                                       status, deleted, created_by, approved_by, approved_at)
+            SELECT e.id, (ARRAY['特休','病假','事假','婚假'])[1 + (e.id + k) % 4], d, d,
+                   (1 + (e.id + k) % 16) * 0.5, 0,
+                   (ARRAY['approved','approved','approved','approved','approved','approved',
+                          'approved','approved','rejected','canceled'])[1 + (e.id * 7 + k) % 10],
+                   (e.id + k) % 20 = 0, 'seed', 'seed', NOW()
+              FROM employees e
+             CROSS JOIN generate_series(1, 10) k
+             CROSS JOIN LATERAL (SELECT CURRENT_DATE - ((e.id * 13 + k * 151) % 2190) AS d) x
+        """)
+        c.execute("""
+            INSERT INTO insurances (employee_id, personal_labour, personal_health, company_labour, company_health)
+            SELECT id, 700, 450, 2500, 1400 FROM employees
+            ON CONFLICT (employee_id) DO NOTHING
+        """)
+        m = today.replace(day=1)
+        for _ in range(12):
+            m = _add_months(m, -1)
+            _ensure_audit_partition(c, m)
+        c.execute("""
+            INSERT INTO audit_logs (table_name, row_id, action, before_json, after_json, acted_by, acted_at)
+            SELECT 'leave_records', lr.id, 'update', '{}'::jsonb, '{}'::jsonb,
+                   'user' || (lr.id % 50), date_trunc('month', NOW()) - ((lr.id % 330) || ' days')::interval
+              FROM leave_records lr WHERE lr.id % 2 = 0
+        """)
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+
+@app.cli.command('plan-check')
+@click.option('--seed', type=int, default=0, help='先在本機資料庫灌入 N 位員工的測試資料')
+@click.option('--min-rows', type=int, default=5000, show_default=True,
+              help='資料表（分區）估計筆數達此值才視為大表')
+def plan_check_command(seed, min_rows):
+    """
+    對 PLAN_CHECKS 逐一 EXPLAIN；只要在大表上出現 Seq Scan 就失敗（exit code 1）。
+    用法：DATABASE_URL=postgresql://...@localhost/hr_test?sslmode=disable flask plan-check --seed 20000
+    """
+    if seed and urlparse(os.environ['DATABASE_URL']).hostname not in ('localhost', '127.0.0.1', '::1'):
+        raise click.ClickException('--seed 只允許用在本機資料庫')
+    init_db()
+    with get_conn() as conn:
+        if seed:
+            _seed_plan_check_data(conn, seed)
+            conn.autocommit = True
+            ensure_hot_indexes(conn, echo=click.echo)
+            conn.autocommit = False
+
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT (SELECT store_id FROM employees WHERE store_id IS NOT NULL
+                         GROUP BY store_id ORDER BY COUNT(*) DESC LIMIT 1),
+                       (SELECT array_agg(id) FROM (SELECT id FROM employees ORDER BY id LIMIT 20) t),
+                       (SELECT employee_id FROM leave_records ORDER BY id DESC LIMIT 1),
+                       (SELECT leave_type FROM leave_records ORDER BY id DESC LIMIT 1),
+                       (SELECT MAX(id) FROM leave_records),
+                       (SELECT date_trunc('month', MAX(date_from))::date FROM leave_records),
+                       (SELECT acted_by FROM audit_logs ORDER BY id DESC LIMIT 1)
+            """)
+            store_id, emp_ids, emp_id, leave_type, record_id, month_start, acted_by = c.fetchone()
+            month_start = month_start or date.today().replace(day=1)
+            params = {
+                'store_id': store_id, 'emp_ids': emp_ids or [], 'emp_id': emp_id,
+                'leave_type': leave_type, 'record_id': record_id,
+                'month_start': month_start, 'month_end': _add_months(month_start, 1),
+                'acted_by': acted_by,
+            }
+            c.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+            rel_rows = {name: n for name, n in c.fetchall()}
+
+        failures = []
+        cc = psycopg.ClientCursor(conn)  # EXPLAIN 需要把參數直接帶入 SQL
+        for label, sql in PLAN_CHECKS:
+            cc.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cc.fetchone()[0][0]['Plan']
+            big = [r for r in _plan_seq_scans(plan) if rel_rows.get(r, 0) >= min_rows]
+            if big:
+                failures.append(label)
+                click.echo(f"FAIL {label}: Seq Scan on {', '.join(sorted(set(big)))}")
+            else:
+                click.echo(f"ok   {label}")
+        cc.close()
+    if failures:
+        raise click.ClickException(f"{len(failures)} 個查詢退化為循序掃描：{', '.join(failures)}")
+
+@app.cli.command('leave-partition-migrate')
+@click.option('--batch', default=5000, show_default=True, help='每批回填的 id 範圍')
+def leave_partition_migrate_command(batch):
+    """
+    線上把舊的單一 leave_records 轉成年度分區表（不停機）：
+      1) 建立 leave_records_part（結構同原表）與各年度分區
+      2) 原表掛觸發器，轉換期間的新增/修改/刪除同步寫入 leave_records_part
+      3) 依 id 分批回填舊資料（每批獨立交易，不長時間鎖表）
+      4) 校正回填期間的差異後，短暫鎖表互換名稱
+    中途中斷可直接重跑；原表保留為 leave_records_unpartitioned，確認無誤後再手動 DROP。
+    """
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        if _leave_records_is_partitioned(c):
+            click.echo('leave_records 已是分區表，不需轉換')
+            return
+
+        c.execute("SELECT to_regclass('leave_records_part')")
+        if c.fetchone()[0] is None:
+            c.execute("""
+                CREATE TABLE leave_records_part (LIKE leave_records INCLUDING DEFAULTS)
+                  PARTITION BY RANGE (date_from)
+            """)
+            c.execute("ALTER TABLE leave_records_part ADD CONSTRAINT leave_records_pk PRIMARY KEY (id, date_from, archived)")
+        # LIKE 不會複製外鍵/CHECK：回填前照原表補上（空表驗證不花時間，之後觸發器/回填寫入也一併受檢查）
+        c.execute("""
+            SELECT o.conname, pg_get_constraintdef(o.oid)
+              FROM pg_constraint o
+             WHERE o.conrelid = 'leave_records'::regclass AND o.contype IN ('f', 'c')
+               AND NOT EXISTS (SELECT 1 FROM pg_constraint p
+                                WHERE p.conrelid = 'leave_records_part'::regclass AND p.conname = o.conname)
+        """)
+        for conname, condef in c.fetchall():
+            c.execute(f'ALTER TABLE leave_records_part ADD CONSTRAINT "{conname}" {condef}')
+        c.execute("SELECT EXTRACT(YEAR FROM MIN(date_from))::int, EXTRACT(YEAR FROM MAX(date_from))::int FROM leave_records")
+        lo, hi = c.fetchone()
+        this_year = date.today().year
+        for y in range(min(lo or this_year, this_year), max(hi or this_year, this_year + 1) + 1):
+            _ensure_leave_year_partition(c, y, parent='leave_records_part')
+        conn.commit()
+
+        c.execute("""
+            SELECT column_name FROM information_schema.columns
+             WHERE table_schema = current_schema() AND table_name = 'leave_records'
+             ORDER BY ordinal_position
+        """)
+        cols = [r[0] for r in c.fetchall()]
+        col_list = ', '.join(cols)
+        new_list = ', '.join(f'NEW.{col}' for col in cols)
+        set_list = ', '.join(f'{col} = EXCLUDED.{col}' for col in cols if col not in ('id', 'date_from', 'archived'))
+        key_match = "l.id = p.id AND l.date_from = p.date_from AND l.archived = p.archived"
+        c.execute(f"""
+            CREATE OR REPLACE FUNCTION leave_records_mirror() RETURNS trigger AS $$
+            BEGIN
+              IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM leave_records_part WHERE id = OLD.id;
+              END IF;
+              IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO leave_records_part ({col_list}) VALUES ({new_list})
+                ON CONFLICT (id, date_from, archived) DO UPDATE SET {set_list};
+              END IF;
+              RETURN NULL;
+            END $$ LANGUAGE plpgsql
+        """)
+        c.execute("DROP TRIGGER IF EXISTS leave_records_mirror ON leave_records")
+        c.execute("""
+            CREATE TRIGGER leave_records_mirror
+              AFTER INSERT OR UPDATE OR DELETE ON leave_records
+              FOR EACH ROW EXECUTE FUNCTION leave_records_mirror()
+        """)
+        conn.commit()
+
+        # 回填（已存在的列略過：觸發器寫入的版本一定比較新）
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM leave_records")
+        max_id = c.fetchone()[0]
+        last = 0
+        while last < max_id:
+            c.execute(f"""
+                INSERT INTO leave_records_part ({col_list})
+                SELECT {col_list} FROM leave_records WHERE id > %s AND id <= %s
+                ON CONFLICT (id, date_from, archived) DO NOTHING
+            """, (last, last + batch))
+            conn.commit()
+            last += batch
+            click.echo(f"backfilled id <= {min(last, max_id)} / {max_id}")
+
+        # 回填與同時間的改期可能留下舊版本：兩邊各做一次 anti-join 校正
+        c.execute(f"""
+            DELETE FROM leave_records_part p
+             WHERE NOT EXISTS (SELECT 1 FROM leave_records l WHERE {key_match})
+        """)
+        c.execute(f"""
+            INSERT INTO leave_records_part ({col_list})
+            SELECT {col_list} FROM leave_records l
+             WHERE NOT EXISTS (SELECT 1 FROM leave_records_part p WHERE {key_match})
+            ON CONFLICT (id, date_from, archived) DO NOTHING
+        """)
+        conn.commit()
+
+        # 互換：之後觸發器已保證兩邊一致，鎖表期間只做筆數核對與改名
+        c.execute("SET LOCAL lock_timeout = '5s'")
+        c.execute("LOCK TABLE leave_records IN ACCESS EXCLUSIVE MODE")
+        c.execute("SELECT (SELECT COUNT(*) FROM leave_records), (SELECT COUNT(*) FROM leave_records_part)")
+        n_old, n_new = c.fetchone()
+        if n_old != n_new:
+            conn.rollback()
+            raise click.ClickException(f'筆數不一致（{n_old} vs {n_new}），請重跑')
+        c.execute("DROP TRIGGER leave_records_mirror ON leave_records")
+        c.execute("DROP FUNCTION leave_records_mirror()")
+        c.execute("ALTER TABLE leave_records RENAME TO leave_records_unpartitioned")
+        c.execute("ALTER TABLE leave_records_part RENAME TO leave_records")
+        c.execute("ALTER SEQUENCE IF EXISTS leave_records_id_seq OWNED BY leave_records.id")
+        conn.commit()
+        click.echo(f'完成：{n_new} 筆；舊表保留為 leave_records_unpartitioned')
+
+@app.cli.command('leave-archive')
+@click.option('--year', type=int, default=None, help='指定年度（預設：前年及更早的所有年度）')
+def leave_archive_command(year):
+    """把已離職員工在已結束年度的請假紀錄移入該年度的封存子分區（查詢方式不變）。"""
+    this_year = date.today().year
+    if year is not None and year >= this_year:
+        raise click.ClickException('只能封存已結束的年度')
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        if not _leave_records_is_partitioned(c):
+            raise click.ClickException('leave_records 尚未分區，請先執行 leave-partition-migrate')
+        if year is not None:
+            years = [year]
+        else:
+            c.execute("SELECT EXTRACT(YEAR FROM MIN(date_from))::int FROM leave_records")
+            lo = c.fetchone()[0] or this_year
+            years = list(range(lo, this_year - 1))
+
+        touched = []
+        for y in years:
+            c.execute("""
+                UPDATE leave_records lr
+                   SET archived = TRUE
+                  FROM employees e
+                 WHERE e.id = lr.employee_id
+                   AND e.end_date IS NOT NULL AND e.end_date < CURRENT_DATE
+                   AND lr.date_from >= %s AND lr.date_from < %s
+                   AND lr.archived = FALSE
+            """, (date(y, 1, 1), date(y + 1, 1, 1)))
+            moved = c.rowcount
+            conn.commit()
+            click.echo(f"{y}: archived {moved} rows")
+            if moved:
+                touched.append(y)
+
+        # 搬走後 hot 分區留下的空間交給 VACUUM 回收（不可在交易內執行）
+        conn.autocommit = True
+        for y in touched:
+            c.execute(f"VACUUM (ANALYZE) leave_records_y{y}_hot")
+            c.execute(f"ANALYZE leave_records_y{y}_arch")
+
+@app.cli.command('leave-ledger-sync')
+@click.option('--all', 'rebuild_all', is_flag=True, help='全部員工重算（預設只處理今天尚未同步的）')
+def leave_ledger_sync_command(rebuild_all):
+    """同步特休帳本：補新期別、推進遞延/到期、重新 FIFO 扣抵（建議每日排程）。"""
+    init_db()
+    with get_conn() as conn:
+        if rebuild_all:
+            with conn.cursor() as c:
+                c.execute("UPDATE employees SET leave_ledger_synced_on = NULL")
+            conn.commit()
+        n = _sync_stale_leave_ledgers(conn)
+    click.echo(f'synced {n} employees')
+
+def _settle_store(store_key, window_from, window_to):
+    """
+    單一分店的特休折現（可在子行程執行）：期別最終到期日、或員工離職日落在區間內的期別，
+    以未休時數 ×（底薪 + 職務津貼）時薪 寫入 leave_settlements，並記到 leave_grants.paid_out_*。
+    已結算的期別（grant_id UNIQUE）略過，整店一個交易，完成後寫 leave_settlement_runs。
+    """
+    with get_conn() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT e.id FROM employees e
+                 WHERE COALESCE(e.store_id, 0) = %(s)s
+                   AND (e.end_date BETWEEN %(f)s AND %(t)s
+                        OR EXISTS (SELECT 1 FROM leave_grants g
+                                    WHERE g.employee_id = e.id AND g.expires_on BETWEEN %(f)s AND %(t)s))
+            """, {'s': store_key, 'f': window_from, 't': window_to})
+            emp_ids = [r[0] for r in c.fetchall()]
+        # 今天尚未同步的帳本先同步（已用時數、離職後不再給假）
+        _sync_stale_leave_ledgers(conn, emp_ids)
+
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT g.id, e.id, e.store_id,
+                       CASE WHEN e.end_date BETWEEN %(f)s AND %(t)s AND e.end_date < g.expires_on
+                            THEN e.end_date ELSE g.expires_on END,
+                       CASE WHEN e.end_date BETWEEN %(f)s AND %(t)s AND e.end_date < g.expires_on
+                            THEN 'termination' ELSE 'expiry' END,
+                       g.granted_hours + g.adjust_hours - g.used_hours - g.paid_out_hours,
+                       e.base_salary, e.position_allowance
+                  FROM leave_grants g
+                  JOIN employees e ON e.id = g.employee_id
+                 WHERE g.employee_id = ANY(%(ids)s)
+                   AND (g.expires_on BETWEEN %(f)s AND %(t)s
+                        OR (e.end_date BETWEEN %(f)s AND %(t)s
+                            AND g.grant_date <= e.end_date AND g.expires_on >= e.end_date))
+                   AND g.used_hours + g.paid_out_hours < g.granted_hours + g.adjust_hours
+                   AND NOT EXISTS (SELECT 1 FROM leave_settlements s WHERE s.grant_id = g.id)
+            """, {'ids': emp_ids, 'f': window_from, 't': window_to})
+            rows = []
+            for gid, emp_id, store_id, settle_date, reason, hours, base, allowance in c.fetchall():
+                rate = Decimal(hourly_wage(Decimal(base or 0), Decimal(allowance or 0), PAYROLL_MONTHLY_HOURS)) \
+                    .quantize(Decimal('0.01'), ROUND_HALF_UP)
+                amount = int((hours * rate).quantize(Decimal('1'), ROUND_HALF_UP))
+                rows.append((gid, emp_id, store_id, settle_date, reason, hours, rate, amount))
+            if rows:
+                c.executemany("""
+                    INSERT INTO leave_settlements
+                      (grant_id, employee_id, store_id, settle_date, reason, hours, hourly_rate, amount)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+                    ON CONFLICT (grant_id) DO NOTHING
+                """, rows)
+                c.executemany("""
+                    UPDATE leave_grants
+                       SET paid_out_hours = paid_out_hours + %s, paid_out_on = %s,
+                           expired_hours = GREATEST(expired_hours - %s, 0), updated_at = NOW()
+                     WHERE id = %s
+                """, [(r[5], r[3], r[5], r[0]) for r in rows])
+            total = sum(r[7] for r in rows)
+            c.execute("""
+                INSERT INTO leave_settlement_runs (window_from, window_to, store_id, rows, amount)
+                VALUES (%s,%s,%s,%s,%s)
+                ON CONFLICT (window_from, window_to, store_id) DO UPDATE
+                   SET rows = leave_settlement_runs.rows + EXCLUDED.rows,
+                       amount = leave_settlement_runs.amount + EXCLUDED.amount, finished_at = NOW()
+            """, (window_from, window_to, store_key, len(rows), total))
+        write_audit(conn, 'leave_settlements', store_key, 'settle', None, {
+            'window_from': window_from.isoformat(), 'window_to': window_to.isoformat(),
+            'rows': len(rows), 'amount': total,
+        })
+    return store_key, len(rows), total
+
+@app.cli.command('leave-settle')
+@click.option('--from', 'window_from', required=True, help='YYYY-MM-DD：期別到期日/離職日區間起')
+@click.option('--to', 'window_to', required=True, help='YYYY-MM-DD：區間迄（含）')
+@click.option('--workers', type=int, default=None, help='平行行程數（預設 CPU 數）')
+@click.option('--out', 'out_path', default=None, help='薪資匯入 CSV 路徑（預設 leave_settlement_<from>_<to>.csv）')
+@click.option('--rerun', is_flag=True, help='已完成的分店也重跑（仍不會重複結算同一期別）')
+def leave_settle_command(window_from, window_to, workers, out_path, rerun):
+    """特休未休折現批次：依分店平行結算，可中斷後重跑（冪等），最後輸出薪資 CSV。"""
+    try:
+        f = datetime.strptime(window_from, '%Y-%m-%d').date()
+        t = datetime.strptime(window_to, '%Y-%m-%d').date()
+    except ValueError:
+        raise click.BadParameter('日期格式需為 YYYY-MM-DD')
+    if t < f or t >= date.today():
+        raise click.BadParameter('區間需已結束（--to 早於今天）且 --from ≤ --to')
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("SELECT DISTINCT COALESCE(store_id, 0) FROM employees ORDER BY 1")
+        stores = [r[0] for r in c.fetchall()]
+        if not rerun:
+            c.execute("SELECT store_id FROM leave_settlement_runs WHERE window_from=%s AND window_to=%s", (f, t))
+            done = {r[0] for r in c.fetchall()}
+            skipped = [s for s in stores if s in done]
+            stores = [s for s in stores if s not in done]
+            if skipped:
+                click.echo(f"skip {len(skipped)} finished stores")
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(stores) or 1))
+    if workers == 1:
+        results = [_settle_store(s, f, t) for s in stores]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_settle_store, stores, [f] * len(stores), [t] * len(stores)))
+    for store_key, n, total in results:
+        click.echo(f"store {store_key}: {n} grants, {total} 元")
+
+    out_path = out_path or f'leave_settlement_{f}_{t}.csv'
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT s.employee_id, e.name, st.name, s.settle_date, s.reason, s.hours, s.hourly_rate, s.amount, s.grant_id
+              FROM leave_settlements s
+              JOIN employees e ON e.id = s.employee_id
+              LEFT JOIN stores st ON st.id = s.store_id
+             WHERE s.settle_date BETWEEN %s AND %s
+             ORDER BY s.store_id NULLS FIRST, s.employee_id, s.settle_date
+        """, (f, t))
+        with open(out_path, 'w', newline='', encoding='utf-8-sig') as fh:
+            w = csv.writer(fh)
+            w.writerow(['員工ID','姓名','分店','結算日','原因','未休時數','時薪','折現金額','期別ID'])
+            n = 0
+            for r in c:
+                w.writerow(r); n += 1
+    click.echo(f"{out_path}: {n} rows")
+
+@app.cli.command('job-worker')
+@click.option('--once', is_flag=True, help='佇列清空就結束（排程/測試用）')
+@click.option('--poll', type=float, default=2.0, help='佇列空時的輪詢秒數')
+def job_worker_command(once, poll):
+    """背景工作 worker：可同時跑多個，以 SKIP LOCKED 分件。"""
+    import time
+    init_db()
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    click.echo(f'worker {worker_id} started')
+    while True:
+        with get_conn() as conn:
+            job = _claim_job(conn, worker_id)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll)
+            continue
+        result = _run_job(job)
+        click.echo(f"job #{job['id']} {job['kind']} (attempt {job['attempts']}): {result}")
+
+@app.cli.command('leave-policy-sim')
+@click.option('--scenario', 'scenarios', multiple=True, help='calendar / anniversary / anniversary:12；第一個為基準（預設現行設定）')
+@click.option('--as-of', 'as_of', default=None, help='YYYY-MM-DD（預設今天）')
+@click.option('--window-days', type=int, default=365, help='到期統計視窗天數')
+@click.option('--out', 'out_path', default=None, help='每人明細 CSV 路徑')
+def leave_policy_sim_command(scenarios, as_of, window_days, out_path):
+    """特休制度試算：比較不同制度/遞延設定下全體的給假、到期與折現成本。"""
+    try:
+        scenarios = [_parse_policy_scenario(s) for s in scenarios] or _default_policy_scenarios()
+        as_of_d = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else date.today()
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    init_db()
+    with get_conn() as conn:
+        _sync_stale_leave_ledgers(conn, never_only=True)
+        conn.commit()
+        totals, items = _simulate_leave_policies(conn, scenarios, as_of_d, window_days)
+    for label, t in totals.items():
+        click.echo(f"{label:<16} 有效給假 {t['entitled_hours']:>12} h  可用 {t['available_hours']:>12} h  "
+                   f"到期 {t['expiring_hours']:>10} h  折現 {t['payout_cost']:>12} 元")
+    if out_path:
+        labels = list(totals)
+        fields = ('entitled_hours', 'available_hours', 'expiring_hours', 'payout_cost')
+        with open(out_path, 'w', newline='', encoding='utf-8-sig') as f:
+            w = csv.writer(f)
+            w.writerow(['員工ID', '姓名', '分店'] + [f'{l} {k}' for l in labels for k in fields])
+            for r in items:
+                w.writerow([r['employee_id'], r['name'], r['store_id']]
+                           + [r['scenarios'][l][k] for l in labels for k in fields])
+        click.echo(f"明細 {len(items)} 筆 → {out_path}")
+
+@app.cli.command('insurance-recalc')
+@click.option('--as-of', 'as_of', default=None, help='YYYY-MM-DD，取該日生效的費率版本（預設今天）')
+@click.option('--apply', 'do_apply', is_flag=True, help='實際寫入；未指定只列出差異')
+def insurance_recalc_command(as_of, do_apply):
+    """依勞健保級距與費率重算所有在職、未鎖定員工的保費。"""
+    try:
+        as_of_d = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else date.today()
+    except ValueError:
+        raise click.BadParameter('格式需為 YYYY-MM-DD', param_hint='--as-of')
+    init_db()
+    with get_conn() as conn:
+        if not do_apply:
+            rows = _insurance_recalc(conn, as_of=as_of_d)
+            for r in rows[:50]:
+                click.echo(f"{r['employee_id']} {r['name']}: {r['before']} → {r['after']}")
+            click.echo(f"共 {len(rows)} 位保費有差異（加 --apply 寫入）")
+            skipped = _insurance_missing_wage(conn)
+            if skipped:
+                click.echo(f"另有 {len(skipped)} 位月薪為 0 未計算：" + ', '.join(str(r['employee_id']) for r in skipped[:50]))
+            return
+        n = _insurance_recalc(conn, as_of=as_of_d, apply=True, acted_by='cli')
+        conn.commit()
+        write_audit(conn, 'insurances', 0, 'recalc', None, {'as_of': as_of_d.isoformat(), 'updated': n}, acted_by='cli')
+    click.echo(f"已更新 {n} 位員工保費")
+
+@app.cli.command('payroll-run')
+@click.option('--month', 'month', default=None, help='YYYY-MM（預設本月）')
+@click.option('--workers', type=int, default=None, help='平行行程數（預設 CPU 數）')
+def payroll_run_command(month, workers):
+    """全公司薪資計算：每個分店一個 run，可平行。"""
+    try:
+        month_start = datetime.strptime(month or date.today().strftime('%Y-%m'), '%Y-%m').date()
+    except ValueError:
+        raise click.BadParameter('格式需為 YYYY-MM', param_hint='--month')
+    init_db()
+    with get_conn() as conn:
+        keys = _payroll_store_keys(conn)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(keys) or 1))
+    if workers == 1:
+        results = [_run_payroll_store(k, month_start) for k in keys]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_run_payroll_store, keys, [month_start] * len(keys)))
+    for key, run_id, n, net in results:
+        click.echo(f"store {key}: run #{run_id}, {n} lines, 實發 {net} 元")
+    with get_conn() as conn:
+        write_audit(conn, 'payroll_runs', results[0][1] if results else 0, 'run', None, {
+            'month': month_start.strftime('%Y-%m'), 'runs': [r[1] for r in results],
+        })
+
+@app.cli.command('leave-snapshot')
+@click.option('--month', 'month', default=None, help='YYYY-MM；在該月月底建立檢查點（預設上個月）')
+def leave_snapshot_command(month):
+    """建立月底餘額檢查點：前一個檢查點 + 之後的差額，讓歷史查詢只需重放少量假單。"""
+    if month:
+        try:
+            month_start = datetime.strptime(month, '%Y-%m').date()
+        except ValueError:
+            raise click.BadParameter('格式需為 YYYY-MM', param_hint='--month')
+    else:
+        month_start = _add_months(date.today().replace(day=1), -1)
+    as_of = _add_months(month_start, 1) - timedelta(days=1)
+    if as_of >= date.today():
+        raise click.BadParameter('只能對已結束的月份建立檢查點', param_hint='--month')
+    init_db()
+    n = 0
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("SELECT id FROM employees ORDER BY id")
+        ids = [r[0] for r in c.fetchall()]
+        # 每批先取員工的帳本鎖再計算/寫入，與假單異動的檢查點失效互斥（不會寫回已失效的舊數字）
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            _lock_leave_ledger(conn, chunk)
+            query, params = _usage_as_of_query(chunk, as_of)
+            c.execute(f"""
+                INSERT INTO leave_balance_snapshots (employee_id, leave_type, as_of, used_hours)
+                SELECT employee_id, leave_type, %(as_of)s, used FROM ({query}) AS q(employee_id, leave_type, used)
+                ON CONFLICT (employee_id, leave_type, as_of) DO UPDATE
+                   SET used_hours = EXCLUDED.used_hours, taken_at = NOW()
+            """, params)
+            n += c.rowcount
+            conn.commit()
+    click.echo(f'{as_of}: {n} snapshot rows')
+
+@app.cli.command('leave-hours-check')
+@click.option('--year', type=int, default=None, help='檢查的年度（依假單開始日，預設今年）')
+def leave_hours_check_command(year):
+    """比對核准假單時數與工作日曆，列出不符的假單（不修改資料）。"""
+    year = year or date.today().year
+    init_db()
+    with get_conn() as conn:
+        rows = _leave_hours_mismatches(conn, date(year, 1, 1), date(year + 1, 1, 1))
+    for m in rows:
+        click.echo(f"#{m['id']}\temp={m['employee_id']}\t{m['leave_type']}\t{m['date_from']}~{m['date_to']}"
+                   f"\t登記 {m['hours']}h / 應扣 {m['expected_hours']}h（{m['business_days']} 個工作日）")
+    click.echo(f'{year}: {len(rows)} 筆時數與工作日曆不符')
+
+@app.cli.command('milestones-refresh')
+@click.option('--all', 'refresh_all', is_flag=True, help='全部員工重算（預設只補過期/未算過的）')
+def milestones_refresh_command(refresh_all):
+    """年資里程碑（下次週年日/特休級距變動日）每日補算；建議每日排程。"""
+    init_db()
+    with get_conn() as conn:
+        if refresh_all:
+            with conn.cursor() as c:
+                c.execute("SELECT id FROM employees")
+                n = _refresh_milestones(conn, [r[0] for r in c.fetchall()])
+        else:
+            n = _refresh_milestones(conn)
+        conn.commit()
+    click.echo(f'{n} 位員工里程碑已更新')
+
+@app.cli.command('rollup-refresh')
+@click.option('--months', type=int, default=3, help='額外重算最近 N 個月（補齊未經寫入路徑的異動）')
+@click.option('--all', 'rebuild_all', is_flag=True, help='全部月份重建')
+def rollup_refresh_command(months, rebuild_all):
+    """分析彙總表夜間補算：重算 dirty 月份 + 最近 N 個月；--all 全部重建。"""
+    init_db()
+    with get_conn() as conn, conn.cursor() as c:
+        if rebuild_all:
+            c.execute("""
+                INSERT INTO rollup_dirty_months (kind, month)
+                SELECT DISTINCT 'leave', date_trunc('month', date_from)::date FROM leave_records
+                UNION
+                SELECT 'headcount', date_trunc('month', d)::date
+                  FROM employees, LATERAL (VALUES (start_date), (end_date)) v(d) WHERE d IS NOT NULL
+                UNION
+                SELECT 'leave', month FROM leave_monthly_rollup
+                UNION
+                SELECT 'headcount', month FROM headcount_monthly_rollup
+                ON CONFLICT DO NOTHING
+            """)
+        else:
+            recent = [_add_months(date.today().replace(day=1), -i) for i in range(months)]
+            _mark_rollup_months(conn, 'leave', recent)
+            _mark_rollup_months(conn, 'headcount', recent)
+        n = _refresh_rollups(conn)
+    click.echo(f'{n} 個月份重算')
+
+# -------------------------
+# 分析用匯出（Parquet）：stores/employees/insurances 整表快照，leave_records 依 date_from 月份分區
+# 每個資料集/分區在 DB 端算 fingerprint（筆數 + 每列雜湊總和），與輸出目錄的 _manifest.json 比對，
+# 只重寫有變動的檔案；下游依 manifest 的 exported_at 只讀新的分區。pyarrow 只有這裡用到，延遲載入。
+# -------------------------
+ANALYTICS_TABLES = ('stores', 'employees', 'insurances')
+ANALYTICS_MANIFEST = '_manifest.json'
+
+def _arrow_schema(description):
+    """cursor.description → pyarrow schema；回傳 (schema, 需轉成 JSON 字串的欄位索引)。"""
+    import pyarrow as pa
+    fields, json_cols = [], set()
+    for i, col in enumerate(description):
+        info = psycopg.postgres.types.get(col.type_code)
+        name = info.name if info else ''
+        if name in ('int2', 'int4'):
+            typ = pa.int32()
+        elif name == 'int8':
+            typ = pa.int64()
+        elif name in ('float4', 'float8'):
+            typ = pa.float64()
+        elif name == 'numeric':
+            typ = pa.decimal128(col.precision, col.scale) if col.precision else pa.decimal128(38, 9)
+        elif name == 'bool':
+            typ = pa.bool_()
+        elif name == 'date':
+            typ = pa.date32()
+        elif name == 'timestamp':
+            typ = pa.timestamp('us')
+        elif name == 'timestamptz':
+            typ = pa.timestamp('us', tz='UTC')
+        else:
+            typ = pa.string()
+            if name in ('json', 'jsonb'):
+                json_cols.add(i)
+        fields.append(pa.field(col.name, typ))
+    return pa.schema(fields), json_cols
+
+def _write_parquet(conn, path, query, params=()):
+    """具名 cursor 每批 EXPORT_BATCH_SIZE 筆寫成一個 row group；先寫 .part 再換名。回傳筆數。"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.part'
+    n = 0
+    try:
+        with conn.cursor(name='analytics_export') as c:
+            c.itersize = EXPORT_BATCH_SIZE
+            c.execute(query, params)
+            schema, json_cols = _arrow_schema(c.description)
+            with pq.ParquetWriter(tmp, schema, compression='zstd') as w:
+                while True:
+                    rows = c.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    cols = list(zip(*rows))
+                    arrays = [pa.array([None if v is None else json.dumps(v, ensure_ascii=False) for v in col]
+                                       if i in json_cols else col, type=schema.field(i).type)
+                              for i, col in enumerate(cols)]
+                    w.write_batch(pa.record_batch(arrays, schema=schema))
+                    n += len(rows)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return n
+
+def _analytics_fingerprints(conn):
+    """{(資料集, 分區): fingerprint}；維度表分區為 ''，leave_records 為 'YYYY-MM'。"""
+    out = {}
+    with conn.cursor() as c:
+        for t in ANALYTICS_TABLES:
+            c.execute(f"SELECT count(*), COALESCE(sum(hashtextextended(t::text, 0)::numeric), 0) FROM {t} t")
+            n, h = c.fetchone()
+            out[(t, '')] = f'{n}:{h}'
+        c.execute("""
+            SELECT to_char(date_from, 'YYYY-MM'), count(*), sum(hashtextextended(lr::text, 0)::numeric)
+              FROM leave_records lr
+             GROUP BY 1
+        """)
+        for month, n, h in c.fetchall():
+            out[('leave_records', month)] = f'{n}:{h}'
+    return out
+
+def _analytics_export(conn, out_dir, full=False, log=lambda msg: None):
+    """
+    依 manifest 增量匯出；整個過程在同一個 REPEATABLE READ 快照內，fingerprint 與檔案內容一致。
+    回傳 (重寫的檔案數, 刪除的分區數)。
+    """
+    manifest_path = os.path.join(out_dir, ANALYTICS_MANIFEST)
+    manifest = {'datasets': {}}
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    datasets = manifest.setdefault('datasets', {})
+
+    conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+    prints = _analytics_fingerprints(conn)
+    now = datetime.now().isoformat(timespec='seconds')
+    written = removed = 0
+
+    for (name, part), fp in sorted(prints.items()):
+        parts = datasets.setdefault(name, {})
+        key = part or 'all'
+        if parts.get(key, {}).get('fingerprint') == fp:
+            continue
+        if part:
+            rel = os.path.join(name, f'month={part}', 'part-0.parquet')
+            month_start = datetime.strptime(part, '%Y-%m').date()
+            n = _write_parquet(conn, os.path.join(out_dir, rel),
+                               "SELECT * FROM leave_records WHERE date_from >= %s AND date_from < %s ORDER BY id",
+                               (month_start, _add_months(month_start, 1)))
+        else:
+            rel = f'{name}.parquet'
+            n = _write_parquet(conn, os.path.join(out_dir, rel), f"SELECT * FROM {name} ORDER BY 1")
+        parts[key] = {'path': rel, 'rows': n, 'fingerprint': fp, 'exported_at': now}
+        written += 1
+        log(f'{rel}: {n} rows')
+
+    # 已沒有資料的月份（整月假單被刪/搬走）→ 移除分區目錄。
+    # 以 manifest 與磁碟上實際的 month=* 目錄對帳：--full 不讀 manifest，舊分區只能從磁碟找到
+    stale = {m for m in datasets.get('leave_records', {}) if ('leave_records', m) not in prints}
+    part_root = os.path.join(out_dir, 'leave_records')
+    if os.path.isdir(part_root):
+        stale |= {d[len('month='):] for d in os.listdir(part_root)
+                  if d.startswith('month=') and ('leave_records', d[len('month='):]) not in prints}
+    for month in sorted(stale):
+        datasets.get('leave_records', {}).pop(month, None)
+        shutil.rmtree(os.path.join(part_root, f'month={month}'), ignore_errors=True)
+        removed += 1
+        log(f"leave_records/month={month}: removed")
+    conn.rollback()
+
+    manifest['generated_at'] = now
+    os.makedirs(out_dir, exist_ok=True)
+    with open(manifest_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.part', manifest_path)
+    return written, removed
+
+@app.cli.command('analytics-export')
+@click.option('--out', 'out_dir', default='analytics', help='輸出目錄（含 _manifest.json）')
+@click.option('--full', is_flag=True, help='忽略 manifest，全部重寫')
+def analytics_export_command(out_dir, full):
+    """匯出分析用 Parquet（型別保留、zstd 壓縮）；預設只重寫有變動的表/月份分區。"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise click.ClickException('需要 pyarrow：pip install pyarrow')
+    init_db()
     with get_conn() as conn:
-        write_audit(conn, 'backup', 0, 'backup', None, {'by': getattr(g,'current_user', None)})
-    return send_file(buf, mimetype='application/zip', as_attachment=True,
-                     download_name=f'backup_{date.today().isoformat()}.zip')
+        written, removed = _analytics_export(conn, out_dir, full, log=click.echo)
+    click.echo(f'{out_dir}: {written} 個檔案重寫，{removed} 個分區移除')
 
 # -------------------------
 # 啟動
@@ -1,8 +1,9 @@
-from datetime import date
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 
-def calculate_seniority(start_date):
-    """回傳年資（整年, 剩餘月）"""
-    today = date.today()
+def calculate_seniority(start_date, as_of=None):
+    """回傳年資（整年, 剩餘月）；as_of 指定基準日（預設今天）"""
+    today = as_of or date.today()
     years = today.year - start_date.year
     months = today.month - start_date.month
     if today.day < start_date.day:
@@ -47,6 +48,19 @@ def entitled_leave_days(years, months, on_leave_suspend):
     days = 15 + extra_years
     return min(days, 30)
 
+def leave_tier_changes(max_years=40):
+    """
+    特休天數會改變的年資點：[(滿幾個月, 之後的天數)]，依 entitled_leave_days 逐月比對產生
+    （6 個月、1/2/3/5 年、10 年起每年，到 30 天上限為止）。
+    """
+    changes, prev = [], entitled_leave_days(0, 0, False)
+    for m in range(1, max_years * 12 + 1):
+        days = entitled_leave_days(m // 12, m % 12, False)
+        if days != prev:
+            changes.append((m, days))
+            prev = days
+    return changes
+
 def entitled_sick_days(years, months):
     """依勞基法，每年可用病假上限為30天"""
     return 30
@@ -58,3 +72,193 @@ def entitled_personal_days(years, months):
 def entitled_marriage_days():
     """依勞基法，婚假一次給8天"""
     return 8
+
+def hourly_wage(base_salary, position_allowance, monthly_hours=240):
+    """月薪制換算時薪：(底薪 + 職務津貼) ÷ 每月工時（勞基法慣例 30 日 × 8 小時 = 240）"""
+    return ((base_salary or 0) + (position_allowance or 0)) / monthly_hours
+
+# -------------------------
+# 月薪計算（單一員工單月；金額四捨五入到元）
+# -------------------------
+SICK_HALF_PAY_HOURS = 240   # 普通傷病假一年內未超過 30 日（240 小時）部分工資折半
+
+def payroll_line(base_salary, position_allowance, employed_days, month_days,
+                 personal_hours=0, sick_hours=0, sick_ytd_hours=0,
+                 personal_labour=0, personal_health=0, leave_cashout=0, monthly_hours=240):
+    """
+    回傳 dict：應發、事假/病假扣款、勞健保自付、特休折現與實發。
+      • 到職/離職當月依在職日數比例計薪
+      • 事假不給薪：時數 × 時薪全扣
+      • 病假：今年（含本月前）累計 240 小時內扣半薪，超過部分不給薪
+      • sick_ytd_hours：本月之前今年已請的病假時數
+    以 Decimal 計算，各金額四捨五入（ROUND_HALF_UP）到元；不用 round()，避免 .5 元被銀行家捨入。
+    """
+    def d(x):
+        return Decimal(str(x or 0))
+    def r(x):
+        return int(x.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    monthly = d(base_salary) + d(position_allowance)
+    rate = monthly / d(monthly_hours)
+    gross = monthly if employed_days >= month_days else monthly * employed_days / month_days
+
+    half_left = max(SICK_HALF_PAY_HOURS - d(sick_ytd_hours), Decimal(0))
+    sick_half = min(d(sick_hours), half_left)
+    sick_unpaid = d(sick_hours) - sick_half
+    personal_deduction = d(personal_hours) * rate
+    sick_deduction = sick_half * rate / 2 + sick_unpaid * rate
+
+    net = r(gross) - r(personal_deduction) - r(sick_deduction) \
+        - r(d(personal_labour)) - r(d(personal_health)) + r(d(leave_cashout))
+    return {
+        'hourly_rate': float(rate.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)),
+        'gross': r(gross),
+        'personal_leave_hours': personal_hours,
+        'personal_leave_deduction': r(personal_deduction),
+        'sick_leave_hours': sick_hours,
+        'sick_half_pay_hours': float(sick_half),
+        'sick_leave_deduction': r(sick_deduction),
+        'personal_labour': r(d(personal_labour)),
+        'personal_health': r(d(personal_health)),
+        'leave_cashout': r(d(leave_cashout)),
+        'net': net,
+    }
+
+# -------------------------
+# 特休給假時點（供特休帳本 leave_grants 使用）
+# -------------------------
+def _add_months(d, months):
+    from calendar import monthrange
+    y = d.year + (d.month - 1 + months) // 12
+    m = (d.month - 1 + months) % 12 + 1
+    return date(y, m, min(d.day, monthrange(y, m)[1]))
+
+def annual_leave_grants(start_date, until):
+    """
+    到 until（含）為止的每一次特休給假：[(給假日, 天數)]。
+    滿6個月給一次，其後每滿1年給一次；天數依 entitled_leave_days。
+    """
+    grants = []
+    if not start_date:
+        return grants
+    months = 6
+    while True:
+        grant_date = _add_months(start_date, months)
+        if grant_date > until:
+            break
+        days = entitled_leave_days(months // 12, months % 12, False)
+        if days:
+            grants.append((grant_date, days))
+        months = 12 if months == 6 else months + 12
+    return grants
+
+def fifo_grant_balances(grants, leaves, as_of, window_end):
+    """
+    特休 FIFO 試算（不寫入）：grants = [(給假日, 最終到期日, 時數)] 依給假日排序，
+    leaves = [(請假日, 時數)] 依日期排序；每筆假扣抵最早且該日仍有效的期別。
+    回傳 (as_of 有效期別的給假時數, as_of 可用餘額, (as_of, window_end] 內到期未休時數)。
+    可用餘額只扣到 as_of（含）為止的假；as_of 之後已排定的假繼續扣抵，只影響到期未休的估算。
+    """
+    remaining = [h for _, _, h in grants]
+    as_of_left = None
+    for day, hours in leaves:
+        if as_of_left is None and day > as_of:
+            as_of_left = list(remaining)
+        for i, (gd, exp, _) in enumerate(grants):
+            if hours <= 0:
+                break
+            if gd <= day <= exp and remaining[i] > 0:
+                take = min(hours, remaining[i])
+                remaining[i] -= take
+                hours -= take
+    if as_of_left is None:
+        as_of_left = remaining
+    entitled = available = expiring = 0
+    for (gd, exp, h), left, left_now in zip(grants, remaining, as_of_left):
+        if gd <= as_of <= exp:
+            entitled += h
+            available += left_now
+        if as_of < exp <= window_end:
+            expiring += left
+    return entitled, available, expiring
+
+def forecast_leave_months(grants, monthly_usage, periods, leave_on=None):
+    """
+    特休逐月推估：grants = [[給假日, 最終到期日, 剩餘時數]]（含未來給假），
+    monthly_usage = 每月預期請休時數，periods = [(起日, 迄日)]（第一段可為不足月，按天數比例）。
+    每段依序：FIFO 扣抵預期請休（先到期先扣）→ 段內到期的餘額視為到期折現。
+    leave_on：預計離職日，該段結束時剩餘全數折現，之後不再推估。
+    回傳每段 (新給假, 預期請休, 到期, 段末餘額)。
+    """
+    from calendar import monthrange
+    grants = sorted(([gd, exp, h] for gd, exp, h in grants), key=lambda g: (g[1], g[0]))
+    out = []
+    for p_from, p_to in periods:
+        if leave_on is not None and p_from > leave_on:
+            out.append((0, 0, 0, 0))
+            continue
+        granted = sum(g[2] for g in grants if p_from <= g[0] <= p_to)
+        need = monthly_usage * ((p_to - p_from).days + 1) / monthrange(p_from.year, p_from.month)[1]
+        used = 0
+        for g in grants:
+            if need <= 0:
+                break
+            if g[0] <= p_to and g[1] >= p_from and g[2] > 0:
+                take = min(need, g[2])
+                g[2] -= take
+                need -= take
+                used += take
+        cutoff = leave_on if leave_on is not None and leave_on <= p_to else None
+        expiring = 0
+        for g in grants:
+            if g[0] <= p_to and (p_from <= g[1] <= p_to or (cutoff and g[1] > p_to)):
+                expiring += g[2]
+                g[2] = 0
+        balance = sum(g[2] for g in grants if g[0] <= p_to < g[1])
+        out.append((granted, used, expiring, balance))
+    return out
+
+# -------------------------
+# 工作日曆：每年一張工作日 bitmap + 前綴和
+# -------------------------
+def _year_days(year):
+    return 366 if date(year, 12, 31).timetuple().tm_yday == 366 else 365
+
+def build_business_day_bitmap(year, workdays, off_dates=(), on_dates=()):
+    """
+    產生該年度的工作日 bitmap（第 n 天 = 第 n 個 bit，1 = 上班）。
+      • workdays：一週中上班的 ISO 星期（1=週一 … 7=週日）
+      • off_dates：放假日（國定假日、颱風假、公司休業）
+      • on_dates：補班日；最後套用，可覆蓋 off_dates
+    """
+    n = _year_days(year)
+    bits = bytearray((n + 7) // 8)
+    first = date(year, 1, 1)
+    wd = set(int(w) for w in workdays)
+    for i in range(n):
+        if (first + timedelta(days=i)).isoweekday() in wd:
+            bits[i >> 3] |= 1 << (i & 7)
+    for d in off_dates:
+        if d.year == year:
+            i = d.timetuple().tm_yday - 1
+            bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+    for d in on_dates:
+        if d.year == year:
+            i = d.timetuple().tm_yday - 1
+            bits[i >> 3] |= 1 << (i & 7)
+    return bytes(bits)
+
+def business_day_prefix(bitmap, year):
+    """bitmap → 前綴和；prefix[i] = 該年前 i 天的工作日數（len = 天數 + 1）。"""
+    n = _year_days(year)
+    prefix = [0] * (n + 1)
+    for i in range(n):
+        prefix[i + 1] = prefix[i] + ((bitmap[i >> 3] >> (i & 7)) & 1)
+    return prefix
+
+def business_days_between(prefix, year, d_from, d_to):
+    """同一年度內 [d_from, d_to] 的工作日數，O(1)；跨年請呼叫端分段。"""
+    if d_to < d_from:
+        return 0
+    lo = d_from.timetuple().tm_yday - 1 if d_from.year == year else 0
+    hi = d_to.timetuple().tm_yday if d_to.year == year else len(prefix) - 1
+    return prefix[hi] - prefix[lo]
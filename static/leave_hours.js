@@ -0,0 +1,32 @@
+// 請假表單：選好起訖日期後，依工作日曆（/api/business-hours）自動帶入時數
+(function() {
+  document.querySelectorAll('form[data-business-hours]').forEach(form => {
+    const start = form.querySelector('[name="start_date"]');
+    const end = form.querySelector('[name="end_date"]');
+    const hours = form.querySelector('[name="hours"]');
+    const hint = form.querySelector('[data-business-hours-hint]');
+    if (!start || !end || !hours) return;
+
+    // 使用者手動改過時數就不再覆蓋
+    let manual = false;
+    hours.addEventListener('input', () => { manual = true; });
+
+    async function refresh() {
+      if (!start.value) return;
+      if (!end.value || end.value < start.value) end.value = start.value;
+      const url = new URL(form.dataset.businessHours, location.href);
+      url.searchParams.set('date_from', start.value);
+      url.searchParams.set('date_to', end.value);
+      try {
+        const res = await fetch(url);
+        if (!res.ok) return;
+        const data = await res.json();
+        if (hint) hint.textContent = `（工作日 ${data.business_days} 天，共 ${data.hours} 小時）`;
+        if (!manual) hours.value = data.hours || '';
+      } catch (e) { /* 離線或 API 失敗就維持手動輸入 */ }
+    }
+
+    start.addEventListener('change', refresh);
+    end.addEventListener('change', refresh);
+  });
+})();
@@ -0,0 +1,188 @@
+"""
+串流 XLSX 寫出（只用標準函式庫）：工作表 XML 逐列寫進 zip entry，記憶體用量與列數無關。
+  • 數字（int/float/Decimal）→ 數值儲存格；date/datetime → 日期序號 + 日期格式；bool → 布林
+  • 其他一律 inline string（不建 sharedStrings，才能邊讀邊寫）
+  • 每張表第一列為粗體標題並凍結
+輸出可為不可 seek 的串流（zipfile 會改用 data descriptor），搭配 ChunkSink 可邊產生邊回應。
+"""
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+_EPOCH = datetime(1899, 12, 30)
+
+# XML 1.0 不允許的控制字元（\t \n \r 以外）
+_ILLEGAL = dict.fromkeys(i for i in range(32) if i not in (9, 10, 13))
+
+# styles.xml 中 cellXfs 的索引
+_STYLE_DATE, _STYLE_DATETIME, _STYLE_HEADER = 1, 2, 3
+
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '</cellXfs></styleSheet>'
+)
+
+
+def _cell(value, style=None):
+    s = f' s="{style}"' if style else ''
+    if value is None or value == '':
+        return f'<c{s}/>'
+    if isinstance(value, bool):
+        return f'<c t="b"{s}><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c{s}><v>{value}</v></c>'
+    if isinstance(value, datetime):
+        serial = (value.replace(tzinfo=None) - _EPOCH).total_seconds() / 86400
+        return f'<c s="{style or _STYLE_DATETIME}"><v>{serial}</v></c>'
+    if isinstance(value, date):
+        return f'<c s="{style or _STYLE_DATE}"><v>{(value - _EPOCH.date()).days}</v></c>'
+    text = escape(str(value).translate(_ILLEGAL))
+    return f'<c t="inlineStr"{s}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class _Sheet:
+    def __init__(self, stream, header):
+        self._stream = stream
+        self._rows = 0
+        self._stream.write((
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetViews><sheetView workbookViewId="0">'
+            '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+            '</sheetView></sheetViews>'
+            '<sheetData>'
+        ).encode('utf-8'))
+        if header:
+            self._write(header, _STYLE_HEADER)
+
+    def _write(self, values, style=None):
+        self._rows += 1
+        cells = ''.join(_cell(v, style) for v in values)
+        self._stream.write(f'<row r="{self._rows}">{cells}</row>'.encode('utf-8'))
+
+    def writerow(self, values):
+        self._write(values)
+
+    def writerows(self, rows):
+        for r in rows:
+            self._write(r)
+
+    def close(self):
+        self._stream.write(b'</sheetData></worksheet>')
+        self._stream.close()
+
+
+class XlsxWriter:
+    """
+    用法：
+        with XlsxWriter(fileobj) as wb:
+            with wb.sheet('員工', ['ID', '姓名']) as ws:
+                for row in cursor:
+                    ws.writerow(row)
+    同一時間只能開一張工作表（zip entry 逐一寫入）。
+    """
+
+    def __init__(self, fileobj):
+        self._zf = zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_DEFLATED)
+        self._names = []
+
+    def sheet(self, name, header=()):
+        # 工作表名稱：最長 31 字、不可含 []:*?/\
+        name = ''.join('_' if ch in '[]:*?/\\' else ch for ch in str(name))[:31] or f'Sheet{len(self._names) + 1}'
+        self._names.append(name)
+        stream = self._zf.open(f'xl/worksheets/sheet{len(self._names)}.xml', mode='w', force_zip64=True)
+        return _SheetContext(_Sheet(stream, list(header)))
+
+    def close(self):
+        n = len(self._names)
+        sheets = ''.join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                         f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                         for i in range(1, n + 1))
+        self._zf.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{sheets}</Types>'))
+        self._zf.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'))
+        self._zf.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + ''.join(f'<sheet name="{escape(nm, {chr(34): "&quot;"})}" sheetId="{i}" r:id="rId{i}"/>'
+                      for i, nm in enumerate(self._names, 1))
+            + '</sheets></workbook>'))
+        self._zf.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(f'<Relationship Id="rId{i}" '
+                      'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{i}.xml"/>' for i in range(1, n + 1))
+            + f'<Relationship Id="rId{n + 1}" '
+              'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+              'Target="styles.xml"/></Relationships>'))
+        self._zf.writestr('xl/styles.xml', _STYLES)
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class _SheetContext:
+    def __init__(self, sheet):
+        self._sheet = sheet
+
+    def __enter__(self):
+        return self._sheet
+
+    def __exit__(self, exc_type, exc, tb):
+        self._sheet.close()
+
+
+class ChunkSink:
+    """只寫不 seek 的檔案物件：累積寫入的 bytes，drain() 取出後清空（供 HTTP 串流逐段送出）。"""
+
+    def __init__(self):
+        self._buf = []
+        self._pos = 0
+
+    def write(self, b):
+        self._buf.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._buf)
+        self._buf.clear()
+        return data